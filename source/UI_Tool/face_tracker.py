@@ -0,0 +1,130 @@
+import threading
+import time
+
+
+def box_iou(box_a, box_b):
+    """_summary_
+    Returns the intersection over union of two face regions in [x, y, w, h] format.
+    """
+    ax, ay, aw, ah = box_a
+    bx, by, bw, bh = box_b
+    overlap_w = min(ax + aw, bx + bw) - max(ax, bx)
+    overlap_h = min(ay + ah, by + bh) - max(ay, by)
+    if overlap_w <= 0 or overlap_h <= 0:
+        return 0.0
+    intersection = overlap_w * overlap_h
+    return intersection / float(aw * ah + bw * bh - intersection)
+
+
+class FaceTracker:
+    """_summary_
+    Tracks faces across the frames of one client by matching the face regions returned by the face detection server.
+    A face that overlaps a tracked face from the previous frame keeps the tracked face's embedding and labels, so it
+    does not need to be sent to the embedding and label servers again. Tracked faces are reprocessed every
+    refresh_frames frames so that the labels can still change.
+    """
+
+    def __init__(self, min_iou=0.5, refresh_frames=15, max_missed=2):
+        """_summary_
+
+        Args:
+            min_iou (float): Minimum intersection over union for a face to be matched to a tracked face. A face whose
+                             box has moved or changed size more than this is processed again.
+            refresh_frames (int): Number of frames a tracked face's embedding and labels are reused for.
+            max_missed (int): Number of frames a tracked face is remembered for after it stops being detected.
+        """
+        self.min_iou = min_iou
+        self.refresh_frames = refresh_frames
+        self.max_missed = max_missed
+        self.method = None
+        self._tracks = []
+        self._frame = []
+        self._missed = []
+        # Held by process_image from match() to commit() so requests from the same client are tracked in order.
+        self.lock = threading.Lock()
+
+    def match(self, face_data, method):
+        """_summary_
+        Matches the faces detected in a frame to the tracked faces. Matched faces have their "embedding" and "labels"
+        filled in from the tracked face.
+
+        Args:
+            face_data (list): list of dictionaries containing information about each face, as built in process_image.
+            method (str): The labelling method. Tracked labels are discarded if the method changes.
+
+        Returns:
+            list: The faces in face_data that need to be embedded and labelled.
+        """
+        if method != self.method:
+            self.method = method
+            self._tracks = []
+
+        # Greedily pair faces and tracks, best overlap first.
+        pairs = sorted(((box_iou(item["regions"], track["regions"]), i, j)
+                        for i, item in enumerate(face_data)
+                        for j, track in enumerate(self._tracks)), reverse=True)
+        matched_faces = {}
+        used_tracks = set()
+        for iou, i, j in pairs:
+            if iou < self.min_iou:
+                break
+            if i in matched_faces or j in used_tracks:
+                continue
+            matched_faces[i] = j
+            used_tracks.add(j)
+
+        pending = []
+        self._frame = []
+        for i, item in enumerate(face_data):
+            track = self._tracks[matched_faces[i]] if i in matched_faces else None
+            if track is not None and track["frames"] < self.refresh_frames:
+                item["embedding"] = track["embedding"]
+                item["labels"] = track["labels"]
+                self._frame.append((item, track["frames"] + 1))
+            else:
+                pending.append(item)
+                self._frame.append((item, 0))
+
+        self._missed = [dict(track, missed=track.get("missed", 0) + 1)
+                        for j, track in enumerate(self._tracks)
+                        if j not in used_tracks and track.get("missed", 0) < self.max_missed]
+        return pending
+
+    def commit(self):
+        """_summary_
+        Updates the tracked faces from the frame passed to the last call of match(). Must be called after the pending
+        faces have been embedded and labelled.
+        """
+        self._tracks = [{
+            "regions": item["regions"],
+            "embedding": item["embedding"],
+            "labels": item["labels"],
+            "frames": frames
+        } for item, frames in self._frame] + self._missed
+        self._frame = []
+
+
+class FaceTrackerRegistry:
+    """_summary_
+    Holds one FaceTracker per client session. Trackers that have not been used for ttl seconds are removed.
+    """
+
+    def __init__(self, ttl=60.0, **tracker_args):
+        self.ttl = ttl
+        self.tracker_args = tracker_args
+        self._trackers = {}
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        """_summary_
+        Returns the FaceTracker of a client session, creating it if necessary.
+        """
+        now = time.monotonic()
+        with self._lock:
+            for key in [key for key, (_, last_used) in self._trackers.items() if now - last_used > self.ttl]:
+                del self._trackers[key]
+            tracker = self._trackers.get(session_id, (None, now))[0]
+            if tracker is None:
+                tracker = FaceTracker(**self.tracker_args)
+            self._trackers[session_id] = (tracker, now)
+            return tracker
@@ -16,6 +16,18 @@ db = client.images
 app = Flask(__name__)
 app.secret_key = "b'W~\x9d\xe9\x13}2Ou\x1f\xdd\x9ct\x1d\xfc+'"
 
+# Frame deduplication. When enabled, /processimage reuses the result of a recent frame if the new frame is nearly
+# identical to it, which skips face detection, embedding and labelling for repeated webcam frames.
+app.config["FRAME_DEDUP_ENABLED"] = os.environ.get("FRAME_DEDUP_ENABLED", "False").lower() == "true"
+app.config["FRAME_DEDUP_MAX_DISTANCE"] = int(os.environ.get("FRAME_DEDUP_MAX_DISTANCE", 5))
+app.config["FRAME_DEDUP_MAX_AGE"] = float(os.environ.get("FRAME_DEDUP_MAX_AGE", 2.0))
+
+# Face tracking. When enabled, faces that stay in the same place across a client's frames keep their embedding and
+# labels and are only sent to the embedding and label servers every FACE_TRACKING_REFRESH_FRAMES frames.
+app.config["FACE_TRACKING_ENABLED"] = os.environ.get("FACE_TRACKING_ENABLED", "False").lower() == "true"
+app.config["FACE_TRACKING_MIN_IOU"] = float(os.environ.get("FACE_TRACKING_MIN_IOU", 0.5))
+app.config["FACE_TRACKING_REFRESH_FRAMES"] = int(os.environ.get("FACE_TRACKING_REFRESH_FRAMES", 15))
+
 # decorators
 
 
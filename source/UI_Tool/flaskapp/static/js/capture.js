@@ -4,6 +4,11 @@ const video = document.getElementById("video");
 let analyse = false;
 let face_data = [];
 let apiUrl = "/processimage";
+// When true, /processimage returns only the regions, labels and names of the faces and the boxes and labels are
+// drawn over the captured frame here, instead of the server drawing them and sending back the whole image.
+let clientOverlay = true;
+const overlayCanvas = document.getElementById("overlay_canvas");
+const overlayFont = "16px Arial";
 
 // define button constants. used later to enable/disable buttons.
 const method_1_btn = document.getElementById("method_1_btn");
@@ -90,6 +95,7 @@ function take_screenshot(method) {
     body: JSON.stringify({
       img: imageData,
       method: method,
+      overlay: clientOverlay,
     }),
   })
     .then((response) => response.json())
@@ -102,6 +108,50 @@ function take_screenshot(method) {
     });
 }
 
+/**
+ * Draws the captured frame with each face bordered and labelled "Face 1", "Face 2" etc. on the results canvas, in the
+ * same way as the label server's /draw_labels endpoint draws them.
+ */
+function drawOverlay(faces) {
+  overlayCanvas.width = canvas.width;
+  overlayCanvas.height = canvas.height;
+  const context = overlayCanvas.getContext("2d");
+  // The screenshot canvas still holds the frame that was sent, as the next frame is only taken after this response.
+  context.drawImage(canvas, 0, 0);
+  context.font = overlayFont;
+  context.textBaseline = "top";
+  faces.forEach((item, i) => {
+    const [x, y, w, h] = item.regions;
+    const text = "Face " + (i + 1);
+    context.strokeStyle = "rgb(255, 0, 0)";
+    context.lineWidth = 2;
+    context.strokeRect(x, y, w, h);
+    const metrics = context.measureText(text);
+    const textHeight = metrics.actualBoundingBoxAscent + metrics.actualBoundingBoxDescent;
+    context.fillStyle = "rgb(255, 255, 255)";
+    // Label above the face if there is enough space, otherwise below it.
+    if (y - textHeight > textHeight) {
+      context.fillText(text, x, y - 25);
+    } else if (y + h + textHeight > textHeight) {
+      context.fillText(text, x, y + h + textHeight / 2);
+    }
+  });
+  overlayCanvas.style.display = "block";
+  document.getElementById("image_1").style.display = "none";
+}
+
+/**
+ * Returns the region of a face cut out of the captured frame, as a data URL.
+ */
+function cropFace(regions) {
+  const [x, y, w, h] = regions;
+  const faceCanvas = document.createElement("canvas");
+  faceCanvas.width = w;
+  faceCanvas.height = h;
+  faceCanvas.getContext("2d").drawImage(canvas, x, y, w, h, 0, 0, w, h);
+  return faceCanvas.toDataURL("image/jpeg");
+}
+
 /**
  *
  * Receives image data and updates UI.
@@ -149,8 +199,13 @@ function updateUI(data) {
           html = html.concat("", listItem);
         });
 
-        document.getElementById(image_name).src =
-          "data:image/jpeg;base64," + image;
+        if (data.overlay === "True") {
+          document.getElementById(image_name).src = cropFace(item.regions);
+        } else {
+          // The face detection server encodes the faces as PNG.
+          document.getElementById(image_name).src =
+            "data:image/png;base64," + image;
+        }
         // console.log(html);
 
         document.getElementById("label_" + image_name).innerHTML = html;
@@ -159,8 +214,15 @@ function updateUI(data) {
       }
     }
     //update results image. This is the origional image with faces bordered.
-    document.getElementById("image_1").src =
-      "data:image/jpeg;base64," + data.image_url;
+    if (data.overlay === "True") {
+      drawOverlay(face_data);
+    } else {
+      overlayCanvas.style.display = "none";
+      document.getElementById("image_1").style.display = "block";
+      // The label server returns the image in its configured format (PNG, JPEG or WebP) and its mime type.
+      document.getElementById("image_1").src =
+        "data:" + (data.mime || "image/png") + ";base64," + data.image_url;
+    }
   }
 }
 
@@ -0,0 +1,104 @@
+import base64
+import threading
+import time
+from collections import OrderedDict, deque
+from io import BytesIO
+from PIL import Image
+
+
+def compute_frame_hash(image_data, hash_size=8):
+    """_summary_
+    Computes a difference hash (dHash) of a base64 encoded image. The image is reduced to a (hash_size+1) x hash_size
+    greyscale thumbnail and each bit of the hash records whether a pixel is brighter than its right hand neighbour.
+    Frames that look the same produce hashes that differ in only a few bits.
+
+    Args:
+        image_data (str): base64 encoded image, optionally prefixed with a data URL header
+                          ("data:image/png;base64,").
+        hash_size (int): Width and height of the hash in bits. The default produces a 64 bit hash.
+
+    Returns:
+        int: The hash of the image.
+    """
+    decoded_string = base64.b64decode(image_data.split(",", 1)[-1])
+    with Image.open(BytesIO(decoded_string)) as image:
+        thumbnail = image.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR)
+    pixels = list(thumbnail.getdata())
+    frame_hash = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            frame_hash = (frame_hash << 1) | (left > right)
+    return frame_hash
+
+
+class FrameDeduplicator:
+    """_summary_
+    Remembers the results of each client's recently processed frames so that a frame which is nearly identical to one
+    of the client's recent frames can reuse its result instead of running face detection, embedding and labelling
+    again. Results are never shared between clients, as they contain the client's images.
+
+    Each client has its own short history, so clients do not evict each other's frames, and a lookup only compares
+    the client's own frames. A client's history is dropped once its newest frame is older than max_age.
+    """
+
+    def __init__(self, max_distance=5, max_age=2.0, history=4):
+        """_summary_
+
+        Args:
+            max_distance (int): Maximum number of differing hash bits for two frames to count as the same frame.
+            max_age (float): Number of seconds a result can be reused for. Keeps the result from going stale when
+                             the scene changes slowly.
+            history (int): Number of recent frames to remember per client.
+        """
+        self.max_distance = max_distance
+        self.max_age = max_age
+        self.history = history
+        # client id: deque of (hash, mode, time, result), ordered from least to most recently stored.
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _evict_expired(self, now):
+        while self._clients:
+            client_id, frames = next(iter(self._clients.items()))
+            if frames and now - frames[-1][2] <= self.max_age:
+                break
+            del self._clients[client_id]
+
+    def lookup(self, frame_hash, client_id, mode):
+        """_summary_
+        Returns the result of a recent frame of the client processed in the same mode whose hash is within
+        max_distance bits of frame_hash, or None if there is no such frame.
+
+        Args:
+            frame_hash (int): Hash of the frame, from compute_frame_hash().
+            client_id (str): Id of the client that sent the frame.
+            mode (tuple): Anything else the result depends on, e.g. (labelling method, overlay).
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._evict_expired(now)
+            for stored_hash, stored_mode, stored_time, result in reversed(self._clients.get(client_id, ())):
+                if stored_mode != mode or now - stored_time > self.max_age:
+                    continue
+                if bin(stored_hash ^ frame_hash).count("1") <= self.max_distance:
+                    self.hits += 1
+                    return result
+            self.misses += 1
+            return None
+
+    def store(self, frame_hash, client_id, mode, result):
+        """_summary_
+        Remembers the result of a frame of the client processed in mode.
+        """
+        now = time.monotonic()
+        with self._lock:
+            frames = self._clients.pop(client_id, None)
+            if frames is None:
+                frames = deque(maxlen=self.history)
+            frames.append((frame_hash, mode, now, result))
+            self._clients[client_id] = frames
+            self._evict_expired(now)
@@ -3,6 +3,12 @@ from flaskapp.user.routes import *
 import requests
 import json
 import uuid
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.instrumentation import request_headers, stage  # noqa: E402
+from common.row_ids import reserve_row_ids  # noqa: E402
 
 
 def save_image(data):
@@ -23,23 +29,70 @@ def save_image(data):
     """
     collection = db.image_data
     try:
-        for item in data:
-            image = {
-                "_id": uuid.uuid4().hex,
-                "image_data": item.get("image"),
-                "embedding": item.get("embedding"),
-                "unverified_labels": item.get("labels"),
-                "verified_labels": "",
-                "incorrect_labels": "",
-                "requiresVerification": "True"
-            }
-            collection.insert_one(image)
+        with stage("mongo_insert"):
+            for item in data:
+                image = {
+                    "_id": uuid.uuid4().hex,
+                    "image_data": item.get("image"),
+                    "embedding": item.get("embedding"),
+                    "unverified_labels": item.get("labels"),
+                    "verified_labels": "",
+                    "incorrect_labels": "",
+                    "requiresVerification": "True"
+                }
+                collection.insert_one(image)
         return "Successfully saved image"
     except Exception as e:
         print(e)
         return "Error saving images to database."
 
 
+# Labelling API endpoint of each labelling method.
+LABEL_ENDPOINTS = {
+    "method_1": "http://127.0.0.1:5003/label_method_1",
+    "method_2": "http://127.0.0.1:5003/label_method_2",
+    "method_3": "http://127.0.0.1:5003/label_method_3",
+    "method_5": "http://127.0.0.1:5003/label_method_5",
+}
+
+
+def detect_faces(image_data):
+    """
+    Sends an image to the face detection server and returns a list of dictionaries containing information about each
+    face detected, in the same format as face_data in process_image. Returns an empty list if no face was detected.
+
+    Args:
+        image_data (str): base64 encoded image with a "data:image/png;base64," header.
+    """
+    with stage("detect"):
+        response = requests.post("http://127.0.0.1:5010/detect",
+                                 headers={"Content-Type": "application/json", **request_headers()},
+                                 json={"img": image_data})
+    if response.status_code != 200:
+        raise ValueError("Error with face detection request")
+
+    data = response.json()
+    if data.get("FaceDetected", "False") != "True":
+        return []
+
+    return [{
+        "image": face[0],
+        "regions": face[1],
+        "embedding": "",
+        "labels": [],
+        "name": ""
+    }
+        for face in data.get("faces")]
+
+
+def get_next_row_id():
+    """_summary_
+    Reserves the next row_id from the counters collection. The row_id is a compact integer given to each verified
+    image, which the label server uses as the image's id in its FAISS index.
+    """
+    return reserve_row_ids(db)
+
+
 def get_embeddings(face_data):
     """
     This function takes an array of dictionaries containing information about an image,
@@ -65,9 +118,10 @@ def get_embeddings(face_data):
                 }]
     """
     for item in face_data:
-        response = requests.post("http://127.0.0.1:5002/get_embedding",
-                                 headers={"Content-Type": "application/json"},
-                                 data=json.dumps({"img": item["image"]}))
+        with stage("embedding"):
+            response = requests.post("http://127.0.0.1:5002/get_embedding",
+                                     headers={"Content-Type": "application/json", **request_headers()},
+                                     data=json.dumps({"img": item["image"]}))
 
         if response.status_code == 200:
             data = response.json()
@@ -114,9 +168,10 @@ def get_labels(face_data, endpoint):
     """
     for item in face_data:
 
-        response = requests.post(endpoint,
-                                 headers={"Content-Type": "application/json"},
-                                 data=json.dumps({"embedding": item["embedding"]}))
+        with stage("labels"):
+            response = requests.post(endpoint,
+                                     headers={"Content-Type": "application/json", **request_headers()},
+                                     data=json.dumps({"embedding": item["embedding"]}))
 
         if response.status_code == 200:
             data = response.json()
@@ -134,18 +189,22 @@ def get_labels(face_data, endpoint):
 def label_image(face_data, imageData):
     """
     Takes in face_data and imageData as inputs and sends a request to "http://127.0.0.1:5003/draw_labels" endpoint.
-    Returns an image with each face in the image bordered and labelled. 
+    Returns an image with each face in the image bordered and labelled, its mime type (the label server encodes it as
+    DRAW_LABELS_FORMAT) and the face data.
 
     """
-    response = requests.post("http://127.0.0.1:5003/draw_labels",
-                             headers={"Content-Type": "application/json"},
-                             data=json.dumps({"face_data": face_data, 'img': imageData}))
+    with stage("draw_labels"):
+        response = requests.post("http://127.0.0.1:5003/draw_labels",
+                                 headers={"Content-Type": "application/json", **request_headers()},
+                                 data=json.dumps({"face_data": face_data, 'img': imageData}))
 
     if response.status_code == 200:
         data = response.json()
         if data.get("success") == "True":
             new_face_data = data.get("face_data")
             labelled_image = data.get("image_url")
+            # Label servers from before the format option always returned PNG, without a "mime".
+            mime = data.get("mime") or "image/png"
             # print(new_face_data)
             # for item in new_face_data:
             #     print(item["name"])
@@ -153,4 +212,16 @@ def label_image(face_data, imageData):
             raise ValueError("Error retrieving labels")
     else:
         raise ValueError("Error with request")
-    return labelled_image, new_face_data
+    return labelled_image, mime, new_face_data
+
+
+def overlay_face_data(face_data):
+    """
+    Names each face "face_1", "face_2" etc. in the same way as the "http://127.0.0.1:5003/draw_labels" endpoint and
+    returns only the name, regions and labels of each face. Used when the browser draws the face borders and labels
+    over the frame itself, so the frame does not need to be sent to the label server and back.
+
+    """
+    for count, item in enumerate(face_data, start=1):
+        item["name"] = "face_" + str(count)
+    return [{"name": item["name"], "regions": item["regions"], "labels": item["labels"]} for item in face_data]
@@ -1,8 +1,28 @@
-from flask import render_template, request, jsonify
+from flask import render_template, request, jsonify, session
 from flaskapp import app, login_required, admin_required, db
 from flaskapp.user.routes import *
 import requests
-from functions import get_embeddings, get_labels, label_image, save_image
+import uuid
+import os
+import tempfile
+from functions import (get_embeddings, get_labels, label_image, overlay_face_data, save_image, get_next_row_id,
+                       LABEL_ENDPOINTS)
+from frame_dedup import FrameDeduplicator, compute_frame_hash
+from face_tracker import FaceTrackerRegistry
+from stream_pipeline import StreamPipeline, iter_video_frames
+from common.instrumentation import instrument_app, request_headers, stage
+from common.profiling import install_profiling
+
+# Request timing, request ids and the /metrics endpoint. The request id is passed on to the detection, embedding and
+# label servers, so their timings of a /processimage request can be matched with the UI's.
+instrument_app(app, "ui")
+# Opt-in sampling and per-request profiling, enabled by setting PROFILE_TOKEN.
+install_profiling(app)
+
+frame_deduplicator = FrameDeduplicator(max_distance=app.config["FRAME_DEDUP_MAX_DISTANCE"],
+                                       max_age=app.config["FRAME_DEDUP_MAX_AGE"])
+face_trackers = FaceTrackerRegistry(min_iou=app.config["FACE_TRACKING_MIN_IOU"],
+                                    refresh_frames=app.config["FACE_TRACKING_REFRESH_FRAMES"])
 
 
 @app.route('/')
@@ -15,6 +35,14 @@ def render_home_page():
     return render_template('home.html')
 
 
+@app.route('/ready')
+def get_ready():
+    """_summary_
+    Readiness check. The UI tool has no models to load, so it is ready once it is accepting requests.
+    """
+    return jsonify({'ready': 'True'}), 200
+
+
 @app.route('/analyser/')
 def render_analyser_page():
     """_summary_
@@ -73,7 +101,8 @@ def update_labels():
     verified_labels = list(form.values())
     # print(verified_labels)
     # get list of unverified labels so we can update incorrect labels.
-    image_data = db.image_data.find_one({"_id": id})
+    with stage("mongo_lookup"):
+        image_data = db.image_data.find_one({"_id": id})
     unverified_labels = image_data['unverified_labels']
     # remove items in verified labels from unverified labels using a list comprehesion
     # https://www.geeksforgeeks.org/python-remove-all-values-from-a-list-present-in-other-list/
@@ -82,11 +111,17 @@ def update_labels():
 
     # print("All labels: " + str(unverified_labels))
     # print("incorrect labels: " + str(incorrect_labels))
+    # Verified images are given a row_id, which links the image to its entry in the label server's FAISS index.
+    row_id = image_data.get("row_id")
+    if row_id is None:
+        row_id = get_next_row_id()
     filter = {'_id': id}
     newvalues = {"$set": {"unverified_labels": "", "verified_labels": verified_labels,
-                          "incorrect_labels": incorrect_labels, "requiresVerification": "False", "UserAddedLabels": user_added_labels}}
+                          "incorrect_labels": incorrect_labels, "requiresVerification": "False", "UserAddedLabels": user_added_labels,
+                          "row_id": row_id}}
 
-    db.image_data.update_one(filter, newvalues)
+    with stage("mongo_update"):
+        db.image_data.update_one(filter, newvalues)
     # print(id)
     return render_verify_page()
 
@@ -115,6 +150,18 @@ def process_image():
     request and sends the image to the Face Detection server. If the face detection server detects faces, it then sends each 
     individual face image to the embedding API and the labelling API to label the image and returns the labels attached. If
     no face is detected, returns "No Face Detected" in response. 
+
+    Clients are identified by "session_id" in the request, or the Flask session.
+
+    If FRAME_DEDUP_ENABLED is set, a perceptual hash of the image is compared with the client's recently processed
+    frames and the previous result is returned if the image is nearly identical.
+
+    If FACE_TRACKING_ENABLED is set, faces are tracked across the frames sent by a client and only new, moved or due
+    for refresh faces are embedded and labelled.
+
+    If the request sets "overlay" to true, the labelled image is not drawn. Only the name, regions and labels of each
+    face are returned and the browser draws them over the frame it sent, which saves sending the frame to the label
+    server, drawing and re-encoding it, and returning it to the browser.
     """
     req = request.get_json()
     try:
@@ -122,10 +169,30 @@ def process_image():
             return jsonify({"success": 'false', 'msg': 'No image found in request'})
 
         image_data = req["img"]
+        if req.get("method") not in LABEL_ENDPOINTS:
+            return jsonify({'success': 'false', 'msg': 'Unknown labelling method.'})
+        overlay = str(req.get("overlay", "False")).lower() == "true"
+
+        client_id = None
+        if app.config["FRAME_DEDUP_ENABLED"] or app.config["FACE_TRACKING_ENABLED"]:
+            if "session_id" not in req and "tracker_id" not in session:
+                session["tracker_id"] = uuid.uuid4().hex
+            client_id = req.get("session_id", session.get("tracker_id"))
+        # Overlay and image results are not interchangeable, so they are deduplicated separately.
+        dedup_mode = (req.get("method"), overlay)
+
+        frame_hash = None
+        if app.config["FRAME_DEDUP_ENABLED"]:
+            frame_hash = compute_frame_hash(image_data)
+            previous_result = frame_deduplicator.lookup(frame_hash, client_id, dedup_mode)
+            if previous_result is not None:
+                return jsonify(previous_result)
+
         endpoint = "http://127.0.0.1:5010/detect"
-        headers = {"Content-Type": "application/json"}
-        response = requests.post(endpoint, headers=headers,
-                                 json={"img": image_data})
+        headers = {"Content-Type": "application/json", **request_headers()}
+        with stage("detect"):
+            response = requests.post(endpoint, headers=headers,
+                                     json={"img": image_data})
 
         if response.status_code != 200:
             return jsonify({"success": "false", 'msg': 'There was an error processing the image'})
@@ -137,7 +204,10 @@ def process_image():
         # If value of "FaceDeteced" != True, it returns an error message.
         if data.get("FaceDetected", "False") != "True":
             # print("No faces detected")
-            return jsonify({'success': 'True', 'FaceDetected': 'False'})
+            result = {'success': 'True', 'FaceDetected': 'False'}
+            if frame_hash is not None:
+                frame_deduplicator.store(frame_hash, client_id, dedup_mode, result)
+            return jsonify(result)
 
         # If faces were detected, get faces from response object.
         # print("Faces detected")
@@ -155,34 +225,87 @@ def process_image():
 
         # Get labelling method
         method = req["method"]
-        if method == "method_1":
-            label_endpoint = "http://127.0.0.1:5003/label_method_1"
-            print("method 1")
-        elif method == "method_2":
-            label_endpoint = "http://127.0.0.1:5003/label_method_2"
-            print("method 2")
-        elif method == "method_3":
-            label_endpoint = "http://127.0.0.1:5003/label_method_3"
-            print("method 3")
-
-        face_data = get_embeddings(face_data)
-        # print("embedding retrieved")
-        face_data = get_labels(face_data, label_endpoint)
-        # print("labels retrieved")
-        labelled_image, complete_face_data = label_image(face_data, image_data)
-        save_image(face_data)
+        label_endpoint = LABEL_ENDPOINTS[method]
+
+        if app.config["FACE_TRACKING_ENABLED"]:
+            tracker = face_trackers.get(client_id)
+            with tracker.lock:
+                # Only faces that are not being tracked need to be embedded, labelled and saved.
+                pending_face_data = tracker.match(face_data, method)
+                get_embeddings(pending_face_data)
+                get_labels(pending_face_data, label_endpoint)
+                tracker.commit()
+        else:
+            face_data = get_embeddings(face_data)
+            # print("embedding retrieved")
+            face_data = get_labels(face_data, label_endpoint)
+            # print("labels retrieved")
+            pending_face_data = face_data
+
+        if overlay:
+            complete_face_data = overlay_face_data(face_data)
+        else:
+            labelled_image, labelled_image_mime, complete_face_data = label_image(face_data, image_data)
+        save_image(pending_face_data)
 
         # print(complete_face_data)
-        return jsonify({
+        result = {
             "success": 'True',
             'FaceDetected': 'True',
-            'image_url': labelled_image,
             'face_data': complete_face_data
-        })
+        }
+        if overlay:
+            result['overlay'] = 'True'
+        else:
+            result['image_url'] = labelled_image
+            result['mime'] = labelled_image_mime
+        if frame_hash is not None:
+            frame_deduplicator.store(frame_hash, client_id, dedup_mode, result)
+        return jsonify(result)
     except (KeyError, ValueError) as e:
         print(e)
         return jsonify({'success': 'false', 'msg': 'There was an error processing the image.'})
 
 
+@app.route('/processvideo', methods=["POST"])
+def process_video():
+    """_summary_
+    This function is called when a POST request is made to the /processvideo endpoint. The request body is a video file,
+    which can be sent with chunked transfer encoding. The video is written to a temporary file as it is received, then
+    frames are sampled at "fps" frames per second and pushed through face detection, embedding and labelling.
+
+    Query parameters:
+        method: labelling method, method_1 (default), method_2, method_3 or method_5.
+        fps: number of frames per second to sample. Defaults to 2.
+
+    Returns the regions and labels of the faces in each processed frame, and the stream statistics.
+    """
+    method = request.args.get("method", "method_1")
+    try:
+        fps = float(request.args.get("fps", 2))
+    except ValueError:
+        fps = 0
+    if not fps > 0:
+        return jsonify({'success': 'false', 'msg': 'fps must be a number greater than 0.'})
+    video_file = tempfile.NamedTemporaryFile(suffix=".video", delete=False)
+    try:
+        with video_file:
+            while True:
+                chunk = request.stream.read(1024 * 1024)
+                if not chunk:
+                    break
+                video_file.write(chunk)
+
+        # Every frame of an uploaded file is processed: reading the file waits for the stages instead of dropping.
+        pipeline = StreamPipeline(method, drop_oldest=False)
+        stats = pipeline.run(iter_video_frames(video_file.name, fps))
+        return jsonify({"success": "True", "results": pipeline.results, "stats": stats})
+    except (KeyError, ValueError) as e:
+        print(e)
+        return jsonify({'success': 'false', 'msg': 'There was an error processing the video.'})
+    finally:
+        os.remove(video_file.name)
+
+
 if __name__ == "__main__":
     app.run(debug=True, port=5000)
@@ -0,0 +1,243 @@
+import base64
+import os
+import threading
+import time
+from collections import deque
+import cv2
+from functions import detect_faces, get_embeddings, get_labels, LABEL_ENDPOINTS
+
+# Marks the end of the stream. Passed through every stage so that each stage knows when to stop.
+_END_OF_STREAM = object()
+# Maximum number of seconds run() waits for the stages to finish the queued frames once the last frame is read, so a
+# stage stuck on a request to another service cannot hang the request that is running the pipeline.
+STREAM_DRAIN_TIMEOUT = float(os.environ.get("STREAM_DRAIN_TIMEOUT", "60"))
+
+
+class FrameQueue:
+    """_summary_
+    Bounded queue placed between two pipeline stages. For a live source (a camera), putting a new item when the queue
+    is full drops the oldest item, so a slow stage always works on the most recent frames instead of falling further
+    behind the camera. For a finite source (a video file) every frame should be processed, so putting an item waits
+    for space instead, which slows reading the file down to the speed of the slowest stage.
+    """
+
+    def __init__(self, maxsize, drop_oldest=True):
+        """_summary_
+
+        Args:
+            maxsize (int): Capacity of the queue.
+            drop_oldest (bool): Drop the oldest item when the queue is full, instead of waiting for space.
+        """
+        self.maxsize = maxsize
+        self.drop_oldest = drop_oldest
+        self.dropped = 0
+        self.closed = False
+        self._items = deque()
+        self._condition = threading.Condition()
+
+    def put(self, item, timeout=None):
+        """_summary_
+        Adds an item to the queue. Without drop_oldest, waits up to timeout seconds (forever if None) for space.
+
+        Returns:
+            bool: False if the item was not added because the queue is closed or there was no space in time.
+        """
+        with self._condition:
+            if not self.drop_oldest:
+                self._condition.wait_for(lambda: len(self._items) < self.maxsize or self.closed, timeout)
+                if len(self._items) >= self.maxsize:
+                    return False
+            if self.closed:
+                return False
+            if len(self._items) >= self.maxsize:
+                self._items.popleft()
+                self.dropped += 1
+            self._items.append(item)
+            self._condition.notify_all()
+            return True
+
+    def get(self):
+        """_summary_
+        Returns the oldest item, waiting for one if the queue is empty. Returns _END_OF_STREAM once the queue is
+        closed.
+        """
+        with self._condition:
+            while not self._items and not self.closed:
+                self._condition.wait()
+            if self.closed:
+                return _END_OF_STREAM
+            item = self._items.popleft()
+            self._condition.notify_all()
+            return item
+
+    def close(self):
+        """_summary_
+        Discards the queued items and wakes every thread waiting to put or get, so that the stages stop.
+        """
+        with self._condition:
+            self.closed = True
+            self._items.clear()
+            self._condition.notify_all()
+
+
+def iter_video_frames(source, sample_fps=5.0):
+    """_summary_
+    Decodes a video file or camera with OpenCV and yields frames sampled at sample_fps frames per second.
+
+    Args:
+        source (str or int): Path of a video file, or the index of a camera.
+        sample_fps (float): Number of frames per second to yield. Frames in between are skipped without being
+                            converted.
+
+    Yields:
+        tuple: (frame number, timestamp in seconds, BGR image as a numpy array)
+    """
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        raise ValueError("Unable to open video source " + str(source))
+    is_camera = isinstance(source, int)
+    video_fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+    interval = 1.0 / sample_fps
+    start = time.monotonic()
+    next_sample = 0.0
+    frame_number = 0
+    try:
+        while capture.grab():
+            timestamp = time.monotonic() - start if is_camera else frame_number / video_fps
+            frame_number += 1
+            # The small tolerance stops rounding errors from skipping frames that fall exactly on the schedule.
+            if timestamp + 1e-6 < next_sample:
+                continue
+            next_sample += interval
+            # If the source has fallen behind the schedule (a slow camera), restart the schedule from this frame.
+            if next_sample < timestamp:
+                next_sample = timestamp + interval
+            ok, frame = capture.retrieve()
+            if ok:
+                yield frame_number - 1, timestamp, frame
+    finally:
+        capture.release()
+
+
+def encode_frame(frame):
+    """_summary_
+    Encodes a BGR frame as a base64 PNG data URL, the format sent to /detect by the UI.
+    """
+    _, buffer = cv2.imencode(".png", frame, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+    return "data:image/png;base64," + base64.b64encode(buffer).decode("ascii")
+
+
+class StreamPipeline:
+    """_summary_
+    Pushes video frames through face detection, embedding and labelling. Each stage runs in its own thread and the
+    stages are connected by FrameQueues, so the stages work on different frames at the same time. With a live source
+    a slow stage drops old frames instead of building up a backlog, with a video file every frame is processed.
+    """
+
+    def __init__(self, method="method_1", queue_size=4, on_result=None, drop_oldest=True):
+        """_summary_
+
+        Args:
+            method (str): Labelling method, one of the keys of LABEL_ENDPOINTS.
+            queue_size (int): Capacity of the queue in front of each stage.
+            on_result (function): Called with the result of each processed frame. By default results are collected
+                                  in self.results.
+            drop_oldest (bool): True for a live source, where a slow stage should drop old frames. False for a video
+                                file, where reading waits for the stages so that no frame is dropped.
+        """
+        self.label_endpoint = LABEL_ENDPOINTS[method]
+        self.queues = [FrameQueue(queue_size, drop_oldest) for _ in range(3)]
+        self.results = []
+        self.on_result = on_result or self.results.append
+        self.frames_sampled = 0
+        self.frames_processed = 0
+        # Set when run() stops waiting for the stages. Frames finished after that are not recorded, so self.results
+        # does not change once run() has returned.
+        self._stopped = False
+        self._results_lock = threading.Lock()
+
+    def _detect(self, frame):
+        return detect_faces(encode_frame(frame["image"]))
+
+    def _embed(self, frame):
+        return get_embeddings(frame["faces"])
+
+    def _label(self, frame):
+        return get_labels(frame["faces"], self.label_endpoint)
+
+    def _run_stage(self, work, in_queue, out_queue):
+        while True:
+            frame = in_queue.get()
+            if frame is _END_OF_STREAM:
+                if out_queue is not None:
+                    out_queue.put(_END_OF_STREAM)
+                return
+            try:
+                # Frames without faces skip the embedding and labelling stages. faces is None before detection.
+                if frame["faces"] is None or frame["faces"]:
+                    frame["faces"] = work(frame)
+            except Exception as e:
+                # Any error (a connection error, timeout or bad response from a service) only drops this frame, so
+                # the stage keeps running and passes _END_OF_STREAM on.
+                print(e)
+                continue
+            if out_queue is not None:
+                out_queue.put(frame)
+            else:
+                self._finish(frame)
+
+    def _finish(self, frame):
+        with self._results_lock:
+            if self._stopped:
+                return
+            self.frames_processed += 1
+            self.on_result({
+                "frame": frame["frame"],
+                "timestamp": frame["timestamp"],
+                "faces": [{"regions": face["regions"], "labels": face["labels"]} for face in frame["faces"]]
+            })
+
+    def run(self, frames):
+        """_summary_
+        Processes every frame yielded by frames (for example iter_video_frames()) and returns the stream statistics.
+
+        If the stages have not finished the queued frames STREAM_DRAIN_TIMEOUT seconds after the last frame is read,
+        the pipeline is stopped and drain_timed_out is True in the statistics. The frames still in the stages are not
+        recorded.
+
+        Returns:
+            dict: frames sampled, processed and dropped, whether the drain timed out, elapsed seconds and the
+                  sustained frames per second.
+        """
+        stages = [self._detect, self._embed, self._label]
+        threads = [threading.Thread(target=self._run_stage,
+                                    args=(work, self.queues[i], self.queues[i + 1] if i + 1 < len(stages) else None),
+                                    daemon=True)
+                   for i, work in enumerate(stages)]
+        start = time.monotonic()
+        for thread in threads:
+            thread.start()
+        try:
+            for frame_number, timestamp, image in frames:
+                self.frames_sampled += 1
+                self.queues[0].put({"frame": frame_number, "timestamp": timestamp, "image": image, "faces": None})
+        finally:
+            # Also stops the stages if reading the frames raises.
+            deadline = time.monotonic() + STREAM_DRAIN_TIMEOUT
+            self.queues[0].put(_END_OF_STREAM, STREAM_DRAIN_TIMEOUT)
+            for thread in threads:
+                thread.join(max(deadline - time.monotonic(), 0))
+            drain_timed_out = any(thread.is_alive() for thread in threads)
+            with self._results_lock:
+                self._stopped = True
+            for queue in self.queues:
+                queue.close()
+        elapsed = time.monotonic() - start
+        return {
+            "frames_sampled": self.frames_sampled,
+            "frames_processed": self.frames_processed,
+            "frames_dropped": sum(queue.dropped for queue in self.queues),
+            "drain_timed_out": drain_timed_out,
+            "elapsed_seconds": elapsed,
+            "fps": self.frames_processed / elapsed if elapsed > 0 else 0.0
+        }
@@ -0,0 +1,36 @@
+"""
+Labels the faces in a local video file or camera feed by pushing sampled frames through the face detection,
+embedding and label servers, and reports the sustained frames per second.
+
+Usage:
+    python stream_video.py video.mp4 --fps 5 --method method_1
+    python stream_video.py 0 --fps 2            (camera 0)
+"""
+import argparse
+import json
+from stream_pipeline import StreamPipeline, iter_video_frames
+
+
+def print_result(result):
+    labels = [face["labels"] for face in result["faces"]]
+    print(f"frame {result['frame']} ({result['timestamp']:.2f}s): {labels}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("source", help="Path of a video file, or the index of a camera.")
+    parser.add_argument("--fps", type=float, default=5.0, help="Number of frames per second to sample.")
+    parser.add_argument("--method", default="method_1", help="Labelling method: method_1, method_2 or method_3.")
+    parser.add_argument("--queue-size", type=int, default=4, help="Capacity of the queue in front of each stage.")
+    args = parser.parse_args()
+
+    source = int(args.source) if args.source.isdigit() else args.source
+    # Only a camera drops frames when the pipeline falls behind. Every frame sampled from a file is processed.
+    pipeline = StreamPipeline(args.method, queue_size=args.queue_size, on_result=print_result,
+                              drop_oldest=isinstance(source, int))
+    stats = pipeline.run(iter_video_frames(source, args.fps))
+    print(json.dumps(stats, indent=2))
+
+
+if __name__ == "__main__":
+    main()
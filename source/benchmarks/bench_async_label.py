@@ -0,0 +1,74 @@
+"""
+Compares the latency of the Flask label server (gunicorn threaded workers) with the asynchronous label server
+(async_app.py on uvicorn workers) as the number of concurrent clients increases. Both are started with serve.py and
+loaded by asyncio clients, so the client can hold thousands of connections open.
+
+The label cache is disabled in the servers (CACHE_ENABLED=0) unless --cache is given, and every concurrency level is
+sent its own set of embeddings, so the results measure labelling rather than cache lookups.
+
+Usage:
+    python benchmarks/bench_async_label.py --concurrency 16 64 256 1024 --requests 2000
+    python benchmarks/bench_async_label.py --method method_2 --workers 2 --threads 8
+"""
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import numpy as np
+import requests
+from load import run_async_load
+from load_test_workers import wait_until_ready
+from sample_data import SOURCE_DIR, load_sample_embeddings
+
+sys.path.insert(0, SOURCE_DIR)
+from serve import SERVICES  # noqa: E402
+
+
+def make_payloads(embeddings, count, seed):
+    """_summary_
+    Returns count request payloads, each a sample embedding plus its own random noise, so that no two requests (in
+    this or another concurrency level) have the same embedding.
+    """
+    rng = np.random.default_rng(seed)
+    payloads = []
+    for i in range(count):
+        emb = embeddings[i % len(embeddings)]
+        payloads.append({"embedding": (emb + rng.normal(scale=emb.std() / 4, size=emb.shape)).reshape(1, -1).tolist()})
+    return payloads
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[16, 64, 256, 1024])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--method", default="method_1")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=8, help="Request threads per Flask worker.")
+    parser.add_argument("--cache", action="store_true", help="Leave the label cache enabled in the servers.")
+    args = parser.parse_args()
+
+    embeddings = load_sample_embeddings("Celeb_A")
+    payload_sets = {concurrency: make_payloads(embeddings, max(args.requests, concurrency), seed)
+                    for seed, concurrency in enumerate(args.concurrency)}
+    env = dict(os.environ, CACHE_ENABLED="1" if args.cache else "0")
+    for service in ("label", "label_async"):
+        base_url = f"http://127.0.0.1:{SERVICES[service][3]}"
+        process = subprocess.Popen([sys.executable, os.path.join(SOURCE_DIR, "serve.py"), service,
+                                    "--workers", str(args.workers), "--threads", str(args.threads)], env=env)
+        try:
+            wait_until_ready(base_url)
+            for concurrency in args.concurrency:
+                stats = run_async_load(f"{base_url}/label_{args.method}", payload_sets[concurrency], concurrency,
+                                       max(args.requests, concurrency))
+                # Cumulative hits of the worker that answers; stays 0 unless --cache is given.
+                stats["cache_hits"] = requests.get(f"{base_url}/cache_stats").json()["hits"]
+                print(json.dumps(dict(service=service, **stats)))
+        finally:
+            process.send_signal(signal.SIGTERM)
+            process.wait()
+
+
+if __name__ == "__main__":
+    main()
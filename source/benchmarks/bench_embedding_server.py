@@ -0,0 +1,45 @@
+"""
+Measures images/sec of the /get_embedding endpoint at increasing concurrency. Run it once against an embedding
+server started with DECODE_WORKERS=0 (decode on the request thread) and once with the default decode worker pool to
+see the effect of moving decode and preprocessing off the request thread.
+
+Usage: python benchmarks/bench_embedding_server.py [--url http://127.0.0.1:5002/get_embedding] [--requests 200]
+"""
+import argparse
+import base64
+import json
+from io import BytesIO
+import numpy as np
+from PIL import Image
+from load import run_load
+
+
+def synthetic_faces(count=16, size=(240, 240), seed=0):
+    """_summary_
+    Returns base64 encoded PNG images of random noise, the same encoding the face detection server uses for faces.
+    """
+    rng = np.random.default_rng(seed)
+    images = []
+    for _ in range(count):
+        pixels = rng.integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+        buffer = BytesIO()
+        Image.fromarray(pixels).save(buffer, format="PNG")
+        images.append(base64.b64encode(buffer.getvalue()).decode("ascii"))
+    return images
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://127.0.0.1:5002/get_embedding")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    args = parser.parse_args()
+
+    payloads = [{"img": image} for image in synthetic_faces()]
+    for concurrency in args.concurrency:
+        stats = run_load(args.url, payloads, concurrency, args.requests)
+        print(json.dumps({"images_per_second": stats["requests_per_second"], **stats}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Measures the hit rate of the label server's result cache (label_server/result_cache.py) on consecutive webcam frames,
+at several similarity thresholds.
+
+The frames are replayed through a ResultCache in process, in order, as cached_labels() in app.py uses it: each frame
+is looked up, and stored on a miss. The hit rate and near duplicate hits are read from the cache's stats(), the same
+numbers the label server reports at /cache_stats.
+
+--frames is a directory of .npy clip embeddings of consecutive frames, in file name order, for example embeddings of
+the faces of a recorded webcam session from the embedding server's /get_embedding. Without --frames, sequences are
+simulated from the sample embeddings: each face is shown for --frames-per-face frames, each frame being the face's
+embedding plus gaussian noise of --jitter times its norm.
+
+The false share rate is the fraction of distinct sample faces whose most similar other sample face is within the
+threshold, i.e. that could be given another face's cached result.
+
+Usage:
+    python benchmarks/bench_label_cache.py
+    python benchmarks/bench_label_cache.py --frames ../recorded_frames --thresholds 0.95 0.97 0.99
+"""
+import argparse
+import os
+import sys
+import numpy as np
+from report import finish, report_meta
+from sample_data import load_sample_embeddings
+from result_cache import ResultCache
+
+
+def load_frames(directory):
+    files = sorted(f for f in os.listdir(directory) if f.endswith(".npy"))
+    return np.concatenate([np.load(os.path.join(directory, f)).reshape(1, -1) for f in files]).astype(np.float32)
+
+
+def simulate_frames(faces, frames_per_face, jitter, seed=0):
+    """_summary_
+    Returns frames_per_face noisy copies of each face, face after face.
+    """
+    rng = np.random.default_rng(seed)
+    frames = np.repeat(faces, frames_per_face, axis=0)
+    scales = np.linalg.norm(frames, axis=1, keepdims=True) * jitter / np.sqrt(frames.shape[1])
+    return (frames + rng.standard_normal(frames.shape, dtype=np.float32) * scales).astype(np.float32)
+
+
+def replay(frames, min_similarity, ttl):
+    """_summary_
+    Replays frames through a new cache and returns its stats.
+    """
+    cache = ResultCache(ttl=ttl, min_similarity=min_similarity)
+    for frame in frames:
+        key = cache.make_key("method_1", frame, 0)
+        if cache.get(key) is None:
+            cache.put(key, ("success", []), 0.0)
+    return cache.stats()
+
+
+def false_share_rate(faces, min_similarity):
+    normalised = faces / np.linalg.norm(faces, axis=1, keepdims=True)
+    similarity = normalised @ normalised.T
+    np.fill_diagonal(similarity, -1.0)
+    return float((similarity.max(axis=1) >= min_similarity).mean())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", help="Directory of .npy embeddings of consecutive frames.")
+    parser.add_argument("--faces", type=int, default=200, help="Sample faces to simulate frames from.")
+    parser.add_argument("--frames-per-face", type=int, default=30)
+    parser.add_argument("--jitter", type=float, default=0.1, help="Noise of simulated frames, relative to the norm.")
+    parser.add_argument("--thresholds", type=float, nargs="+", default=[1.0, 0.99, 0.97, 0.95])
+    parser.add_argument("--ttl", type=float, default=1e9, help="Cache time to live. Frames are replayed instantly.")
+    parser.add_argument("--output", help="Report path. Defaults to benchmarks/reports/label_cache_<timestamp>.json.")
+    args = parser.parse_args()
+
+    faces = load_sample_embeddings("FairFace", args.faces)
+    frames = load_frames(args.frames) if args.frames else simulate_frames(faces, args.frames_per_face, args.jitter)
+    results = []
+    for threshold in args.thresholds:
+        # A threshold of 1.0 only shares results between identical embeddings.
+        result = dict(name="label_cache_" + str(threshold), frames=len(frames),
+                      false_share_rate=false_share_rate(faces, threshold),
+                      **replay(frames, threshold - 1e-6 if threshold >= 1.0 else threshold, args.ttl))
+        print(result)
+        results.append(result)
+
+    meta = report_meta("label_cache", frames=args.frames or "simulated", faces=args.faces,
+                       frames_per_face=args.frames_per_face, jitter=args.jitter)
+    sys.exit(finish(meta, results, args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Compares the per-call latency of label_method_2 with the original implementation, which builds a list of incorrect
+labels from the neighbours and calls method_2_get_age_label, method_2_get_gender_label and method_2_get_race_label.
+
+Usage: python benchmarks/bench_label_method_2.py [--calls 500] [--neighbours 3]
+"""
+import argparse
+import time
+import numpy as np
+from sample_data import load_sample_embeddings, install_verified_set
+import label
+
+
+def label_method_2_reference(emb, neighbours):
+    """_summary_
+    The original method 2 engine, with neighbours resolved through the verified_images lookup.
+    """
+    incorrect_labels = []
+    snapshot = label.verified_images
+    _, I = snapshot.index.search(emb, neighbours)
+    for row_id in I[0]:
+        if row_id >= 0:
+            incorrect_labels += snapshot.lookup[row_id]['incorrect_labels']
+    incorrect_labels = list(set(incorrect_labels))
+    age = label.method_2_get_age_label(emb, incorrect_labels)
+    gender = label.method_2_get_gender_label(emb, incorrect_labels)
+    race = label.method_2_get_race_label(emb, incorrect_labels)
+    return [age, gender, race]
+
+
+def time_calls(fn, queries):
+    timings = []
+    results = []
+    for emb in queries:
+        start = time.perf_counter()
+        results.append(fn(emb))
+        timings.append(time.perf_counter() - start)
+    return np.array(timings) * 1000, results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=500)
+    parser.add_argument("--neighbours", type=int, default=label.METHOD_2_NEIGHBOURS)
+    args = parser.parse_args()
+
+    verified = load_sample_embeddings("FairFace")
+    install_verified_set(label, verified)
+    queries = load_sample_embeddings("Celeb_A")
+    queries = [queries[[i % len(queries)]] for i in range(args.calls)]
+
+    reference_ms, reference_labels = time_calls(
+        lambda emb: label_method_2_reference(emb, args.neighbours), queries)
+    vectorised_ms, vectorised_labels = time_calls(
+        lambda emb: label.label_method_2(emb, args.neighbours)[1], queries)
+
+    mismatches = sum(a != b for a, b in zip(reference_labels, vectorised_labels))
+    print(f"verified images: {len(verified)}, calls: {args.calls}, neighbours: {args.neighbours}")
+    for name, ms in (("reference", reference_ms), ("vectorised", vectorised_ms)):
+        print(f"{name:>10}: mean {ms.mean():.3f} ms  p50 {np.percentile(ms, 50):.3f} ms  "
+              f"p99 {np.percentile(ms, 99):.3f} ms")
+    print(f"speed up: {reference_ms.mean() / vectorised_ms.mean():.1f}x, label mismatches: {mismatches}")
+
+
+if __name__ == "__main__":
+    main()
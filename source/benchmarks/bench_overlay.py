@@ -0,0 +1,147 @@
+"""
+Measures what drawing the face borders and labels in the browser ("overlay" mode) saves per frame, compared with the
+label server drawing them on the frame and the whole labelled image being sent back to the browser.
+
+Each frame is sent to the label server's /draw_labels endpoint in every output format (png, jpeg, webp and overlay),
+recording the latency and the bytes sent and received per frame. In the image formats the labelled image is also
+returned to the browser by /processimage, so its size is recorded too. In overlay mode /processimage does not call
+/draw_labels at all, so a "saving_<format>" result records what overlay mode saves per frame compared with each image
+format:
+    label_server_bytes_saved        bytes no longer sent to and received from /draw_labels
+    browser_bytes_saved             bytes of labelled image no longer returned to the browser
+    mean_ms_saved / p50_ms_saved    latency of the /draw_labels call no longer made
+
+With --processimage the frames are also sent to the UI's /processimage with and without "overlay", which measures the
+whole request as the browser sees it. The face detector finds no faces in synthetic noise frames, so --processimage
+needs --images with photos of faces. Noise frames also compress far worse than photos, so use --images for
+representative image sizes.
+
+Sizes are of the JSON bodies. Results are written to a JSON report (see report.py).
+
+Usage:
+    python benchmarks/bench_overlay.py
+    python benchmarks/bench_overlay.py --images ~/photos --processimage --calls 100
+"""
+import argparse
+import json
+import sys
+import time
+import requests
+from load import summarise
+from report import finish, report_meta
+from run_suite import DATA_URL_PREFIX, load_images, succeeded
+from bench_embedding_server import synthetic_faces
+
+FORMATS = ["png", "jpeg", "webp", "overlay"]
+# Face regions drawn on every frame by /draw_labels, as [x, y, w, h].
+FACE_REGIONS = [[40 + 150 * i, 120, 120, 120] for i in range(3)]
+
+
+def time_requests(url, payloads, calls, warmup=2):
+    """_summary_
+    Sends calls JSON POST requests to url one at a time, cycling through payloads, and returns the latency
+    percentiles and the mean bytes sent, received and of the returned "image_url" per request.
+    """
+    session = requests.Session()
+    bodies = [json.dumps(payload) for payload in payloads]
+    for i in range(warmup):
+        session.post(url, data=bodies[i % len(bodies)], headers={"Content-Type": "application/json"})
+
+    latencies = []
+    request_bytes = response_bytes = image_bytes = errors = 0
+    start = time.perf_counter()
+    for i in range(calls):
+        body = bodies[i % len(bodies)]
+        call_start = time.perf_counter()
+        response = session.post(url, data=body, headers={"Content-Type": "application/json"})
+        latency = time.perf_counter() - call_start
+        if response.status_code != 200 or not succeeded(response):
+            errors += 1
+            continue
+        latencies.append(latency)
+        request_bytes += len(body)
+        response_bytes += len(response.content)
+        image_bytes += len(response.json().get("image_url") or "")
+    stats = summarise(latencies, time.perf_counter() - start, errors)
+    count = max(len(latencies), 1)
+    stats.update(request_bytes=request_bytes / count, response_bytes=response_bytes / count,
+                 image_bytes=image_bytes / count)
+    return stats
+
+
+def saving(name, result):
+    """_summary_
+    Returns what overlay mode saves per frame by not calling /draw_labels, given the result of an image format.
+    """
+    return {
+        "name": name,
+        "label_server_bytes_saved": result["request_bytes"] + result["response_bytes"],
+        "browser_bytes_saved": result["image_bytes"],
+        "mean_ms_saved": result["mean_ms"],
+        "p50_ms_saved": result["p50_ms"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--label-url", default="http://127.0.0.1:5003/draw_labels")
+    parser.add_argument("--ui-url", default="http://127.0.0.1:5000/processimage")
+    parser.add_argument("--images", help="Directory of photos to use instead of synthetic frames.")
+    parser.add_argument("--size", type=int, nargs=2, default=[640, 480], help="Frame width and height.")
+    parser.add_argument("--quality", type=int, help="JPEG and WebP quality. Defaults to the label server's.")
+    parser.add_argument("--calls", type=int, default=50, help="Requests per format.")
+    parser.add_argument("--processimage", action="store_true", help="Also compare the modes of /processimage.")
+    parser.add_argument("--method", default="method_1", help="Labelling method used by --processimage.")
+    parser.add_argument("--output", help="Report path. Defaults to benchmarks/reports/overlay_<timestamp>.json.")
+    parser.add_argument("--baseline", help="Report to compare the results with.")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+
+    size = tuple(args.size)
+    frames = load_images(args.images, size) if args.images else synthetic_faces(4, size)
+    frames = [DATA_URL_PREFIX + frame for frame in frames]
+
+    results = []
+    by_format = {}
+    for output_format in FORMATS:
+        payloads = []
+        for frame in frames:
+            payload = {"face_data": [{"labels": ["20-29", "Female", "White"], "regions": regions}
+                                     for regions in FACE_REGIONS], "format": output_format}
+            if output_format != "overlay":
+                # Overlay mode does not need the frame, so the UI does not send it.
+                payload["img"] = frame
+            if args.quality:
+                payload["quality"] = args.quality
+            payloads.append(payload)
+        by_format[output_format] = dict(name="draw_labels_" + output_format,
+                                        **time_requests(args.label_url, payloads, args.calls))
+        results.append(by_format[output_format])
+        print(by_format[output_format])
+    for output_format in FORMATS[:-1]:
+        results.append(saving("saving_" + output_format, by_format[output_format]))
+        print(results[-1])
+
+    if args.processimage:
+        by_mode = {}
+        for overlay in (False, True):
+            payloads = [{"img": frame, "method": args.method, "overlay": overlay} for frame in frames]
+            by_mode[overlay] = dict(name="processimage_" + ("overlay" if overlay else "image"),
+                                    **time_requests(args.ui_url, payloads, args.calls))
+            results.append(by_mode[overlay])
+            print(by_mode[overlay])
+        results.append({
+            "name": "saving_processimage",
+            "browser_bytes_saved": by_mode[False]["response_bytes"] - by_mode[True]["response_bytes"],
+            "mean_ms_saved": by_mode[False]["mean_ms"] - by_mode[True]["mean_ms"],
+            "p50_ms_saved": by_mode[False]["p50_ms"] - by_mode[True]["p50_ms"],
+        })
+        print(results[-1])
+
+    meta = report_meta("overlay", images=args.images or "synthetic", size=args.size, quality=args.quality,
+                       calls=args.calls, processimage=args.processimage)
+    sys.exit(finish(meta, results, args.output, args.baseline, args.tolerance))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Measures how the verified image index scales: index build time, memory and per-query latency of methods 2 and 3 at
+increasing numbers of verified images. The images come from a store written by
+label_server/generate_verified_images.py, or, with --mongo, from the local MongoDB through build_verified_images().
+Results are written to a JSON report (see report.py).
+
+Method 3 searches every verified image for every query, so it is only timed up to --method-3-max-size images.
+
+Usage:
+    python label_server/generate_verified_images.py --count 1000000 --store /data/synthetic.store
+    python benchmarks/bench_scale.py --store /data/synthetic.store --sizes 10000 100000 1000000
+    python benchmarks/bench_scale.py --mongo
+"""
+import argparse
+import resource
+import sys
+import time
+from load import summarise
+from report import finish, report_meta
+from sample_data import load_sample_embeddings
+import label
+from generate_verified_images import load_verified_store
+
+
+def rss_mb():
+    """_summary_
+    Returns the resident memory of the process in MB, or the peak resident memory where /proc is not available.
+    """
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def time_queries(method, queries, calls):
+    latencies = []
+    start = time.perf_counter()
+    for i in range(calls):
+        call_start = time.perf_counter()
+        method(queries[i % len(queries)])
+        latencies.append(time.perf_counter() - call_start)
+    return summarise(latencies, time.perf_counter() - start)
+
+
+def measure(name, build, queries, calls, method_3_max_size):
+    """_summary_
+    Builds the verified image index with build(), installs it in the label module and times methods 2 and 3.
+    """
+    # Release the previous index before measuring the memory of the new one.
+    label.verified_images = label.verified_images._replace(embeddings=None, index=None, lookup=None)
+    memory_before = rss_mb()
+    start = time.perf_counter()
+    data = build()
+    build_seconds = time.perf_counter() - start
+    label.verified_images = label.VerifiedImages(*data, version=label.verified_images.version + 1)
+    size = label.verified_images.index.ntotal
+    results = [{
+        "name": name + "_build_n" + str(size),
+        "images": size,
+        "build_seconds": build_seconds,
+        "memory_mb": rss_mb() - memory_before,
+        "index_mb": size * 768 * 4 / 2 ** 20,
+    }]
+    results.append(dict(name=name + "_label_method_2_n" + str(size), images=size,
+                        **time_queries(label.label_method_2, queries, calls)))
+    if size <= method_3_max_size:
+        results.append(dict(name=name + "_label_method_3_n" + str(size), images=size,
+                            **time_queries(label.label_method_3, queries, max(1, calls // 10))))
+    for result in results:
+        print(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--store", help="Store written by generate_verified_images.py.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000],
+                        help="Numbers of images of the store to build the index from.")
+    parser.add_argument("--mongo", action="store_true", help="Build the index from the local MongoDB.")
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--method-3-max-size", type=int, default=1000000)
+    parser.add_argument("--output", help="Report path. Defaults to benchmarks/reports/scale_<timestamp>.json.")
+    parser.add_argument("--baseline", help="Report to compare the results with.")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+    if not (args.store or args.mongo):
+        parser.error("one of --store or --mongo is required")
+
+    queries = load_sample_embeddings("Celeb_A", 200)
+    queries = [queries[[i]] for i in range(len(queries))]
+    results = []
+    if args.store:
+        for size in args.sizes:
+            results += measure("store", lambda: load_verified_store(args.store, label.method_2_labels, size),
+                               queries, args.calls, args.method_3_max_size)
+    if args.mongo:
+        results += measure("mongo", label.build_verified_images, queries, args.calls, args.method_3_max_size)
+
+    meta = report_meta("scale", store=args.store, sizes=args.sizes, mongo=args.mongo, calls=args.calls)
+    sys.exit(finish(meta, results, args.output, args.baseline, args.tolerance))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""
+Runs a service with serve.py for every combination of worker processes and torch/FAISS threads per worker, and
+reports the throughput of each combination and the best one for this machine. The thread counts are passed to the
+service through TORCH_THREADS and FAISS_THREADS (see common/threads.py).
+
+Usage:
+    python benchmarks/bench_thread_matrix.py label --workers 1 2 4 --torch-threads 1 2 4
+    python benchmarks/bench_thread_matrix.py embedding --workers 1 2 --torch-threads 1 2 4 8 --concurrency 8
+"""
+import argparse
+import json
+from load_test_workers import ENDPOINTS, measure
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("service", choices=ENDPOINTS.keys())
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--torch-threads", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--threads", type=int, default=4, help="Request threads per worker.")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=500)
+    args = parser.parse_args()
+
+    results = []
+    for workers in args.workers:
+        for torch_threads in args.torch_threads:
+            env = {"TORCH_THREADS": str(torch_threads), "FAISS_THREADS": str(torch_threads)}
+            stats = measure(args.service, workers, args.threads, args.concurrency, args.requests, extra_env=env)
+            stats["torch_threads"] = torch_threads
+            results.append(stats)
+            print(json.dumps(stats))
+
+    print()
+    print(f"{'workers':>8} {'threads':>8} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    for stats in results:
+        print(f"{stats['workers']:>8} {stats['torch_threads']:>8} {stats['requests_per_second']:>8.1f} "
+              f"{stats['p50_ms']:>8.1f} {stats['p99_ms']:>8.1f}")
+    best = max(results, key=lambda stats: stats["requests_per_second"])
+    print(f"best: {best['workers']} workers x {best['torch_threads']} threads, "
+          f"{best['requests_per_second']:.1f} req/s")
+
+
+if __name__ == "__main__":
+    main()
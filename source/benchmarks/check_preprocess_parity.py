@@ -0,0 +1,55 @@
+"""
+Checks that batch_preprocess.preprocess_batch matches clip's PIL preprocess transform, and compares their speed.
+Outputs may differ by one 8-bit level (about 0.015 after normalisation) where PIL's fixed point resampling rounds
+differently. Exits with status 1 if any value differs by more than that.
+
+Usage: python benchmarks/check_preprocess_parity.py [image paths...]
+"""
+import os
+import sys
+import time
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+from clip.clip import _transform
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "image_embedding_server"))
+from batch_preprocess import preprocess_batch, CLIP_STD  # noqa: E402
+
+N_PX = 224
+# One 8-bit level after normalisation, for the channel with the smallest standard deviation.
+TOLERANCE = 1.0 / 255 / float(CLIP_STD.min()) + 1e-6
+
+
+def sample_images(paths):
+    if paths:
+        return [cv2.imread(path, cv2.IMREAD_UNCHANGED) for path in paths]
+    rng = np.random.default_rng(0)
+    noise = [rng.integers(0, 256, size, dtype=np.uint8)
+             for size in [(240, 240, 3), (100, 180, 3), (480, 640, 3), (150, 97, 3), (224, 224, 3), (120, 130)]]
+    return noise + [cv2.GaussianBlur(image, (9, 9), 3) for image in noise]
+
+
+def main():
+    preprocess = _transform(N_PX)
+    images = sample_images(sys.argv[1:])
+
+    start = time.perf_counter()
+    reference = torch.stack([preprocess(Image.fromarray(image)) for image in images])
+    reference_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batch = preprocess_batch(images, n_px=N_PX, fallback=preprocess)
+    batch_seconds = time.perf_counter() - start
+
+    difference = (batch - reference).abs()
+    print(f"images: {len(images)}")
+    print(f"max abs difference: {difference.max().item():.6f} (tolerance {TOLERANCE:.6f})")
+    print(f"values differing: {(difference > 1e-4).float().mean().item() * 100:.4f}%")
+    print(f"PIL preprocess: {reference_seconds * 1000:.1f} ms, preprocess_batch: {batch_seconds * 1000:.1f} ms")
+    sys.exit(0 if difference.max().item() <= TOLERANCE else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+import aiohttp
+import numpy as np
+import requests
+
+
+def summarise(latencies, elapsed, errors=0):
+    """_summary_
+    Returns the latency percentiles (in milliseconds) and throughput of a set of requests.
+    """
+    ms = np.array(latencies) * 1000
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "elapsed_seconds": elapsed,
+        "requests_per_second": len(latencies) / elapsed if elapsed > 0 else 0.0,
+        "mean_ms": float(ms.mean()) if len(ms) else 0.0,
+        "p50_ms": float(np.percentile(ms, 50)) if len(ms) else 0.0,
+        "p95_ms": float(np.percentile(ms, 95)) if len(ms) else 0.0,
+        "p99_ms": float(np.percentile(ms, 99)) if len(ms) else 0.0,
+    }
+
+
+def run_load(url, payloads, concurrency=8, total_requests=200, warmup=5, check=None):
+    """_summary_
+    Sends total_requests JSON POST requests to url from concurrency threads, cycling through payloads, and returns
+    the latency percentiles and throughput. The first warmup requests are sent before timing starts.
+
+    A request counts as an error if it does not return 200, or if check is given and check(response) is False, e.g.
+    for endpoints that report errors in the response body.
+    """
+    session = requests.Session()
+    for i in range(warmup):
+        session.post(url, json=payloads[i % len(payloads)])
+
+    def send(i):
+        start = time.perf_counter()
+        try:
+            response = requests.post(url, json=payloads[i % len(payloads)])
+            ok = response.status_code == 200 and (check is None or check(response))
+        except (requests.RequestException, ValueError):
+            ok = False
+        return time.perf_counter() - start, ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(send, range(total_requests)))
+    elapsed = time.perf_counter() - start
+    stats = summarise([latency for latency, ok in results if ok], elapsed,
+                      errors=sum(1 for _, ok in results if not ok))
+    stats["concurrency"] = concurrency
+    return stats
+
+
+def run_async_load(url, payloads, concurrency=8, total_requests=200, warmup=5, timeout=300):
+    """_summary_
+    Same as run_load(), but the requests are sent by concurrency asyncio tasks, each holding its own connection.
+    This can hold thousands of connections open at once, where run_load() is limited by the number of threads.
+    """
+    async def main():
+        client_timeout = aiohttp.ClientTimeout(total=timeout)
+        connector = aiohttp.TCPConnector(limit=concurrency)
+        async with aiohttp.ClientSession(connector=connector, timeout=client_timeout) as session:
+            for i in range(warmup):
+                async with session.post(url, json=payloads[i % len(payloads)]) as response:
+                    await response.read()
+
+            remaining = iter(range(total_requests))
+            results = []
+
+            async def client():
+                for i in remaining:
+                    start = time.perf_counter()
+                    try:
+                        async with session.post(url, json=payloads[i % len(payloads)]) as response:
+                            await response.read()
+                            ok = response.status == 200
+                    except (aiohttp.ClientError, asyncio.TimeoutError):
+                        ok = False
+                    results.append((time.perf_counter() - start, ok))
+
+            start = time.perf_counter()
+            await asyncio.gather(*(client() for _ in range(concurrency)))
+            return results, time.perf_counter() - start
+
+    results, elapsed = asyncio.run(main())
+    stats = summarise([latency for latency, ok in results if ok], elapsed,
+                      errors=sum(1 for _, ok in results if not ok))
+    stats["concurrency"] = concurrency
+    return stats
@@ -0,0 +1,80 @@
+"""
+Starts a service with serve.py at each worker count, waits for its /ready endpoint, and measures requests/sec and
+latency under load.
+
+Usage:
+    python benchmarks/load_test_workers.py label --workers 1 2 4 --threads 4 --concurrency 16
+    python benchmarks/load_test_workers.py embedding --workers 1 2 --threads 2
+"""
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import requests
+from load import run_load
+from sample_data import SOURCE_DIR, load_sample_embeddings
+from bench_embedding_server import synthetic_faces
+
+sys.path.insert(0, SOURCE_DIR)
+from serve import SERVICES  # noqa: E402
+
+# service name: (endpoint, function returning request payloads)
+ENDPOINTS = {
+    "face_detection": ("/detect", lambda: [{"img": "data:image/png;base64," + image} for image in synthetic_faces(4, (640, 480))]),
+    "embedding": ("/get_embedding", lambda: [{"img": image} for image in synthetic_faces()]),
+    "label": ("/label_method_1", lambda: [{"embedding": emb.reshape(1, -1).tolist()}
+                                          for emb in load_sample_embeddings("Celeb_A", 50)]),
+    "ui": ("/processimage", lambda: [{"img": "data:image/png;base64," + image, "method": "method_1"}
+                                     for image in synthetic_faces(4, (640, 480))]),
+}
+
+
+def wait_until_ready(base_url, timeout=600):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(base_url + "/ready", timeout=2).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(1)
+    raise TimeoutError("Service did not become ready")
+
+
+def measure(service, workers, threads, concurrency, total_requests, extra_env=None):
+    """_summary_
+    Starts the service with the given number of workers and threads, runs the load test and stops the service.
+    """
+    port = SERVICES[service][3]
+    base_url = f"http://127.0.0.1:{port}"
+    endpoint, payloads = ENDPOINTS[service]
+    process = subprocess.Popen([sys.executable, os.path.join(SOURCE_DIR, "serve.py"), service,
+                                "--workers", str(workers), "--threads", str(threads)],
+                               env=dict(os.environ, **(extra_env or {})))
+    try:
+        wait_until_ready(base_url)
+        stats = run_load(base_url + endpoint, payloads(), concurrency, total_requests)
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait()
+    return dict(service=service, workers=workers, threads=threads, **stats)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("service", choices=ENDPOINTS.keys())
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=500)
+    args = parser.parse_args()
+
+    for workers in args.workers:
+        print(json.dumps(measure(args.service, workers, args.threads, args.concurrency, args.requests)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+In-process micro-benchmarks of the label server's hot paths, written to a JSON report (see report.py):
+
+    index_build             building the verified image index and label table, as build_verified_images() does
+    build_verified_images   build_verified_images() itself, reading the local MongoDB (only with --mongo)
+    faiss_search_*          FAISS searches of the verified image index, for method 2 (k neighbours), method 3
+                            (every image) and a batch of queries
+    text_similarity_*       the clip text-similarity path of methods 1, 4 and 5, one query and a batch
+    label_method_2/3        methods 2 and 3 end to end
+
+The verified set is built from the FairFace sample embeddings, repeated with small noise to reach each size.
+
+Usage:
+    python benchmarks/micro_benchmarks.py --sizes 1000 10000 --calls 200
+    python benchmarks/micro_benchmarks.py --baseline benchmarks/reports/micro_old.json
+"""
+import argparse
+import sys
+import time
+import numpy as np
+from load import summarise
+from report import finish, report_meta
+from sample_data import load_sample_embeddings, install_verified_set
+import label
+import batch_label
+
+BATCH_SIZE = 64
+
+
+def scaled_embeddings(embeddings, size, seed=0):
+    """_summary_
+    Returns size embeddings made by repeating embeddings with a little gaussian noise.
+    """
+    rng = np.random.default_rng(seed)
+    rows = embeddings[np.arange(size) % len(embeddings)]
+    noise = rng.normal(0, 0.01, rows.shape).astype(np.float32)
+    return np.ascontiguousarray(rows + noise * np.abs(rows).mean())
+
+
+def time_calls(name, fn, queries, calls):
+    """_summary_
+    Calls fn(query) calls times, cycling through queries, and returns the latency statistics.
+    """
+    latencies = []
+    start = time.perf_counter()
+    for i in range(calls):
+        query = queries[i % len(queries)]
+        call_start = time.perf_counter()
+        fn(query)
+        latencies.append(time.perf_counter() - call_start)
+    stats = summarise(latencies, time.perf_counter() - start)
+    result = dict(name=name, **stats)
+    print(result)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000],
+                        help="Numbers of verified images to benchmark.")
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--mongo", action="store_true",
+                        help="Also time build_verified_images() against the local MongoDB.")
+    parser.add_argument("--output", help="Report path. Defaults to benchmarks/reports/micro_<timestamp>.json.")
+    parser.add_argument("--baseline", help="Report to compare the results with.")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+
+    sample = load_sample_embeddings("FairFace")
+    queries = load_sample_embeddings("Celeb_A", 200)
+    single_queries = [queries[[i]] for i in range(len(queries))]
+    batches = [queries[i:i + BATCH_SIZE] for i in range(0, len(queries) - BATCH_SIZE + 1, BATCH_SIZE)]
+    results = []
+
+    results.append(time_calls("text_similarity_method_1", label.label_method_1, single_queries, args.calls))
+    results.append(time_calls("text_similarity_method_4", label.label_method_4, single_queries, args.calls))
+    results.append(time_calls("text_similarity_method_5", label.label_method_5, single_queries, args.calls))
+    results.append(time_calls("text_similarity_method_1_batch" + str(BATCH_SIZE),
+                              batch_label.label_method_1_batch, batches, max(1, args.calls // BATCH_SIZE)))
+
+    for size in args.sizes:
+        verified = scaled_embeddings(sample, size)
+        results.append(time_calls("index_build_n" + str(size), lambda embeddings: install_verified_set(
+            label, embeddings), [verified], 3))
+        snapshot = label.verified_images
+        neighbours = int(label.METHOD_2_NEIGHBOURS)
+        results.append(time_calls("faiss_search_k" + str(neighbours) + "_n" + str(size),
+                                  lambda emb: snapshot.index.search(emb, neighbours), single_queries, args.calls))
+        results.append(time_calls("faiss_search_all_n" + str(size),
+                                  lambda emb: snapshot.index.search(emb, snapshot.index.ntotal), single_queries,
+                                  max(1, args.calls // 10)))
+        results.append(time_calls("faiss_search_k" + str(neighbours) + "_batch" + str(BATCH_SIZE) + "_n" + str(size),
+                                  lambda embeddings: snapshot.index.search(embeddings, neighbours), batches,
+                                  max(1, args.calls // 10)))
+        results.append(time_calls("label_method_2_n" + str(size), label.label_method_2, single_queries, args.calls))
+        results.append(time_calls("label_method_3_n" + str(size), label.label_method_3, single_queries,
+                                  max(1, args.calls // 10)))
+
+    if args.mongo:
+        results.append(time_calls("build_verified_images", lambda _: label.build_verified_images(), [None], 3))
+
+    meta = report_meta("micro", sizes=args.sizes, calls=args.calls, model=label.CLIP_MODEL)
+    sys.exit(finish(meta, results, args.output, args.baseline, args.tolerance))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+JSON benchmark reports, shared by run_suite.py and micro_benchmarks.py.
+
+A report is {"meta": {...}, "results": [...]}. Each result has a "name" (and, for load tests, a "concurrency"), plus the
+statistics returned by load.summarise(). Two reports are compared result by result, matched on name and concurrency,
+so a run can be checked against a saved baseline for regressions.
+"""
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+
+REPORTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "reports")
+
+
+def report_meta(suite, **settings):
+    """_summary_
+    Returns the metadata recorded with a report: when and where it was run, and the git commit of the code.
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "suite": suite,
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": commit,
+        "host": platform.node(),
+        "python": sys.version.split()[0],
+        "cpu_count": os.cpu_count(),
+        "settings": settings,
+    }
+
+
+def write_report(meta, results, output=None):
+    """_summary_
+    Writes a report to output, by default reports/<suite>_<timestamp>.json, and returns its path.
+    """
+    if output is None:
+        os.makedirs(REPORTS_DIR, exist_ok=True)
+        output = os.path.join(REPORTS_DIR, meta["suite"] + "_" + meta["timestamp"].replace(":", "-") + ".json")
+    with open(output, "w") as file:
+        json.dump({"meta": meta, "results": results}, file, indent=2)
+    return output
+
+
+def result_key(result):
+    return result["name"], result.get("concurrency")
+
+
+def compare_reports(baseline, results, tolerance=0.1):
+    """_summary_
+    Compares results with a baseline report. A result regresses if its p95 latency is more than tolerance higher,
+    or its throughput more than tolerance lower, than the baseline result with the same name and concurrency.
+
+    Returns:
+        list: One {"name", "concurrency", "metric", "baseline", "current", "change"} dictionary per regression.
+    """
+    baseline_results = {result_key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        previous = baseline_results.get(result_key(result))
+        if previous is None or "error" in result or "error" in previous:
+            continue
+        for metric, worse in (("p95_ms", 1), ("requests_per_second", -1)):
+            if not previous.get(metric) or metric not in result:
+                continue
+            change = (result[metric] - previous[metric]) / previous[metric]
+            if change * worse > tolerance:
+                regressions.append({"name": result["name"], "concurrency": result.get("concurrency"),
+                                    "metric": metric, "baseline": previous[metric], "current": result[metric],
+                                    "change": change})
+    return regressions
+
+
+def finish(meta, results, output=None, baseline=None, tolerance=0.1):
+    """_summary_
+    Writes the report and, if a baseline report path is given, prints any regressions against it.
+
+    Returns:
+        int: Exit code, 1 if there were regressions.
+    """
+    path = write_report(meta, results, output)
+    print("Report written to " + path)
+    if not baseline:
+        return 0
+    with open(baseline) as file:
+        regressions = compare_reports(json.load(file), results, tolerance)
+    for regression in regressions:
+        print("REGRESSION " + json.dumps(regression))
+    print(str(len(regressions)) + " regressions against " + baseline)
+    return 1 if regressions else 0
@@ -0,0 +1,137 @@
+"""
+Latency and throughput benchmark suite for every service. Each scenario sends JSON requests to one endpoint of a
+running service at each concurrency level and records p50/p95/p99 latency and requests/sec. The results are written
+to a JSON report (see report.py), which can be compared with a previous report to catch regressions.
+
+The services are not started by the suite; start them with serve.py (or the Flask apps) first. Scenarios whose
+service is not ready are recorded with an error and skipped.
+
+Embeddings come from the sample embeddings in Clip_Image_Embeddings, and images are synthetic noise images unless
+--images is given a directory of real photos. The face detector finds no faces in noise images, so /processimage
+only exercises the detection path with synthetic images.
+
+Usage:
+    python benchmarks/run_suite.py --concurrency 1 8 32 --requests 300
+    python benchmarks/run_suite.py --scenarios label_method_1 label_method_2 --baseline benchmarks/reports/old.json
+"""
+import argparse
+import base64
+import os
+import sys
+from io import BytesIO
+import requests
+from PIL import Image
+from load import run_load
+from report import finish, report_meta
+from sample_data import SOURCE_DIR, load_sample_embeddings
+from bench_embedding_server import synthetic_faces
+
+sys.path.insert(0, SOURCE_DIR)
+from serve import SERVICES  # noqa: E402
+
+DATA_URL_PREFIX = "data:image/png;base64,"
+
+
+def load_images(directory, size=None):
+    """_summary_
+    Returns the images in directory as base64 encoded PNGs, resized to size if given.
+    """
+    images = []
+    for file in sorted(os.listdir(directory)):
+        try:
+            image = Image.open(os.path.join(directory, file)).convert("RGB")
+        except OSError:
+            continue
+        if size:
+            image = image.resize(size)
+        buffer = BytesIO()
+        image.save(buffer, format="PNG")
+        images.append(base64.b64encode(buffer.getvalue()).decode("ascii"))
+    return images
+
+
+def build_scenarios(images_dir=None):
+    """_summary_
+    Returns {scenario name: (service, endpoint, function returning the request payloads)}.
+    """
+    def frames():
+        if images_dir:
+            return load_images(images_dir, (640, 480))
+        return synthetic_faces(4, (640, 480))
+
+    def faces():
+        if images_dir:
+            return load_images(images_dir, (240, 240))
+        return synthetic_faces()
+
+    def embeddings():
+        return [{"embedding": emb.reshape(1, -1).tolist()} for emb in load_sample_embeddings("Celeb_A", 50)]
+
+    def draw_labels():
+        face_data = [{"labels": ["20-29", "Female", "White"], "regions": [40 + 150 * i, 120, 120, 120]}
+                     for i in range(3)]
+        return [{"img": DATA_URL_PREFIX + image, "face_data": face_data} for image in frames()]
+
+    scenarios = {
+        "detect": ("face_detection", "/detect", lambda: [{"img": DATA_URL_PREFIX + image} for image in frames()]),
+        "get_embedding": ("embedding", "/get_embedding", lambda: [{"img": image} for image in faces()]),
+        "draw_labels": ("label", "/draw_labels", draw_labels),
+        "processimage": ("ui", "/processimage",
+                         lambda: [{"img": DATA_URL_PREFIX + image, "method": "method_1"} for image in frames()]),
+    }
+    for method in range(1, 6):
+        scenarios["label_method_" + str(method)] = ("label", "/label_method_" + str(method), embeddings)
+    return scenarios
+
+
+def succeeded(response):
+    """_summary_
+    The services return errors with a 200 status and "success": "False" (or False) in the body.
+    """
+    return str(response.json().get("success")) == "True"
+
+
+def is_ready(base_url):
+    try:
+        return requests.get(base_url + "/ready", timeout=5).status_code == 200
+    except requests.RequestException:
+        return False
+
+
+def main():
+    scenarios = build_scenarios()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenarios", nargs="+", default=list(scenarios), choices=list(scenarios))
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=200, help="Requests per scenario and concurrency level.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--images", help="Directory of photos to use instead of synthetic images.")
+    parser.add_argument("--output", help="Report path. Defaults to benchmarks/reports/suite_<timestamp>.json.")
+    parser.add_argument("--baseline", help="Report to compare the results with.")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="Relative change in p95 latency or throughput reported as a regression.")
+    args = parser.parse_args()
+    scenarios = build_scenarios(args.images)
+
+    results = []
+    for name in args.scenarios:
+        service, endpoint, payloads = scenarios[name]
+        base_url = "http://" + args.host + ":" + str(SERVICES[service][3])
+        if not is_ready(base_url):
+            print(name + ": " + base_url + " is not ready, skipping")
+            results.append({"name": name, "endpoint": endpoint, "error": "service not ready"})
+            continue
+        scenario_payloads = payloads()
+        for concurrency in args.concurrency:
+            stats = run_load(base_url + endpoint, scenario_payloads, concurrency, args.requests, check=succeeded)
+            result = dict(name=name, endpoint=endpoint, **stats)
+            print(result)
+            results.append(result)
+
+    meta = report_meta("suite", concurrency=args.concurrency, requests=args.requests, host=args.host,
+                       images=args.images or "synthetic")
+    sys.exit(finish(meta, results, args.output, args.baseline, args.tolerance))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+import os
+import sys
+import random
+import numpy as np
+import faiss
+
+# The benchmarks import the service modules directly, so add the service folders to the path.
+SOURCE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REPO_DIR = os.path.dirname(SOURCE_DIR)
+sys.path.insert(0, os.path.join(SOURCE_DIR, "label_server"))
+sys.path.insert(0, SOURCE_DIR)
+from index_store import LabelTable  # noqa: E402
+from common.embedding_store import EmbeddingStore, is_store  # noqa: E402
+
+EMBEDDINGS_DIR = os.path.join(REPO_DIR, "Clip_Image_Embeddings")
+
+
+def load_sample_embeddings(dataset="FairFace", limit=None):
+    """_summary_
+    Loads the sample clip embeddings shipped in Clip_Image_Embeddings/<dataset> into a single (n, 768) float32 array.
+    If Clip_Image_Embeddings/<dataset>.store has been built with pack_embeddings.py, it is read instead.
+    """
+    store_path = os.path.join(EMBEDDINGS_DIR, dataset + ".store")
+    if is_store(store_path):
+        return np.array(EmbeddingStore(store_path).embeddings(limit))
+    folder = os.path.join(EMBEDDINGS_DIR, dataset)
+    files = sorted(f for f in os.listdir(folder) if f.endswith(".npy"))[:limit]
+    return np.concatenate([np.load(os.path.join(folder, f)).reshape(1, -1) for f in files]).astype(np.float32)
+
+
+def install_verified_set(label, embeddings, seed=0):
+    """_summary_
+    Fills the label module's verified image index with the given embeddings, giving each image random verified
+    and incorrect labels. This mirrors build_verified_images() without needing a MongoDB instance.
+    """
+    rng = random.Random(seed)
+    index = faiss.IndexIDMap(faiss.IndexFlatL2(768))
+    row_ids = np.arange(len(embeddings), dtype=np.int64)
+    index.add_with_ids(embeddings, row_ids)
+
+    records = []
+    for row_id in row_ids:
+        verified = [rng.choice(labels) for labels in label.method_2_attributes]
+        incorrect = [rng.choice([l for l in labels if l not in verified])
+                     for labels in label.method_2_attributes if rng.random() < 0.5]
+        records.append({"_id": str(row_id), "verified_labels": verified, "incorrect_labels": incorrect})
+
+    label.verified_images = label.VerifiedImages(embeddings, index,
+                                                 LabelTable.from_records(row_ids, records, label.method_2_labels),
+                                                 label.verified_images.version + 1)
@@ -0,0 +1,161 @@
+"""
+Packed store of clip embeddings, replacing directories of one (1, 768) .npy file per image.
+
+A store is a directory holding the embeddings in shards, each one contiguous float32 matrix, with a sidecar of the id
+and metadata of every row:
+
+    manifest.json           {"dim": 768, "dtype": "float32", "shards": [{"name": "shard_00000", "rows": 1000}, ...]}
+    shard_00000.npy         (rows, dim) float32 matrix
+    shard_00000.jsonl       one {"id": ..., <metadata>} line per row
+    ...
+
+Shards are memory mapped when read, so opening a store costs one file open per shard rather than one per image.
+append() writes a new shard and then replaces the manifest atomically, so readers never see a partial shard.
+"""
+import csv
+import json
+import os
+import numpy as np
+
+MANIFEST = "manifest.json"
+
+
+def is_store(path):
+    """_summary_
+    Returns True if path is an embedding store directory.
+    """
+    return os.path.isfile(os.path.join(path, MANIFEST))
+
+
+class EmbeddingStore:
+    """_summary_
+    Reader and writer of a packed embedding store directory.
+    """
+
+    def __init__(self, path, dim=768):
+        """_summary_
+        Opens the store at path, creating an empty store if it does not exist.
+
+        Args:
+            path (str): Store directory.
+            dim (int): Embedding size of a new store.
+        """
+        self.path = path
+        if is_store(path):
+            with open(os.path.join(path, MANIFEST)) as file:
+                self.manifest = json.load(file)
+        else:
+            os.makedirs(path, exist_ok=True)
+            self.manifest = {"dim": dim, "dtype": "float32", "shards": []}
+            self._write_manifest()
+
+    def __len__(self):
+        return sum(shard["rows"] for shard in self.manifest["shards"])
+
+    @property
+    def dim(self):
+        return self.manifest["dim"]
+
+    def append(self, embeddings, ids, metadata=None):
+        """_summary_
+        Adds a shard to the store.
+
+        Args:
+            embeddings (NumpyArray): (n, dim) embeddings. Each row is flattened, so (n, 1, dim) arrays are accepted.
+            ids (list): Id of each row, e.g. the image name.
+            metadata (list): Optional dictionary of metadata for each row.
+        """
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32).reshape(len(ids), self.dim)
+        name = "shard_%05d" % len(self.manifest["shards"])
+        np.save(os.path.join(self.path, name + ".npy"), embeddings)
+        with open(os.path.join(self.path, name + ".jsonl"), "w") as file:
+            for i, row_id in enumerate(ids):
+                record = dict(metadata[i]) if metadata else {}
+                record["id"] = row_id
+                file.write(json.dumps(record) + "\n")
+        self.manifest["shards"].append({"name": name, "rows": len(ids)})
+        self._write_manifest()
+
+    def shard_embeddings(self, shard):
+        """_summary_
+        Returns the read only memory mapped embeddings of a shard.
+        """
+        return np.load(os.path.join(self.path, shard["name"] + ".npy"), mmap_mode="r")
+
+    def shard_records(self, shard):
+        """_summary_
+        Returns the {"id": ..., <metadata>} record of every row of a shard.
+        """
+        with open(os.path.join(self.path, shard["name"] + ".jsonl")) as file:
+            return [json.loads(line) for line in file]
+
+    def records(self):
+        """_summary_
+        Returns the record of every row in the store.
+        """
+        return [record for shard in self.manifest["shards"] for record in self.shard_records(shard)]
+
+    def ids(self):
+        return [record["id"] for record in self.records()]
+
+    def embeddings(self, limit=None):
+        """_summary_
+        Returns the embeddings of the store as one (n, dim) float32 matrix. A store with one shard is returned
+        memory mapped without copying, otherwise the shards are concatenated.
+        """
+        shards = [self.shard_embeddings(shard) for shard in self.manifest["shards"]]
+        if not shards:
+            return np.empty((0, self.dim), dtype=np.float32)
+        matrix = shards[0] if len(shards) == 1 else np.concatenate(shards)
+        return matrix[:limit] if limit is not None else matrix
+
+    def iter_shards(self):
+        """_summary_
+        Yields (records, embeddings) for each shard, without loading the other shards.
+        """
+        for shard in self.manifest["shards"]:
+            yield self.shard_records(shard), self.shard_embeddings(shard)
+
+    def _write_manifest(self):
+        temp_path = os.path.join(self.path, MANIFEST + ".tmp")
+        with open(temp_path, "w") as file:
+            json.dump(self.manifest, file, indent=2)
+        os.replace(temp_path, os.path.join(self.path, MANIFEST))
+
+
+def load_fairface_labels(label_file):
+    """_summary_
+    Reads a FairFace label CSV (file,age,gender,race,...) into a dictionary from image name ("1.jpg") to
+    [age, gender, race].
+    """
+    labels = {}
+    with open(label_file, newline="") as file:
+        for row in csv.reader(file):
+            if len(row) >= 4 and row[0] != "file":
+                labels[os.path.basename(row[0])] = row[1:4]
+    return labels
+
+
+def pack_directory(directory, store, shard_size=10000, labels=None):
+    """_summary_
+    Packs a directory of per-image .npy embedding files into a store, shard_size rows per shard.
+
+    Args:
+        directory (str): Directory of <image name>.npy files.
+        store (EmbeddingStore): Store the embeddings are appended to.
+        shard_size (int): Maximum number of rows per shard.
+        labels (dict): Optional {image name: labels} dictionary, stored as the "labels" metadata of each row.
+
+    Returns:
+        int: Number of embeddings packed.
+    """
+    files = sorted(file for file in os.listdir(directory) if file.endswith(".npy"))
+    for start in range(0, len(files), shard_size):
+        batch = files[start:start + shard_size]
+        embeddings = np.empty((len(batch), store.dim), dtype=np.float32)
+        for i, file in enumerate(batch):
+            embeddings[i] = np.load(os.path.join(directory, file)).reshape(-1)
+        ids = [file[:-4] for file in batch]
+        metadata = [{"labels": labels[row_id]} if labels and row_id in labels else {} for row_id in ids]
+        store.append(embeddings, ids, metadata)
+    return len(files)
@@ -0,0 +1,242 @@
+"""
+Request and stage timing for the services, exposed as Prometheus-style metrics.
+
+Each Flask app calls instrument_app(app, service) once. This adds a /metrics endpoint and times every request. Code
+that does a distinct piece of work (decoding, detection, FAISS searches, Mongo lookups, drawing, ...) is wrapped in
+"with stage(name):", which records the time in a histogram and against the current request.
+
+Every request is given a request id, read from the X-Request-ID header or generated. The id is returned in the
+X-Request-ID response header together with a Server-Timing header of the request's stages, and request_headers()
+returns the header to pass on to downstream services. A request to the UI's /processimage and the requests it makes
+to the detection, embedding and label servers therefore share one id. Requests slower than SLOW_REQUEST_SECONDS are
+printed with their id and stage timings, so a slow request can be traced to a stage and a service.
+
+Metrics:
+    http_requests_total{service, endpoint, status}              counter
+    http_request_duration_seconds{service, endpoint}            histogram
+    stage_duration_seconds{service, stage}                      histogram
+    stage_errors_total{service, stage}                          counter
+
+Metrics are kept per process. Every series has a "worker" label with the process id, as with several gunicorn
+workers each scrape of /metrics is answered by one of them.
+"""
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+REQUEST_ID_HEADER = "X-Request-ID"
+SLOW_REQUEST_SECONDS = float(os.environ.get("SLOW_REQUEST_SECONDS", "1.0"))
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Name of the service, set by instrument_app().
+service_name = ""
+
+# Id and (stage, seconds) timings of the request being handled by the current thread.
+_request_id = contextvars.ContextVar("request_id", default=None)
+_request_stages = contextvars.ContextVar("request_stages", default=None)
+
+
+def _format_labels(labels):
+    return "{" + ",".join('%s="%s"' % (key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                          for key, value in labels) + "}"
+
+
+class Counter:
+    """_summary_
+    Thread safe counter with labels.
+    """
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels, amount=1):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self, extra_labels):
+        lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s counter" % self.name]
+        with self._lock:
+            for key, value in self._values.items():
+                lines.append(self.name + _format_labels(key + extra_labels) + " " + repr(value))
+        return lines
+
+
+class Histogram:
+    """_summary_
+    Thread safe histogram with labels and fixed buckets, in seconds.
+    """
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        # labels: [count per bucket, sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self, extra_labels):
+        lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s histogram" % self.name]
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(self.name + "_bucket" + _format_labels(key + extra_labels + (("le", repr(bound)),))
+                                 + " " + str(cumulative))
+                lines.append(self.name + "_bucket" + _format_labels(key + extra_labels + (("le", "+Inf"),))
+                             + " " + str(count))
+                lines.append(self.name + "_sum" + _format_labels(key + extra_labels) + " " + repr(total))
+                lines.append(self.name + "_count" + _format_labels(key + extra_labels) + " " + str(count))
+        return lines
+
+
+class Registry:
+    """_summary_
+    The metrics of a process, rendered in the Prometheus text format by render().
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name, documentation):
+        with self._lock:
+            return self._metrics.setdefault(name, Counter(name, documentation))
+
+    def histogram(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        with self._lock:
+            return self._metrics.setdefault(name, Histogram(name, documentation, buckets))
+
+    def render(self):
+        extra_labels = (("worker", os.getpid()),)
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            lines += metric.render(extra_labels)
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+requests_total = registry.counter("http_requests_total", "Requests handled, by endpoint and status code.")
+request_duration = registry.histogram("http_request_duration_seconds", "Time taken to handle a request.")
+stage_duration = registry.histogram("stage_duration_seconds", "Time spent in each stage of request handling.")
+stage_errors = registry.counter("stage_errors_total", "Exceptions raised from each stage.")
+
+
+def observe_stage(name, seconds):
+    """_summary_
+    Records that a stage took seconds. Use stage() where the work can be wrapped in a with block.
+    """
+    stage_duration.observe({"service": service_name, "stage": name}, seconds)
+    stages = _request_stages.get()
+    if stages is not None:
+        stages.append((name, seconds))
+
+
+@contextmanager
+def stage(name):
+    """_summary_
+    Times the code in the with block as the stage called name. Exceptions are counted and re-raised.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        stage_errors.inc({"service": service_name, "stage": name})
+        raise
+    finally:
+        observe_stage(name, time.perf_counter() - start)
+
+
+def current_request_id():
+    return _request_id.get()
+
+
+def request_headers():
+    """_summary_
+    Returns the headers that pass the current request id on to a downstream service, or {} outside a request.
+    """
+    request_id = _request_id.get()
+    return {REQUEST_ID_HEADER: request_id} if request_id else {}
+
+
+def server_timing(stages):
+    """_summary_
+    Returns a Server-Timing header value with the total time of each stage, in the order the stages first ran.
+    """
+    totals = {}
+    for name, seconds in stages:
+        totals[name] = totals.get(name, 0.0) + seconds
+    return ", ".join("%s;dur=%.1f" % (name, seconds * 1000) for name, seconds in totals.items())
+
+
+def instrument_app(app, service):
+    """_summary_
+    Times every request of a Flask app, assigns request ids and adds the /metrics endpoint.
+
+    Args:
+        app (Flask): The app.
+        service (str): Name of the service, the "service" label of its metrics.
+    """
+    from flask import Response, g, request
+    global service_name
+    service_name = service
+
+    @app.before_request
+    def start_request_timing():
+        g.request_start = time.perf_counter()
+        _request_id.set(request.headers.get(REQUEST_ID_HEADER) or uuid.uuid4().hex)
+        _request_stages.set([])
+
+    @app.after_request
+    def finish_request_timing(response):
+        start = g.get("request_start")
+        if start is None:
+            return response
+        elapsed = time.perf_counter() - start
+        # The route rule rather than the path, so ids in paths do not create new series.
+        endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        requests_total.inc({"service": service, "endpoint": endpoint, "status": response.status_code})
+        request_duration.observe({"service": service, "endpoint": endpoint}, elapsed)
+
+        request_id = _request_id.get()
+        stages = _request_stages.get() or []
+        response.headers[REQUEST_ID_HEADER] = request_id
+        if stages:
+            response.headers["Server-Timing"] = server_timing(stages)
+        if elapsed >= SLOW_REQUEST_SECONDS:
+            print(json.dumps({"slow_request": request_id, "service": service, "endpoint": endpoint,
+                              "status": response.status_code, "seconds": round(elapsed, 4),
+                              "stages": server_timing(stages)}))
+        _request_id.set(None)
+        _request_stages.set(None)
+        return response
+
+    @app.route("/metrics", methods=["GET"])
+    def get_metrics():
+        """_summary_
+        Returns the metrics of this process in the Prometheus text format.
+        """
+        return Response(registry.render(), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,153 @@
+"""
+Opt-in profiling of live traffic, for finding where time goes in a running service.
+
+install_profiling(app) adds two tools to a Flask app. Both are disabled unless the PROFILE_TOKEN environment variable
+is set, and every use must send the token in the X-Admin-Token header.
+
+GET /debug/profile?seconds=10&interval=0.005
+    Samples the stack of every thread of the process every interval seconds for the given number of seconds (at most
+    PROFILE_MAX_SECONDS) and returns the samples as collapsed stacks, one "thread;frame;frame;... count" line per
+    distinct stack. The output can be drawn as a flamegraph with flamegraph.pl or speedscope. Only one sampling
+    profile runs at a time. Sampling reads the stacks from a background thread without tracing every call, so the
+    overhead is low enough to profile production traffic.
+
+X-Profile: 1 request header
+    Runs that request under cProfile and returns the cProfile statistics of the request (sorted by cumulative time)
+    as text/plain instead of the usual response body. The original status code is kept and the original content type
+    is returned in X-Profile-Content-Type. Only the request thread is profiled, so work done in other threads or
+    processes (e.g. the embedding pipeline) shows up as time spent waiting. Only one request is profiled at a time;
+    others are served normally with X-Profile: busy.
+"""
+import cProfile
+import hmac
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN", "")
+PROFILE_MAX_SECONDS = float(os.environ.get("PROFILE_MAX_SECONDS", "60"))
+# Number of functions listed in an X-Profile response.
+PROFILE_STATS_LINES = int(os.environ.get("PROFILE_STATS_LINES", "60"))
+ADMIN_TOKEN_HEADER = "X-Admin-Token"
+
+
+def is_authorised(token):
+    """_summary_
+    Returns True if profiling is enabled and token is the admin token.
+    """
+    return bool(PROFILE_TOKEN) and hmac.compare_digest(token or "", PROFILE_TOKEN)
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return "%s:%s" % (os.path.basename(code.co_filename), code.co_name)
+
+
+class SamplingProfiler:
+    """_summary_
+    Samples the stacks of every thread of the process from a background thread.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def sample(self, seconds, interval=0.005):
+        """_summary_
+        Samples every thread's stack for seconds and returns the collapsed stacks.
+
+        Returns:
+            str: One "thread;outermost frame;...;innermost frame count" line per distinct stack, or None if another
+                 profile is already running.
+        """
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            stacks = Counter()
+            own_thread = threading.get_ident()
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id == own_thread:
+                        continue
+                    frames = []
+                    while frame is not None:
+                        frames.append(frame_name(frame))
+                        frame = frame.f_back
+                    frames.append(names.get(thread_id, str(thread_id)))
+                    stacks[";".join(reversed(frames))] += 1
+                time.sleep(interval)
+            return "".join("%s %d\n" % (stack, count) for stack, count in stacks.most_common())
+        finally:
+            self._lock.release()
+
+
+sampling_profiler = SamplingProfiler()
+# Held while a request is run under cProfile, as only one cProfile profiler can be active at a time.
+_request_profile_lock = threading.Lock()
+
+
+def format_stats(profiler, lines=PROFILE_STATS_LINES):
+    stream = io.StringIO()
+    stats = pstats.Stats(profiler, stream=stream)
+    stats.sort_stats("cumulative").print_stats(lines)
+    return stream.getvalue()
+
+
+def install_profiling(app):
+    """_summary_
+    Adds the /debug/profile endpoint and the X-Profile request header to a Flask app.
+    """
+    from flask import Response, g, request
+
+    @app.before_request
+    def start_request_profile():
+        if request.headers.get("X-Profile") != "1" or not is_authorised(request.headers.get(ADMIN_TOKEN_HEADER)):
+            return
+        if not _request_profile_lock.acquire(blocking=False):
+            g.request_profile_busy = True
+            return
+        g.request_profiler = cProfile.Profile()
+        g.request_profiler.enable()
+
+    @app.after_request
+    def finish_request_profile(response):
+        profiler = g.pop("request_profiler", None)
+        if profiler is None:
+            if g.pop("request_profile_busy", False):
+                response.headers["X-Profile"] = "busy"
+            return response
+        profiler.disable()
+        _request_profile_lock.release()
+        profiled = Response(format_stats(profiler), status=response.status_code, mimetype="text/plain")
+        profiled.headers["X-Profile-Content-Type"] = response.content_type
+        return profiled
+
+    @app.teardown_request
+    def release_request_profile(error=None):
+        # after_request is skipped if the request raised, so make sure the profiler is stopped.
+        profiler = g.pop("request_profiler", None)
+        if profiler is not None:
+            profiler.disable()
+            _request_profile_lock.release()
+
+    @app.route("/debug/profile", methods=["GET"])
+    def get_profile():
+        """_summary_
+        Returns a sampling profile of the process as collapsed stacks.
+        """
+        if not is_authorised(request.headers.get(ADMIN_TOKEN_HEADER)):
+            return Response("Forbidden\n", status=403, mimetype="text/plain")
+        try:
+            seconds = min(float(request.args.get("seconds", 10)), PROFILE_MAX_SECONDS)
+            interval = max(float(request.args.get("interval", 0.005)), 0.001)
+        except ValueError:
+            return Response("seconds and interval must be numbers\n", status=400, mimetype="text/plain")
+        collapsed = sampling_profiler.sample(seconds, interval)
+        if collapsed is None:
+            return Response("A profile is already running\n", status=409, mimetype="text/plain")
+        return Response(collapsed, mimetype="text/plain")
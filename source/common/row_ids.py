@@ -0,0 +1,18 @@
+"""
+Row ids of verified images, shared by the UI and the label server.
+
+A row_id is a compact integer given to each verified image, which the label server uses as the image's id in its
+FAISS index and as its row in the label lookup table. Row ids are reserved from the "row_id" document of the
+counters collection, so every process that assigns them draws from the same sequence.
+"""
+import pymongo
+
+
+def reserve_row_ids(db, count=1):
+    """_summary_
+    Reserves a block of count row ids from the counters collection of db and returns the first id in the block.
+    Row ids are never reused, so a row id always refers to the same image document.
+    """
+    counter = db.counters.find_one_and_update({"_id": "row_id"}, {"$inc": {"seq": count}},
+                                              upsert=True, return_document=pymongo.ReturnDocument.AFTER)
+    return counter["seq"] - count
@@ -0,0 +1,60 @@
+"""
+Thread configuration for torch and FAISS, shared by the services.
+
+By default torch and FAISS each start one thread per core in every process. With several gunicorn workers, request
+threads or decode processes on the same host, this oversubscribes the cores and the threads spend their time
+competing with each other. Each service calls configure_threads() once at start up, before its models are loaded,
+with defaults suited to how it uses the libraries. The defaults can be overridden per service with environment
+variables:
+
+    TORCH_THREADS           torch intra-op threads per process
+    TORCH_INTEROP_THREADS   torch inter-op threads per process
+    FAISS_THREADS           FAISS (OpenMP) threads per process
+
+serve.py sets SERVICE_WORKERS to the number of worker processes, so the defaults divide the cores between workers.
+"""
+import os
+import torch
+
+
+def cores_per_worker():
+    """_summary_
+    Returns the number of cores available to each worker process of the service, at least 1.
+    """
+    workers = max(1, int(os.environ.get("SERVICE_WORKERS", "1")))
+    return max(1, (os.cpu_count() or 1) // workers)
+
+
+def configure_threads(torch_threads=None, interop_threads=1, faiss_threads=None):
+    """_summary_
+    Sets the number of threads used by torch and, if faiss_threads is given, FAISS. Environment variables take
+    precedence over the arguments.
+
+    Args:
+        torch_threads (int): Default torch intra-op threads. Defaults to cores_per_worker().
+        interop_threads (int): Default torch inter-op threads. The services do not run independent torch operations
+                               in parallel, so one is enough.
+        faiss_threads (int): Default FAISS threads. FAISS is not imported or configured if None and FAISS_THREADS
+                             is not set.
+
+    Returns:
+        dict: The settings that were applied.
+    """
+    settings = {
+        "torch_threads": int(os.environ.get("TORCH_THREADS", torch_threads or cores_per_worker())),
+        "torch_interop_threads": int(os.environ.get("TORCH_INTEROP_THREADS", interop_threads)),
+    }
+    torch.set_num_threads(settings["torch_threads"])
+    try:
+        torch.set_num_interop_threads(settings["torch_interop_threads"])
+    except RuntimeError as e:
+        # The inter-op pool can only be sized once per process, before any inter-op work has started.
+        print(e)
+
+    faiss_threads = os.environ.get("FAISS_THREADS", faiss_threads)
+    if faiss_threads is not None:
+        import faiss
+        settings["faiss_threads"] = int(faiss_threads)
+        faiss.omp_set_num_threads(settings["faiss_threads"])
+    print("Thread settings: " + str(settings))
+    return settings
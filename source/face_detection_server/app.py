@@ -7,12 +7,27 @@ import numpy as np
 from io import BytesIO
 from PIL import Image
 import base64
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.instrumentation import instrument_app, stage  # noqa: E402
+from common.profiling import install_profiling  # noqa: E402
 
 app = Flask(__name__)
 
 # Neccessary to prevent CORS error being thrown.
 # https://stackoverflow.com/questions/28461001/python-flask-cors-issue
 CORS(app)
+# Request timing, request ids and the /metrics endpoint.
+instrument_app(app, "face_detection")
+# Opt-in sampling and per-request profiling, enabled by setting PROFILE_TOKEN.
+install_profiling(app)
+
+# build face detector model once when the server starts.
+# https://github.com/serengil/deepface/blob/master/deepface/detectors/FaceDetector.py
+detector_backend = "opencv"
+face_detector = FaceDetector.build_model(detector_backend)
 
 
 @app.route('/')
@@ -20,6 +35,15 @@ def index():
     return "Success"
 
 
+@app.route('/ready')
+def get_ready():
+    """_summary_
+    Readiness check. The face detector model is built when the server starts, so the server is ready once it is
+    accepting requests.
+    """
+    return jsonify({'ready': 'True'}), 200
+
+
 @app.route('/detect', methods=["POST"])
 def detect():
     """_summary_
@@ -36,42 +60,41 @@ def detect():
     try:
         # Get base64 encoded string from request object
         raw_content = req["img"]
-        # decode the base 64 string
-        # https://stackoverflow.com/questions/33754935/read-a-base-64-encoded-image-from-memory-using-opencv-python-library
-        decoded_string = base64.b64decode(raw_content[22:])
-        # create array of decoded string
-        numpy_image = np.frombuffer(decoded_string, dtype=np.uint8)
-        # convert array to image. Processing the image this way prevents us from having to temporarily save the image to disk.
-        img = cv2.imdecode(numpy_image, cv2.IMREAD_COLOR)
-
-        # build face detector model
-        # https://github.com/serengil/deepface/blob/master/deepface/detectors/FaceDetector.py
-        detector_backend = "opencv"
-        face_detector = FaceDetector.build_model(detector_backend)
-        faces = FaceDetector.detect_faces(face_detector, detector_backend, img)
+        with stage("decode"):
+            # decode the base 64 string
+            # https://stackoverflow.com/questions/33754935/read-a-base-64-encoded-image-from-memory-using-opencv-python-library
+            decoded_string = base64.b64decode(raw_content[22:])
+            # create array of decoded string
+            numpy_image = np.frombuffer(decoded_string, dtype=np.uint8)
+            # convert array to image. Processing the image this way prevents us from having to temporarily save the image to disk.
+            img = cv2.imdecode(numpy_image, cv2.IMREAD_COLOR)
+
+        with stage("detect"):
+            faces = FaceDetector.detect_faces(face_detector, detector_backend, img)
 
         if len(faces) > 0:
             data = []
-            # process each face to send in response.
-            for face in faces:
-                # The next 3 lines of code are important as they allow the image to be saved and sent without temporarily saving to disk.
-                # Image is returned as a np array. So need to format in order for it to be sent in response.
-                image = Image.fromarray(face[0])
-                image_arr = BytesIO()
-                image.save(image_arr, format='PNG')
-                encoded_image = base64.encodebytes(
-                    image_arr.getvalue()).decode('ascii')
-                regions = face[1]
-
-                # need to convert regions from int 32 to int to allow them to be converted to json. Was getting an error with int32.
-                for i, x in enumerate(regions):
-                    regions[i] = int(x)
-
-                values = [encoded_image, regions]
-                data.append(values)
-                # close the image object.
-                image.close()
-                image_arr.close()
+            with stage("encode"):
+                # process each face to send in response.
+                for face in faces:
+                    # The next 3 lines of code are important as they allow the image to be saved and sent without temporarily saving to disk.
+                    # Image is returned as a np array. So need to format in order for it to be sent in response.
+                    image = Image.fromarray(face[0])
+                    image_arr = BytesIO()
+                    image.save(image_arr, format='PNG')
+                    encoded_image = base64.encodebytes(
+                        image_arr.getvalue()).decode('ascii')
+                    regions = face[1]
+
+                    # need to convert regions from int 32 to int to allow them to be converted to json. Was getting an error with int32.
+                    for i, x in enumerate(regions):
+                        regions[i] = int(x)
+
+                    values = [encoded_image, regions]
+                    data.append(values)
+                    # close the image object.
+                    image.close()
+                    image_arr.close()
             return jsonify({'success': 'True', 'FaceDetected': 'True', 'faces': data}), 200
             # return make_response(jsonify(success='True', FaceDetected='True', faces=data), 200)
         else:
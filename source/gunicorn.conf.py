@@ -0,0 +1,20 @@
+# Gunicorn settings shared by every service. serve.py passes the service specific settings on the command line.
+import os
+import sys
+
+worker_class = "gthread"
+# Loading the clip model and running it on the CPU can take a while.
+timeout = 120
+graceful_timeout = 30
+
+
+def post_fork(server, worker):
+    """_summary_
+    With preload, each service's app module is imported once in the master process and shared with the workers
+    copy-on-write. Threads and process pools do not survive the fork, so they are started here, in each worker, by
+    the module's start_background_jobs() function.
+    """
+    module = sys.modules.get(os.environ.get("SERVICE_MODULE", ""))
+    start_background_jobs = getattr(module, "start_background_jobs", None)
+    if start_background_jobs is not None:
+        start_background_jobs()
@@ -1,20 +1,59 @@
 from flask import Flask, jsonify, request
 from flask_cors import CORS
-import base64
-from PIL import Image
-import cv2
-import numpy as np
 import clip
 import torch
+import os
+import sys
+from PIL import Image
+from embedding_pipeline import EmbeddingPipeline, decode_image
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.threads import configure_threads, cores_per_worker  # noqa: E402
+from common.instrumentation import instrument_app, stage  # noqa: E402
+from common.profiling import install_profiling  # noqa: E402
 
 app = Flask(__name__)
 # Neccessary to prevent CORS error being thrown.
 # https://stackoverflow.com/questions/28461001/python-flask-cors-issue
 CORS(app)
+# Request timing, request ids and the /metrics endpoint.
+instrument_app(app, "embedding")
+# Opt-in sampling and per-request profiling, enabled by setting PROFILE_TOKEN.
+install_profiling(app)
+
+# Number of worker processes used to decode and preprocess images. Set DECODE_WORKERS=0 to decode on the request
+# thread instead.
+DECODE_WORKERS = int(os.environ.get("DECODE_WORKERS", max(1, cores_per_worker() // 2)))
+# The model runs on one inference thread per worker, so torch gets the cores not used by the decode workers.
+thread_settings = configure_threads(torch_threads=max(1, cores_per_worker() - DECODE_WORKERS))
 
 # Set up clip model.
 device = "cuda" if torch.cuda.is_available() else "cpu"
 model, preprocess = clip.load("ViT-L/14", device=device, jit=True)
+# Maximum number of images run through the model together.
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", 8))
+# "tensor" preprocesses images with batch_preprocess.preprocess_batch, "pil" with clip's preprocess transform.
+PREPROCESS_BACKEND = os.environ.get("PREPROCESS_BACKEND", "tensor")
+# Input resolution of ViT-L/14.
+N_PX = 224
+embedding_pipeline = None
+
+# Set to True by start_background_jobs() once the model has been warmed up and the embedding pipeline is running.
+ready = False
+
+
+def start_background_jobs():
+    """_summary_
+    Starts the embedding pipeline and marks the server as ready. When served by gunicorn with preload (see serve.py),
+    this is called in each worker after it is forked, as the pipeline's threads and worker processes would not
+    survive the fork.
+    """
+    global embedding_pipeline, ready
+    if DECODE_WORKERS > 0:
+        embedding_pipeline = EmbeddingPipeline(model, preprocess, device,
+                                               decode_workers=DECODE_WORKERS, max_batch_size=MAX_BATCH_SIZE,
+                                               backend=PREPROCESS_BACKEND, n_px=N_PX)
+    ready = True
 
 
 @app.route('/')
@@ -22,6 +61,17 @@ def index():
     return "Success"
 
 
+@app.route('/ready')
+def get_ready():
+    """_summary_
+    Readiness check. Returns 200 once the clip model is loaded and warmed up and the embedding pipeline is running,
+    else 503.
+    """
+    if ready:
+        return jsonify({'ready': 'True'}), 200
+    return jsonify({'ready': 'False'}), 503
+
+
 @app.route('/get_embedding', methods=["POST"])
 def process_image():
     """_summary_
@@ -32,6 +82,9 @@ def process_image():
     If the a clip embedding is successfully generated, it returns {'success': 'True', 'embedding': embedding.tolist()}
 
     If there was an error generating the embedding, it returns {'success': 'False', 'msg': 'Error Processing Image'}
+
+    Unless DECODE_WORKERS is 0, the image is decoded and preprocessed by the embedding pipeline's worker processes and
+    batched with other requests for the model.
     """
     try:
         req = request.get_json()
@@ -39,15 +92,15 @@ def process_image():
             return jsonify({'success': 'False', 'msg': 'No image found in request'}), 400
 
         raw_content = req["img"]
-        decoded_string = base64.b64decode(raw_content)
-        numpy_image = np.frombuffer(decoded_string, dtype=np.uint8)
-
-        # Decode the image data from the numpy array
-        img = cv2.imdecode(numpy_image, cv2.IMREAD_UNCHANGED)
-        img = Image.fromarray(img)
-
-        # Get embedding
-        embedding = generate_embedding(img)
+        if embedding_pipeline is not None:
+            # The pipeline records its decode_preprocess and encode stages itself.
+            with stage("embed"):
+                embedding = embedding_pipeline.submit(raw_content).result()
+        else:
+            with stage("decode"):
+                img = decode_image(raw_content)
+            # Get embedding
+            embedding = generate_embedding(img)
         return jsonify({'success': 'True', 'embedding': embedding.tolist()}), 200
     except Exception as e:
         print(e)
@@ -58,8 +111,9 @@ def generate_embedding(img):
     """_summary_
     This function receives an image object and returns a clip image embedding.
     """
-    prepro = preprocess(img).unsqueeze(0).to(device)
-    with torch.no_grad():
+    with stage("preprocess"):
+        prepro = preprocess(img).unsqueeze(0).to(device)
+    with torch.no_grad(), stage("encode"):
         image_features = model.encode_image(prepro)
         # moves image features tensor from GPU to CPU if it is currently on GPU and casts as float.
         emb = image_features.to("cpu").float()
@@ -67,5 +121,11 @@ def generate_embedding(img):
     return emb
 
 
+# The first call to the jit model is much slower than the rest, so run it once before serving requests.
+generate_embedding(Image.new("RGB", (N_PX, N_PX)))
+if os.environ.get("DEFER_BACKGROUND_JOBS") != "1":
+    start_background_jobs()
+
+
 if __name__ == "__main__":
     app.run(debug=True, port=5002)
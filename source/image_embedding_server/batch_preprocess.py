@@ -0,0 +1,66 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+# Normalisation constants used by clip's preprocess transform.
+CLIP_MEAN = torch.tensor([0.48145466, 0.4578275, 0.40821073]).view(1, 3, 1, 1)
+CLIP_STD = torch.tensor([0.26862954, 0.26130258, 0.27577711]).view(1, 3, 1, 1)
+
+
+def resized_shape(height, width, n_px):
+    """_summary_
+    Returns the (height, width) an image is resized to so that its shorter side is n_px, rounding the longer side
+    down in the same way as torchvision's Resize.
+    """
+    if height <= width:
+        return n_px, int(n_px * width / height)
+    return int(n_px * height / width), n_px
+
+
+def preprocess_batch(images, n_px=224, out=None, fallback=None):
+    """_summary_
+    Tensor based equivalent of clip's preprocess transform for a list of decoded images. Each image is resized so that
+    its shorter side is n_px with antialiased bicubic interpolation, rounded to 8 bits like the PIL resize, centre
+    cropped and written straight into the batch buffer. The batch is then scaled and normalised in one operation.
+
+    Args:
+        images (list): uint8 numpy arrays of shape (H, W), (H, W, 3) or (H, W, 4), as returned by cv2.imdecode.
+        n_px (int): Output resolution. 224 for ViT-L/14.
+        out (Tensor): Optional preallocated (N, 3, n_px, n_px) float32 buffer to write the batch into.
+        fallback (function): Optional PIL preprocess transform used for images with a transparent alpha channel,
+                             which PIL resizes with premultiplied alpha.
+
+    Returns:
+        Tensor: (N, 3, n_px, n_px) float32 batch ready for model.encode_image.
+    """
+    batch = out if out is not None else torch.empty((len(images), 3, n_px, n_px), dtype=torch.float32)
+    from_pil = []
+    for i, image in enumerate(images):
+        if image.ndim == 2:
+            image = np.repeat(image[:, :, None], 3, axis=2)
+        elif image.shape[2] == 4:
+            if fallback is not None and image[:, :, 3].min() < 255:
+                from_pil.append(i)
+                continue
+            image = image[:, :, :3]
+
+        height, width = image.shape[:2]
+        new_height, new_width = resized_shape(height, width, n_px)
+        pixels = torch.from_numpy(np.ascontiguousarray(image)).permute(2, 0, 1).unsqueeze(0).float()
+        # PIL resizes horizontally then vertically, rounding to 8 bits after each pass.
+        if new_width != width:
+            pixels = F.interpolate(pixels, size=(height, new_width), mode="bicubic",
+                                   align_corners=False, antialias=True).clamp_(0, 255).round_()
+        if new_height != height:
+            pixels = F.interpolate(pixels, size=(new_height, new_width), mode="bicubic",
+                                   align_corners=False, antialias=True).clamp_(0, 255).round_()
+        top = int(round((new_height - n_px) / 2.0))
+        left = int(round((new_width - n_px) / 2.0))
+        batch[i] = pixels[0, :, top:top + n_px, left:left + n_px]
+
+    batch.div_(255).sub_(CLIP_MEAN).div_(CLIP_STD)
+    # The fallback transform normalises the image itself, so these images are filled in after the batch is normalised.
+    for i in from_pil:
+        batch[i] = fallback(Image.fromarray(images[i]))
+    return batch
@@ -0,0 +1,178 @@
+import base64
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+from batch_preprocess import preprocess_batch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.instrumentation import observe_stage  # noqa: E402
+
+# The clip preprocess transform and preprocessing settings, set in each worker process by _init_worker.
+_preprocess = None
+_backend = "tensor"
+_n_px = 224
+
+
+def _init_worker(preprocess, backend, n_px):
+    """_summary_
+    Runs once in each decode worker process. Workers only decode and preprocess images, so torch is limited to one
+    thread per worker to stop the workers competing with each other and with the model for cores.
+    """
+    global _preprocess, _backend, _n_px
+    _preprocess = preprocess
+    _backend = backend
+    _n_px = n_px
+    torch.set_num_threads(1)
+
+
+def decode_array(raw_content):
+    """_summary_
+    Decodes a base64 encoded image into a numpy array with cv2.imdecode.
+    """
+    decoded_string = base64.b64decode(raw_content)
+    numpy_image = np.frombuffer(decoded_string, dtype=np.uint8)
+    # Decode the image data from the numpy array
+    return cv2.imdecode(numpy_image, cv2.IMREAD_UNCHANGED)
+
+
+def decode_image(raw_content):
+    """_summary_
+    Decodes a base64 encoded image into a PIL image, in the same way as the /get_embedding endpoint always has.
+    """
+    return Image.fromarray(decode_array(raw_content))
+
+
+def decode_and_preprocess(raw_content):
+    """_summary_
+    Runs in a decode worker process. Returns the preprocessed image as a (3, n_px, n_px) float32 numpy array, ready
+    to be stacked into a batch for the model. The "tensor" backend uses preprocess_batch, the "pil" backend uses
+    clip's preprocess transform.
+    """
+    if _backend == "tensor":
+        return preprocess_batch([decode_array(raw_content)], n_px=_n_px, fallback=_preprocess)[0].numpy()
+    return _preprocess(decode_image(raw_content)).numpy()
+
+
+class EmbeddingPipeline:
+    """_summary_
+    Splits embedding generation into two stages. Images are decoded and preprocessed by a pool of worker processes,
+    which sidesteps the GIL, and the ready tensors are put on an inference queue. A single inference thread takes
+    everything waiting on the queue (up to max_batch_size images) and runs it through the model as one batch, so the
+    model never waits for JPEG/PNG decoding.
+    """
+
+    def __init__(self, model, preprocess, device, decode_workers=2, max_batch_size=8, backend="tensor", n_px=224):
+        self.model = model
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.decode_workers = decode_workers
+        self._worker_args = (preprocess, backend, n_px)
+        # Number of times the decode pool was rebuilt after a worker process died.
+        self.pool_restarts = 0
+        self._pool_lock = threading.Lock()
+        # The workers are started before the inference thread, so that they are forked from a single threaded process.
+        self._pool = self._start_pool()
+        self._queue = queue.Queue()
+        threading.Thread(target=self._inference_loop, daemon=True).start()
+
+    def _start_pool(self):
+        """_summary_
+        Creates the decode pool and waits for all of its workers to start. Workers are forked so they inherit the
+        preprocess transform without reloading the clip model (spawned or forkserver workers would import the app
+        module, and with it the model). A fork pool otherwise only forks its workers on the first submit, from a
+        request thread, and forking while other threads hold locks can deadlock the child.
+        """
+        pool = ProcessPoolExecutor(max_workers=self.decode_workers, mp_context=multiprocessing.get_context("fork"),
+                                   initializer=_init_worker, initargs=self._worker_args)
+        for future in [pool.submit(os.getpid) for _ in range(self.decode_workers)]:
+            future.result()
+        return pool
+
+    def _restart_pool(self, broken_pool):
+        """_summary_
+        Replaces a pool that broke because one of its worker processes died, e.g. killed by the OOM killer. Every
+        request waiting on the broken pool sees the failure, so only the first one rebuilds it.
+
+        Returns:
+            ProcessPoolExecutor: the working pool.
+        """
+        with self._pool_lock:
+            if self._pool is broken_pool:
+                print("Decode worker died, restarting the decode pool.")
+                broken_pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = self._start_pool()
+                self.pool_restarts += 1
+            return self._pool
+
+    def submit(self, raw_content):
+        """_summary_
+        Queues a base64 encoded image for embedding. If a decode worker dies, the pool is rebuilt and the image is
+        decoded again once.
+
+        Returns:
+            Future: resolves to the (1, 768) clip image embedding of the image.
+        """
+        result = Future()
+        start = time.perf_counter()
+
+        def decode(retry):
+            pool = self._pool
+            try:
+                future = pool.submit(decode_and_preprocess, raw_content)
+            except BrokenProcessPool:
+                pool = self._restart_pool(pool)
+                future = pool.submit(decode_and_preprocess, raw_content)
+            future.add_done_callback(lambda decode_future: ready(decode_future, pool, retry))
+
+        def ready(decode_future, pool, retry):
+            try:
+                pixels = decode_future.result()
+            except BrokenProcessPool as e:
+                self._restart_pool(pool)
+                if not retry:
+                    result.set_exception(e)
+                    return
+                try:
+                    decode(False)
+                except Exception as retry_error:
+                    result.set_exception(retry_error)
+                return
+            except Exception as e:
+                result.set_exception(e)
+                return
+            # Includes the time spent waiting for a free decode worker.
+            observe_stage("decode_preprocess", time.perf_counter() - start)
+            self._queue.put((pixels, result))
+
+        decode(True)
+        return result
+
+    def _inference_loop(self):
+        while True:
+            items = [self._queue.get()]
+            while len(items) < self.max_batch_size:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                start = time.perf_counter()
+                batch = torch.from_numpy(np.stack([pixels for pixels, _ in items])).to(self.device)
+                with torch.no_grad():
+                    # moves image features tensor from GPU to CPU if it is currently on GPU and casts as float.
+                    features = self.model.encode_image(batch).to("cpu").float()
+                observe_stage("encode", time.perf_counter() - start)
+                for i, (_, result) in enumerate(items):
+                    result.set_result(features[i:i + 1])
+            except Exception as e:
+                for _, result in items:
+                    result.set_exception(e)
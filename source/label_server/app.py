@@ -1,11 +1,17 @@
 from flask import Flask, jsonify, request
 import label
+from result_cache import ResultCache
+from index_store import IndexStore
 from flask_cors import CORS
 from apscheduler.schedulers.background import BackgroundScheduler
 from datetime import datetime
 import base64
 from io import BytesIO
 from PIL import Image, ImageDraw, ImageFont
+import time
+import os
+from common.instrumentation import instrument_app, stage
+from common.profiling import install_profiling
 
 
 app = Flask(__name__)
@@ -13,17 +19,139 @@ app = Flask(__name__)
 # Neccessary to prevent CORS error being thrown.
 # https://stackoverflow.com/questions/28461001/python-flask-cors-issue
 CORS(app)
+# Request timing, request ids and the /metrics endpoint.
+instrument_app(app, "label")
+# Opt-in sampling and per-request profiling, enabled by setting PROFILE_TOKEN.
+install_profiling(app)
+
+# Labelling results are cached so that repeated frames of the same face from a webcam are not relabelled. A request
+# reuses a result if its embedding's cosine similarity to the cached embedding is at least CACHE_MIN_SIMILARITY.
+CACHE_MAX_ENTRIES = 1024
+CACHE_TTL_SECONDS = 10
+CACHE_MIN_SIMILARITY = float(os.environ.get("CACHE_MIN_SIMILARITY", "0.97"))
+# Set CACHE_ENABLED=0 to label every request, e.g. to benchmark the labelling methods themselves.
+CACHE_ENABLED = os.environ.get("CACHE_ENABLED", "1") != "0"
+label_cache = ResultCache(max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL_SECONDS, min_similarity=CACHE_MIN_SIMILARITY)
+
+
+# When INDEX_STORE_DIR is set, the verified image index is built by one process on the host and published to this
+# directory. Every worker maps the published version read-only, so the index is held in memory once per host rather
+# than once per worker. Workers poll for new versions every INDEX_POLL_SECONDS.
+INDEX_STORE_DIR = os.environ.get("INDEX_STORE_DIR")
+INDEX_POLL_SECONDS = int(os.environ.get("INDEX_POLL_SECONDS", "10"))
+index_store = IndexStore(INDEX_STORE_DIR) if INDEX_STORE_DIR else None
+
+
+def sync_index():
+    """_summary_
+    Loads the latest published version of the verified image index, clearing the label cache if it changed.
+    """
+    try:
+        if label.load_published_data(index_store):
+            label_cache.clear()
+    except Exception as e:
+        print(e)
+
+
+def refresh_index(force=False):
+    """_summary_
+    Rebuilds the FAISS index of verified images and clears the label cache, as cached results from methods 2 and 3
+    were calculated against the old index.
+
+    With an index store, only the builder process rebuilds on schedule. force=True publishes a new version from
+    any process (used by the POST / endpoint). Other workers pick up the new version on their next sync_index().
+    """
+    if index_store is None:
+        label.update_data()
+        label_cache.clear()
+        return
+    if force or index_store.try_become_builder():
+        label.publish_data(index_store)
+        sync_index()
+
+
+def cached_labels(method_name, method, embedding, *params, uses_index=False):
+    """_summary_
+    Returns method(embedding, *params), using the label cache where possible. Only successful results are cached.
+    Methods that search the verified images (uses_index=True) are passed the snapshot the cache key was made from,
+    so a refresh during the request cannot store a result under the wrong version.
+    """
+    snapshot = label.verified_images
+    key = label_cache.make_key(method_name, embedding, snapshot.version, *params)
+    result = label_cache.get(key) if CACHE_ENABLED else None
+    if result is None:
+        start = time.perf_counter()
+        with stage(method_name):
+            if uses_index:
+                result = method(embedding, *params, snapshot=snapshot)
+            else:
+                result = method(embedding, *params)
+        if CACHE_ENABLED and result[0] == 'success':
+            label_cache.put(key, result, time.perf_counter() - start)
+    return result
 
 # https://dev.to/brightside/scheduling-tasks-using-apscheduler-in-django-2dbl#:~:text=Setting%20up%20APScheduler%3A%201%20Adding%20something_update.py%20to%20our,4%20Thank%20you%2C%20that%27s%20it%20for%20this%20tutorial.
 scheduler = BackgroundScheduler()
 # In a production environment, the scheduler would be set to run at a time of low usage (3-4am for example).
-scheduler.add_job(label.update_data, 'interval',
-                  minutes=5, start_date=datetime.now())
-scheduler.start()
+# Refreshes swap in a new snapshot without blocking requests, so the interval can be set as low as needed.
+INDEX_REFRESH_SECONDS = int(os.environ.get("INDEX_REFRESH_SECONDS", "300"))
+scheduler.add_job(refresh_index, 'interval',
+                  seconds=INDEX_REFRESH_SECONDS, start_date=datetime.now())
+if index_store is not None:
+    scheduler.add_job(sync_index, 'interval', seconds=INDEX_POLL_SECONDS)
+
+
+def reload_taxonomies():
+    """_summary_
+    Reloads taxonomies.json if it has changed, clearing the label cache if it was reloaded.
+    """
+    if label.taxonomy_registry.reload_if_changed():
+        label_cache.clear()
+
+
+# New and changed taxonomies are picked up without restarting the server.
+TAXONOMY_POLL_SECONDS = int(os.environ.get("TAXONOMY_POLL_SECONDS", "30"))
+scheduler.add_job(reload_taxonomies, 'interval', seconds=TAXONOMY_POLL_SECONDS)
+
+# Set to True by start_background_jobs() once the index has been built and the scheduler is running.
+ready = False
+
+
+def start_background_jobs():
+    """_summary_
+    Starts the scheduler and marks the server as ready. When served by gunicorn with preload (see serve.py), this is
+    called in each worker after it is forked, as threads started in the master process do not survive the fork.
+    """
+    global ready
+    scheduler.start()
+    ready = True
+
 
 # Even though we have set up the scheduler, we need to call update_data() once to populate vi_index and
-# vi_embeddings variable at start up.
-label.update_data()
+# vi_embeddings variable at start up. With an index store, the first process to start publishes a version if none
+# exists yet and every process maps the current version. The builder lock is released after the first publish, as
+# with gunicorn's preload this runs in the master process, which never runs the scheduled refreshes. The workers
+# elect the builder among themselves on their first refresh.
+if index_store is None:
+    label.update_data()
+else:
+    if index_store.current_version() is None and index_store.try_become_builder():
+        label.publish_data(index_store)
+        index_store.release_builder()
+    sync_index()
+if os.environ.get("DEFER_BACKGROUND_JOBS") != "1":
+    start_background_jobs()
+
+
+@app.route('/ready', methods=['GET'])
+def get_ready():
+    """_summary_
+    Readiness check. Returns 200 once the clip text features and the verified image index are loaded and the
+    scheduler is running, else 503.
+    """
+    if ready:
+        return jsonify({'ready': 'True'}), 200
+    return jsonify({'ready': 'False'}), 503
 
 
 @app.route('/', methods=['POST'])
@@ -31,10 +159,19 @@ def reset_index():
     """_summary_
     Updates the FAISS index of verified images in the database. 
     """
-    label.update_data()
+    refresh_index(force=True)
     return jsonify({'message': 'Data updated successfully'}), 204
 
 
+@app.route('/cache_stats', methods=['GET'])
+def get_cache_stats():
+    """_summary_
+    Returns the label cache metrics: number of entries, hits, near duplicate hits, misses, hit rate, evictions, the
+    total labelling time saved by cache hits in seconds and the similarity threshold.
+    """
+    return jsonify(label_cache.stats())
+
+
 @app.route('/label_method_1', methods=['POST'])
 def get_labels_method_1():
     """_summary_
@@ -53,7 +190,7 @@ def get_labels_method_1():
     try:
         request_data = request.get_json()
         embedding = request_data.get('embedding')
-        status, detected_labels = label.label_method_1(embedding)
+        status, detected_labels = cached_labels('method_1', label.label_method_1, embedding)
         # print("detected labels: " + str(detected_labels))
         if status == 'success':
             return jsonify({'success': 'True', 'labels': detected_labels})
@@ -65,17 +202,38 @@ def get_labels_method_1():
         return jsonify({'success': 'False', 'msg': "Internal server error."})
 
 
+def parse_neighbours(value):
+    """_summary_
+    Returns the number of method 2 neighbours requested, clamped to between 1 and the smaller of the number of
+    verified images and METHOD_2_MAX_NEIGHBOURS, or None if value is not a positive whole number.
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        return None
+    try:
+        neighbours = int(value)
+    except ValueError:
+        return None
+    if neighbours < 1:
+        return None
+    return max(1, min(neighbours, label.verified_images.index.ntotal, label.METHOD_2_MAX_NEIGHBOURS))
+
+
 @app.route('/label_method_2', methods=['POST'])
 def get_labels_method_2():
     """_summary_
     This function is called when a request is made to /label_method_2 endpoint.
     This labelleling method attempts to correct predictions and improve accuracy by comparing the predicted label 
-    to the predictions of the 3 closest images in the database.
+    to the predictions of the 3 closest images in the database. The number of neighbours can be changed by passing
+    "neighbours" in the request, up to METHOD_2_MAX_NEIGHBOURS.
     """
     try:
         request_data = request.get_json()
         embedding = request_data.get('embedding')
-        status, detected_labels = label.label_method_2(embedding)
+        neighbours = parse_neighbours(request_data.get('neighbours', label.METHOD_2_NEIGHBOURS))
+        if neighbours is None:
+            return jsonify({'success': 'False', 'msg': "neighbours must be a whole number greater than 0."}), 400
+        status, detected_labels = cached_labels('method_2', label.label_method_2, embedding, neighbours,
+                                                uses_index=True)
         # print("detected labels: " + str(detected_labels))
         if status == 'success':
             return jsonify({'success': 'True', 'labels': detected_labels})
@@ -98,7 +256,7 @@ def get_labels_method_3():
     try:
         request_data = request.get_json()
         embedding = request_data.get('embedding')
-        status, detected_labels = label.label_method_3(embedding)
+        status, detected_labels = cached_labels('method_3', label.label_method_3, embedding, uses_index=True)
         # print("detected labels: " + str(detected_labels))
 
         if status == 'success':
@@ -120,7 +278,7 @@ def get_labels_method_4():
     try:
         request_data = request.get_json()
         embedding = request_data.get('embedding')
-        status, detected_labels = label.label_method_4(embedding)
+        status, detected_labels = cached_labels('method_4', label.label_method_4, embedding)
         # print("detected labels: " + str(detected_labels))
 
         if status == 'success':
@@ -133,6 +291,132 @@ def get_labels_method_4():
         return jsonify({'success': 'False', 'msg': "Internal server error."})
 
 
+@app.route('/label_method_5', methods=['POST'])
+def get_labels_method_5():
+    """_summary_
+    This function is called when a request is made to /label_method_5 endpoint.
+    This labelling method is similar to label_method_1, but scores each label with an ensemble of prompts.
+    """
+    try:
+        request_data = request.get_json()
+        embedding = request_data.get('embedding')
+        status, detected_labels = cached_labels('method_5', label.label_method_5, embedding)
+
+        if status == 'success':
+            return jsonify({'success': 'True', 'labels': detected_labels})
+        else:
+            return jsonify({'success': 'False', 'msg': "Error in retrieving labels"})
+
+    except Exception as e:
+        print(e)
+        return jsonify({'success': 'False', 'msg': "Internal server error."})
+
+
+@app.route('/taxonomies', methods=['GET'])
+def get_taxonomies():
+    """_summary_
+    Returns the loaded taxonomies and their labels.
+    """
+    state = label.taxonomy_registry.state
+    return jsonify({name: taxonomy.labels for name, taxonomy in state.taxonomies.items()})
+
+
+@app.route('/taxonomies', methods=['POST'])
+def post_taxonomies():
+    """_summary_
+    Reloads taxonomies.json. New and changed taxonomies are built, the others are reused.
+    """
+    try:
+        built = label.taxonomy_registry.reload()
+        label_cache.clear()
+        return jsonify({'success': 'True', 'built': built,
+                        'taxonomies': list(label.taxonomy_registry.state.taxonomies)})
+    except Exception as e:
+        print(e)
+        return jsonify({'success': 'False', 'msg': "Error loading taxonomies"})
+
+
+@app.route('/label_taxonomies', methods=['POST'])
+def get_labels_taxonomies():
+    """_summary_
+    This function is called when a request is made to /label_taxonomies endpoint.
+    Labels the embedding with the taxonomies listed in "taxonomies" in the request, or with every taxonomy if it is
+    not given. The labels are returned as a {taxonomy: label} dictionary.
+    """
+    try:
+        request_data = request.get_json()
+        embedding = request_data.get('embedding')
+        names = request_data.get('taxonomies')
+        status, detected_labels = cached_labels('taxonomies', label.label_taxonomies, embedding, names)
+
+        if status == 'success':
+            return jsonify({'success': 'True', 'labels': detected_labels})
+        else:
+            return jsonify({'success': 'False', 'msg': detected_labels})
+
+    except Exception as e:
+        print(e)
+        return jsonify({'success': 'False', 'msg': "Internal server error."})
+
+
+# Output of /draw_labels when the request does not ask for one. "png", "jpeg" and "webp" return the image with the
+# faces drawn on it, "overlay" returns only the position of each box and label, for the browser to draw over the frame
+# it already has. PNG is lossless but several times slower to encode, and larger, than JPEG or WebP for camera frames.
+DRAW_LABELS_FORMAT = os.environ.get("DRAW_LABELS_FORMAT", "jpeg")
+# JPEG and WebP quality, 1-100.
+DRAW_LABELS_QUALITY = int(os.environ.get("DRAW_LABELS_QUALITY", "80"))
+DRAW_LABELS_FORMATS = {"png": ("PNG", "image/png"), "jpeg": ("JPEG", "image/jpeg"), "webp": ("WEBP", "image/webp")}
+# Font of the "Face N" labels. Pillow's default font is used if LABEL_FONT cannot be loaded.
+LABEL_FONT = os.environ.get("LABEL_FONT", "arial.ttf")
+LABEL_FONT_SIZE = int(os.environ.get("LABEL_FONT_SIZE", "16"))
+
+
+def load_label_font():
+    """_summary_
+    Loads the label font. Called once when the app starts rather than for every face.
+    """
+    try:
+        return ImageFont.truetype(LABEL_FONT, LABEL_FONT_SIZE)
+    except OSError:
+        print("Unable to load " + LABEL_FONT + ", using the default font.")
+        try:
+            return ImageFont.load_default(size=LABEL_FONT_SIZE)
+        except TypeError:
+            # Pillow < 10.1 only has a fixed size bitmap default font.
+            return ImageFont.load_default()
+
+
+label_font = load_label_font()
+
+
+def face_overlay(count, regions, font=label_font):
+    """_summary_
+    Returns where the box and "Face N" label of a face are drawn.
+
+    Args:
+        count (int): Number of the face, starting at 1.
+        regions (list): [x, y, w, h] of the face. x,y = cordinates of the top left corner of the rectangle.
+
+    Returns:
+        dict: "name", "box" ([x, y, w, h]), "text", and "text_position" ([x, y] of the top left of the label, or None
+              if there is no room for the label).
+    """
+    x, y, w, h = regions
+    text = "Face "+str(count)
+    # get label size as (Width, height).
+    left, top, right, bottom = font.getbbox(text)
+    label_size = (right - left, bottom - top)
+    # Check of there is enough space above the image to tag the face
+    if y-label_size[1] > label_size[1]:
+        text_position = [x, y-25]
+    # Check if there is enough space below the image to add the label
+    elif y+h+label_size[1] > label_size[1]:
+        text_position = [x, y+h+(label_size[1]/2)]
+    else:
+        text_position = None
+    return {"name": "face_"+str(count), "box": [x, y, w, h], "text": text, "text_position": text_position}
+
+
 # https://www.geeksforgeeks.org/python-pil-imagedraw-draw-rectangle/
 @app.route("/draw_labels", methods=['POST'])
 def draw_Labels():
@@ -141,72 +425,72 @@ def draw_Labels():
     The function expects an image in the request and regional co-ordinates of all faces in the image. 
 
     Returns the image with each face bordered and labelled sequentially "Face 1", "Face 2" etc.
+
+    The request can set "format" to "png", "jpeg" or "webp" (DRAW_LABELS_FORMAT by default) and "quality" for JPEG and
+    WebP (DRAW_LABELS_QUALITY by default). The response's "mime" is the image type, for building a data URL. With
+    "format": "overlay" the image is not needed, decoded or returned, and the response's "overlay" lists the box and
+    label of each face for the client to draw.
     """
     try:
         data = request.get_json()
         if not data:
             raise ValueError('No data received')
-        # print(data['face_data'])
+        face_data = data.get('face_data')
+        if not face_data:
+            raise ValueError('No face data provided')
+        output_format = str(data.get('format') or DRAW_LABELS_FORMAT).lower()
+        if output_format != "overlay" and output_format not in DRAW_LABELS_FORMATS:
+            raise ValueError('Unsupported format ' + output_format)
+        quality = int(data.get('quality') or DRAW_LABELS_QUALITY)
+
+        overlay = []
+        for count, item in enumerate(face_data, start=1):
+            face = face_overlay(count, item['regions'])
+            item['name'] = face['name']
+            overlay.append(face)
+
+        if output_format == "overlay":
+            return jsonify({'success': 'True', 'format': 'overlay', 'overlay': overlay, 'face_data': face_data})
+
         # Create Image object from origional image
-        raw_content = data["img"]
+        raw_content = data.get("img")
         if not raw_content:
             raise ValueError('No image data provided')
 
-        decoded_string = base64.b64decode(raw_content[22:])
-        image_bytes = BytesIO(decoded_string)
-        image = Image.open(image_bytes)
+        with stage("decode"):
+            decoded_string = base64.b64decode(raw_content[22:])
+            image_bytes = BytesIO(decoded_string)
+            image = Image.open(image_bytes)
+            image.load()
+            if output_format == "jpeg" and image.mode != "RGB":
+                # JPEG has no alpha channel, and the browser sends PNG screenshots as RGBA.
+                image = image.convert("RGB")
         # create drawing context
         draw = ImageDraw.Draw(image)
-        face_data = data['face_data']
-
-        if not face_data:
-            raise ValueError('No face data provided')
 
-        count = 1
-        # For each face in the image, get the labels and draw over original image
-        for item in face_data:
-            labels = item['labels']
-            regions = item['regions']
-            x, y, w, h = regions
-            font = ImageFont.truetype('arial.ttf', 16)
-            item['name'] = "face_"+str(count)
-            # Draw Boxes
-            # x,y = cordinates of the top left corner of the rectangle. w = width and h = height.
-            draw.rectangle((x, y, x+w, y+h), outline=(255, 0, 0), width=2)
-            # Draw labels
-            # x,y = cordinates of the top left corner of the rectangle. w = width and h = height.
-            # label_1
-            # get label size. Returns tuple of (Width, height)
-            label_Size = draw.textsize("Face "+str(count), font=font)
-            # print(label_Size)
-            # get the centre points rectangle height and width.
-            # x_centre = x+(w/2)
-            # y_centre = y+(h/2)
-            # Check of there is enough space above the image to tag the face
-            if y-label_Size[1] > label_Size[1]:
-                draw.text((x, y-25), "Face "+str(count),
-                          font=font, fill=(255, 255, 255))
-            # Check if there is enough space below the image to add the label
-            elif y+h+label_Size[1] > label_Size[1]:
-                draw.text((x, y+h+(label_Size[1]/2)), "Face "+str(count),
-                          font=font, fill=(255, 255, 255))
-            count = count + 1
-            # draw.text((x-20, y+h+20), labels[1], font=font, fill=(255, 255, 255))
-            # draw.text((x+w+20, y+h+20), labels[2], font=font, fill=(255, 255, 255))
-            # draw.line((x-50, y+h+10, x, y), fill=(255, 255, 255), width=2)
-            # draw.line((x+w+50, y+h+10, x+w, y), fill=(255, 255, 255), width=2)
-
-        new_image_arr = BytesIO()
-        image.save(new_image_arr, format='PNG')
-        # image.show()
-        new_encoded_image = base64.encodebytes(
-            new_image_arr.getvalue()).decode('ascii)')
+        with stage("draw"):
+            # For each face in the image, draw the box and label over original image
+            for face in overlay:
+                x, y, w, h = face['box']
+                draw.rectangle((x, y, x+w, y+h), outline=(255, 0, 0), width=2)
+                if face['text_position'] is not None:
+                    draw.text(tuple(face['text_position']), face['text'], font=label_font, fill=(255, 255, 255))
+
+        with stage("encode"):
+            pil_format, mime = DRAW_LABELS_FORMATS[output_format]
+            new_image_arr = BytesIO()
+            if pil_format == "PNG":
+                image.save(new_image_arr, format=pil_format)
+            else:
+                image.save(new_image_arr, format=pil_format, quality=quality)
+            new_encoded_image = base64.b64encode(new_image_arr.getvalue()).decode('ascii')
 
         new_image_arr.close()
         image.close()
         image_bytes.close()
 
-        return jsonify({'success': 'True', 'image_url': new_encoded_image, 'face_data': face_data})
+        return jsonify({'success': 'True', 'image_url': new_encoded_image, 'format': output_format, 'mime': mime,
+                        'face_data': face_data})
 
     except ValueError as e:
         return jsonify({'success': False, 'error': str(e)})
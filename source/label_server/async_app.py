@@ -0,0 +1,182 @@
+"""
+Asynchronous (ASGI) variant of the label server API, for clients that hold many concurrent connections open, such as
+cameras streaming frames.
+
+Request parsing and responses are handled on the event loop, so an open connection costs a coroutine rather than a
+thread. The CPU bound labelling (FAISS search and CLIP scoring) runs in a dedicated thread pool sized to the number of
+cores. FAISS and torch release the GIL while they work, so the pool uses every core while sharing one copy of the
+model and index.
+
+The labelling endpoints, label cache and index refresh are shared with the Flask server in app.py, and requests are
+validated in the same way. The API is the Flask server's without /draw_labels, which decodes and encodes whole
+frames and is left to the Flask server; streaming clients can draw the overlays themselves (see /processimage's
+"overlay" mode). /metrics reports the stage timings and cache of this process, but not per request timings.
+
+Usage:
+    python async_app.py
+    python serve.py label_async --workers 1
+"""
+import asyncio
+import contextlib
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.routing import Route
+import uvicorn
+import label
+import app as label_api
+# label.py adds the source folder to the path.
+from common.threads import cores_per_worker
+from common.instrumentation import registry
+
+# Number of threads labelling requests at the same time. Defaults to the number of cores available to this worker.
+# label.py limits torch and FAISS to one thread per request.
+LABEL_EXECUTOR_WORKERS = int(os.environ.get("LABEL_EXECUTOR_WORKERS", cores_per_worker()))
+label_executor = ThreadPoolExecutor(max_workers=LABEL_EXECUTOR_WORKERS, thread_name_prefix="label")
+
+
+def start_background_jobs():
+    """_summary_
+    Starts the label server's scheduler if the Flask module has not already started it. Called by the gunicorn
+    post_fork hook when served with preload (see serve.py).
+    """
+    if not label_api.ready:
+        label_api.start_background_jobs()
+
+
+def label_endpoint(method_name, method, uses_index=False, params=()):
+    """_summary_
+    Returns an endpoint that labels the "embedding" in the request with method, in the label executor. The
+    responses are the same as the Flask endpoints.
+
+    Args:
+        method_name (str): Name used for the label cache.
+        method (function): Labelling function from label.py.
+        uses_index (bool): Whether the method searches the verified images.
+        params (tuple): (name, default) or (name, default, parse, error) of extra request fields passed to the
+                        method. parse converts the field, returning None if it is invalid, in which case the
+                        endpoint returns a 400 with the error message.
+    """
+    async def endpoint(request):
+        try:
+            request_data = await request.json()
+            embedding = request_data.get('embedding')
+            values = []
+            for name, default, *validation in params:
+                value = request_data.get(name, default)
+                if validation:
+                    parse, error = validation
+                    value = parse(value)
+                    if value is None:
+                        return JSONResponse({'success': 'False', 'msg': error}, status_code=400)
+                values.append(value)
+            loop = asyncio.get_running_loop()
+            status, detected_labels = await loop.run_in_executor(
+                label_executor, functools.partial(label_api.cached_labels, method_name, method, embedding, *values,
+                                                  uses_index=uses_index))
+            if status == 'success':
+                return JSONResponse({'success': 'True', 'labels': detected_labels})
+            else:
+                return JSONResponse({'success': 'False', 'msg': "Error in retrieving labels"})
+
+        except Exception as e:
+            print(e)
+            return JSONResponse({'success': 'False', 'msg': "Internal server error."})
+
+    return endpoint
+
+
+async def get_ready(request):
+    """_summary_
+    Readiness check. Returns 200 once the verified image index is loaded and the scheduler is running, else 503.
+    """
+    if label_api.ready:
+        return JSONResponse({'ready': 'True'}, status_code=200)
+    return JSONResponse({'ready': 'False'}, status_code=503)
+
+
+async def reset_index(request):
+    """_summary_
+    Updates the FAISS index of verified images in the database. The index is built on the default executor, so
+    labelling continues against the current index while it is built.
+    """
+    await asyncio.get_running_loop().run_in_executor(None, label_api.refresh_index, True)
+    return Response(status_code=204)
+
+
+async def get_cache_stats(request):
+    """_summary_
+    Returns the label cache metrics. See the /cache_stats endpoint in app.py.
+    """
+    return JSONResponse(label_api.label_cache.stats())
+
+
+async def get_taxonomies(request):
+    """_summary_
+    Returns the loaded taxonomies and their labels. See the GET /taxonomies endpoint in app.py.
+    """
+    state = label.taxonomy_registry.state
+    return JSONResponse({name: taxonomy.labels for name, taxonomy in state.taxonomies.items()})
+
+
+async def reload_taxonomies(request):
+    """_summary_
+    Reloads taxonomies.json, on the default executor. See the POST /taxonomies endpoint in app.py.
+    """
+    try:
+        built = await asyncio.get_running_loop().run_in_executor(None, label.taxonomy_registry.reload)
+        label_api.label_cache.clear()
+        return JSONResponse({'success': 'True', 'built': built,
+                             'taxonomies': list(label.taxonomy_registry.state.taxonomies)})
+    except Exception as e:
+        print(e)
+        return JSONResponse({'success': 'False', 'msg': "Error loading taxonomies"})
+
+
+async def get_metrics(request):
+    """_summary_
+    Returns the metrics of this process in the Prometheus text format.
+    """
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    start_background_jobs()
+    yield
+    label_executor.shutdown(wait=False)
+
+
+app = Starlette(
+    routes=[
+        Route('/ready', get_ready, methods=['GET']),
+        Route('/', reset_index, methods=['POST']),
+        Route('/cache_stats', get_cache_stats, methods=['GET']),
+        Route('/metrics', get_metrics, methods=['GET']),
+        Route('/taxonomies', get_taxonomies, methods=['GET']),
+        Route('/taxonomies', reload_taxonomies, methods=['POST']),
+        Route('/label_method_1', label_endpoint('method_1', label.label_method_1), methods=['POST']),
+        Route('/label_method_2', label_endpoint('method_2', label.label_method_2, uses_index=True,
+                                                params=(('neighbours', label.METHOD_2_NEIGHBOURS,
+                                                         label_api.parse_neighbours,
+                                                         "neighbours must be a whole number greater than 0."),)),
+              methods=['POST']),
+        Route('/label_method_3', label_endpoint('method_3', label.label_method_3, uses_index=True), methods=['POST']),
+        Route('/label_method_4', label_endpoint('method_4', label.label_method_4), methods=['POST']),
+        Route('/label_method_5', label_endpoint('method_5', label.label_method_5), methods=['POST']),
+        Route('/label_taxonomies', label_endpoint('taxonomies', label.label_taxonomies,
+                                                  params=(('taxonomies', None),)), methods=['POST']),
+    ],
+    # Neccessary to prevent CORS error being thrown, as in app.py.
+    middleware=[Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])],
+    lifespan=lifespan,
+)
+
+
+if __name__ == "__main__":
+    # A large backlog lets many clients connect at once without being refused.
+    uvicorn.run(app, host="127.0.0.1", port=5004, backlog=4096)
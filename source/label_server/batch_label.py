@@ -0,0 +1,153 @@
+"""
+Batched versions of the labelling methods in label.py, for labelling many embeddings in-process.
+
+Each function takes an (n, 768) array of clip image embeddings and returns a list of n [age, gender, race] labels,
+the same labels the single embedding method in label.py returns for each row. Methods 1, 2, 4 and 5 are scored with
+one matrix multiplication for the whole batch, and method 3 with one FAISS search per chunk of rows.
+"""
+import math
+import os
+import numpy as np
+import torch
+import torch.nn.functional as F
+import label
+
+# Method 1 scores the image against the label features without normalising them, so the batch scores use the raw
+# features, in the same order as method_2_labels.
+method_1_label_features = torch.cat(
+    [label.age_label_features, label.gender_label_features, label.race_label_features]).float()
+
+# Maximum rows of each method 3 search.
+METHOD_3_CHUNK_SIZE = 32
+# Memory each method 3 chunk may use. Every row of a chunk ranks all the verified images, which takes about
+# METHOD_3_BYTES_PER_NEIGHBOUR bytes per verified image: the FAISS distances and ids, and the votes and their
+# cumulative sum for every label. Chunks are made smaller as the verified set grows, down to one row.
+METHOD_3_CHUNK_BYTES = int(os.environ.get("METHOD_3_CHUNK_BYTES", str(256 * 2 ** 20)))
+METHOD_3_BYTES_PER_NEIGHBOUR = 12 + 5 * len(label.method_2_labels)
+
+
+def _image_features(embeddings):
+    emb = torch.from_numpy(np.ascontiguousarray(embeddings, dtype=np.float32).reshape(-1, 768))
+    return F.normalize(emb, p=2, dim=1).to(label.device)
+
+
+def _attribute_labels(similarity):
+    """_summary_
+    Returns the best [age, gender, race] labels of each row of an (n, len(method_2_labels)) similarity tensor.
+    Labels whose score is -inf are reported as "No Label Identified".
+    """
+    similarity = torch.cat([similarity.cpu(), torch.full((similarity.shape[0], 1), -math.inf)], dim=1)
+    values, indices = similarity[:, label.method_2_label_matrix].max(dim=2)
+    results = []
+    for row_values, row_indices in zip(values.tolist(), indices.tolist()):
+        results.append([attribute[index] if not math.isinf(value) else "No Label Identified"
+                        for attribute, value, index in zip(label.method_2_attributes, row_values, row_indices)])
+    return results
+
+
+def label_method_1_batch(embeddings):
+    """_summary_
+    Batched label_method_1.
+    """
+    with torch.no_grad():
+        return _attribute_labels(_image_features(embeddings) @ method_1_label_features.T)
+
+
+def label_method_2_batch(embeddings, neighbours=label.METHOD_2_NEIGHBOURS, snapshot=None):
+    """_summary_
+    Batched label_method_2. The nearest neighbours of every row are found with one FAISS search.
+    """
+    if snapshot is None:
+        snapshot = label.verified_images
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32).reshape(-1, 768)
+    excluded = np.zeros((len(embeddings), len(label.method_2_labels)), dtype=bool)
+    if snapshot.index.ntotal > 0:
+        _, I = snapshot.index.search(embeddings, int(neighbours))
+        # FAISS pads the result with -1 if there are fewer images than neighbours.
+        masks = snapshot.lookup.incorrect_mask[np.maximum(I, 0)] & (I >= 0)[:, :, None]
+        excluded = masks.any(axis=1)
+    with torch.no_grad():
+        similarity = (_image_features(embeddings) @ label.method_2_label_features.T).cpu()
+    similarity[torch.from_numpy(excluded)] = -math.inf
+    return _attribute_labels(similarity)
+
+
+def method_3_chunk_size(total):
+    """_summary_
+    Returns the number of rows of each method 3 search against total verified images.
+    """
+    return max(1, min(METHOD_3_CHUNK_SIZE, METHOD_3_CHUNK_BYTES // (total * METHOD_3_BYTES_PER_NEIGHBOUR)))
+
+
+def label_method_3_batch(embeddings, snapshot=None):
+    """_summary_
+    Batched label_method_3. The neighbours of every row are ranked with one FAISS search, and the vote counts of every
+    label are accumulated along the ranking with a cumulative sum, so the label that first reaches n votes is found
+    without looping over the neighbours in Python.
+    """
+    if snapshot is None:
+        snapshot = label.verified_images
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32).reshape(-1, 768)
+    total = snapshot.index.ntotal
+    if total == 0:
+        # As label_method_3, method 1 labels the images until there are verified images.
+        return label_method_1_batch(embeddings)
+    n = round(math.sqrt(total))
+    chunk_size = method_3_chunk_size(total)
+    results = []
+    for start in range(0, len(embeddings), chunk_size):
+        _, I = snapshot.index.search(embeddings[start:start + chunk_size], total)
+        I = np.maximum(I, 0)
+        # label_method_3 stops with "No Label Identified" at a neighbour that has no verified image.
+        missing = snapshot.lookup.doc_ids[I] == ""
+        first_missing = np.where(missing.any(axis=1), missing.argmax(axis=1), total)
+        reached = np.cumsum(snapshot.lookup.verified_mask[I], axis=1, dtype=np.int32) >= n
+        first_reached = np.where(reached.any(axis=1), reached.argmax(axis=1), total)
+        for row in range(len(I)):
+            labels = []
+            offset = 0
+            for attribute in label.method_2_attributes:
+                positions = first_reached[row, offset:offset + len(attribute)]
+                offset += len(attribute)
+                # Ties go to the first label, as label_method_3 checks the labels in order.
+                best = int(np.argmin(positions))
+                if positions[best] >= total or first_missing[row] <= positions[best]:
+                    labels.append("No Label Identified")
+                else:
+                    labels.append(attribute[best])
+            results.append(labels)
+    return results
+
+
+def label_method_4_batch(embeddings):
+    """_summary_
+    Batched label_method_4. The marginals of every row are computed from one (n, age, race, gender) grid.
+    """
+    with torch.no_grad():
+        logits = (100.0 * _image_features(embeddings) @ label.sentence_features.T).float().cpu()
+    grid = logits[:, label.method_4_grid_order].reshape((-1,) + label.method_4_shape)
+    codes = []
+    for axis in range(1, grid.dim()):
+        other_axes = [i for i in range(1, grid.dim()) if i != axis]
+        codes.append(torch.logsumexp(grid, dim=other_axes).argmax(dim=1).tolist())
+    results = []
+    for age, race, gender in zip(*codes):
+        results.append([label.age_labels[age], label.gender_labels[gender], label.race_labels[race]])
+    return results
+
+
+def label_method_5_batch(embeddings):
+    """_summary_
+    Batched label_method_5.
+    """
+    with torch.no_grad():
+        return _attribute_labels(_image_features(embeddings) @ label.method_5_label_features.T)
+
+
+BATCH_METHODS = {
+    "method_1": label_method_1_batch,
+    "method_2": label_method_2_batch,
+    "method_3": label_method_3_batch,
+    "method_4": label_method_4_batch,
+    "method_5": label_method_5_batch,
+}
@@ -0,0 +1,38 @@
+"""
+Builds the prompt ensemble cache used by label method 5 ahead of time, so the label server does not have to build it
+at start up. Loads the clip model through label.py, so the cache is built with the same model, tokenizer and device
+as the label server.
+
+Usage:
+    python build_prompt_cache.py            builds the cache if it is missing
+    python build_prompt_cache.py --force    rebuilds it
+"""
+import argparse
+import json
+import prompt_ensembles
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--force", action="store_true", help="Rebuild the cache even if it exists.")
+    args = parser.parse_args()
+
+    # Importing label loads the model and builds the cache if it is missing, in which case it is already fresh.
+    import label
+    if args.force and not label.method_5_built:
+        features = prompt_ensembles.build_ensemble_features(label.model, label.clip.tokenize, label.device,
+                                                            label.method_2_attributes, label.method_5_templates)
+        prompt_ensembles.save_ensemble_features(label.method_5_version, features, label.CLIP_MODEL,
+                                                label.method_2_attributes, label.method_5_templates)
+    print(json.dumps({
+        "version": label.method_5_version,
+        "model": label.CLIP_MODEL,
+        "path": prompt_ensembles.cache_path(label.method_5_version),
+        "labels": len(label.method_2_labels),
+        "prompts": sum(len(labels) * len(templates)
+                       for labels, templates in zip(label.method_2_attributes, label.method_5_templates)),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Labels a directory of clip image embeddings (one <image name>.npy file per image, as in "Test Data Files/test_N") or a
+packed embedding store (see common/embedding_store.py) in process, compares the labels with the FairFace ground truth and writes the results to a CSV or Parquet file.
+
+The embeddings are loaded into one matrix and labelled in batches with the methods in batch_label.py, and the ground
+truth CSV is read once into a dictionary, so a 200 image fold takes a fraction of a second. The ground truth of a
+packed store is read from its "labels" metadata if no CSV is given.
+
+Usage:
+    python bulk_label.py "../../Test Data Files/test_1" --method method_1 --labels fairface_label_train.csv
+    python bulk_label.py "../../Test Data Files/test_1" --method method_2 --output results.parquet
+
+Methods 2 and 3 search the verified images, which are loaded from the database first.
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.embedding_store import EmbeddingStore, is_store, load_fairface_labels  # noqa: E402
+
+ATTRIBUTES = ["age", "gender", "race"]
+
+
+def load_embedding_dir(path):
+    """_summary_
+    Loads every .npy file in a directory, or every row of a packed embedding store, into one (n, 768) float32 matrix.
+
+    Returns:
+        list: Image names (the file names without ".npy", or the store ids), in the same order as the matrix rows.
+        NumpyArray: The embeddings.
+        dict: {image name: labels} from the store metadata, empty for a directory.
+    """
+    if is_store(path):
+        store = EmbeddingStore(path)
+        records = store.records()
+        labels = {record["id"]: record["labels"] for record in records if "labels" in record}
+        return [record["id"] for record in records], store.embeddings(), labels
+    files = sorted(file for file in os.listdir(path) if file.endswith(".npy"))
+    embeddings = np.empty((len(files), 768), dtype=np.float32)
+    for i, file in enumerate(files):
+        embeddings[i] = np.load(os.path.join(path, file)).reshape(-1)
+    return [file[:-4] for file in files], embeddings, {}
+
+
+def label_embeddings(method, embeddings, batch_size=1024):
+    """_summary_
+    Labels the rows of an embedding matrix with one of the methods in batch_label.BATCH_METHODS.
+    """
+    import batch_label
+    labels = []
+    for start in range(0, len(embeddings), batch_size):
+        labels += batch_label.BATCH_METHODS[method](embeddings[start:start + batch_size])
+    return labels
+
+
+def build_rows(names, labels, method, ground_truth=None):
+    """_summary_
+    Returns one result dictionary per image, with the predicted labels and, if the image is in ground_truth, the
+    true labels and whether each prediction is correct.
+    """
+    rows = []
+    for name, predicted in zip(names, labels):
+        row = {"image": name, "method": method}
+        truth = ground_truth.get(name) if ground_truth else None
+        for i, (attribute, value) in enumerate(zip(ATTRIBUTES, predicted)):
+            row["predicted_" + attribute] = value
+            row["true_" + attribute] = truth[i] if truth else ""
+            row["correct_" + attribute] = (value == truth[i]) if truth else ""
+        rows.append(row)
+    return rows
+
+
+def summarise_rows(rows):
+    """_summary_
+    Returns the accuracy of each attribute and overall, over the rows that have ground truth.
+    """
+    scored = [row for row in rows if row["true_age"] != ""]
+    summary = {"images": len(rows), "with_ground_truth": len(scored)}
+    if scored:
+        for attribute in ATTRIBUTES:
+            summary[attribute + "_accuracy"] = sum(row["correct_" + attribute] for row in scored) / len(scored)
+        summary["accuracy"] = sum(row["correct_" + attribute] for row in scored
+                                  for attribute in ATTRIBUTES) / (len(scored) * len(ATTRIBUTES))
+    return summary
+
+
+def write_rows(rows, output):
+    """_summary_
+    Writes the rows to a CSV file, or a Parquet file if output ends with ".parquet" (requires pandas and pyarrow).
+    """
+    if output.endswith(".parquet"):
+        import pandas as pd
+        pd.DataFrame(rows).to_parquet(output, index=False)
+        return
+    with open(output, "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=list(rows[0]) if rows else ["image"])
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory", help="Directory of <image name>.npy embedding files, or a packed store.")
+    parser.add_argument("--method", default="method_1",
+                        choices=["method_1", "method_2", "method_3", "method_4", "method_5"])
+    parser.add_argument("--labels", help="FairFace label CSV with the ground truth.")
+    parser.add_argument("--output", default="labels.csv", help="Output .csv or .parquet file.")
+    parser.add_argument("--batch-size", type=int, default=1024)
+    args = parser.parse_args()
+
+    # Importing label loads the clip model, so it is done after the arguments are checked.
+    import label
+    if args.method in ("method_2", "method_3"):
+        label.update_data()
+
+    start = time.perf_counter()
+    names, embeddings, ground_truth = load_embedding_dir(args.directory)
+    if args.labels:
+        ground_truth = load_fairface_labels(args.labels)
+    loaded = time.perf_counter()
+    labels = label_embeddings(args.method, embeddings, args.batch_size)
+    labelled = time.perf_counter()
+    rows = build_rows(names, labels, args.method, ground_truth)
+    write_rows(rows, args.output)
+
+    summary = summarise_rows(rows)
+    summary.update({"method": args.method, "output": args.output,
+                    "load_seconds": loaded - start, "label_seconds": labelled - loaded,
+                    "total_seconds": time.perf_counter() - start})
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""
+Evaluates the labelling methods the way Scripts/Experimentation_Script.ipynb does, without the database or the label
+server, and writes the results in the layout of the spreadsheets in Results/.
+
+In the notebook, each run ("Fold N" in Results/) clears the database, shuffles the test batches (Test Data Files/
+test_1 to test_40) and labels them in order through the label server. Every labelled image is inserted into the
+database as a verified image, with its ground truth as its verified labels and its wrong predictions as its incorrect
+labels, so methods 2 and 3 are evaluated against a verified set that grows as the run goes on.
+
+Here the verified set is simulated in memory: each run starts from an empty index, and after each batch is labelled
+its images are appended to a local FAISS index and label table. Runs are seeded, so results are deterministic, and
+every (method, run) pair is evaluated in its own process.
+
+Usage:
+    python evaluate_folds.py "../../Test Data Files" --labels fairface_label_train.csv --methods method_1 method_2
+    python evaluate_folds.py "../../Test Data Files" --runs 5 --output results.json --excel ../../Results/new
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import statistics
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import faiss
+import numpy as np
+from bulk_label import load_embedding_dir, load_fairface_labels
+from index_store import LabelTable
+
+# The batches, loaded once in the main process and shared with the worker processes when they are forked.
+# Each batch is (name, image names, embeddings, ground truth labels).
+_batches = []
+
+
+def load_batches(directory, ground_truth=None):
+    """_summary_
+    Loads every batch directory (or packed store) in directory. Only images with ground truth are kept.
+    """
+    batches = []
+    names = [name for name in os.listdir(directory) if os.path.isdir(os.path.join(directory, name))]
+    # Natural sort, so test_2 comes before test_10.
+    names.sort(key=lambda name: [int(part) if part.isdigit() else part for part in name.replace("_", " ").split()])
+    for name in names:
+        images, embeddings, labels = load_embedding_dir(os.path.join(directory, name))
+        if ground_truth:
+            labels = ground_truth
+        keep = [i for i, image in enumerate(images) if image in labels]
+        batches.append((name, [images[i] for i in keep], embeddings[keep], [list(labels[images[i]]) for i in keep]))
+    return batches
+
+
+def empty_verified_images(label):
+    return label.VerifiedImages(np.empty((0, 768), dtype=np.float32), faiss.IndexIDMap(faiss.IndexFlatL2(768)),
+                                LabelTable.from_records([], [], label.method_2_labels), 0)
+
+
+def append_verified_images(label, snapshot, embeddings, records):
+    """_summary_
+    Returns a snapshot with the given images appended to the verified set. The FAISS index is appended to in place,
+    as each run owns its index.
+    """
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    first_row_id = snapshot.index.ntotal
+    snapshot.index.add_with_ids(embeddings, np.arange(first_row_id, first_row_id + len(embeddings), dtype=np.int64))
+    table = LabelTable.from_records(list(range(len(records))), records, label.method_2_labels)
+    lookup = LabelTable(np.concatenate([snapshot.lookup.doc_ids, table.doc_ids]),
+                        np.concatenate([snapshot.lookup.verified_mask, table.verified_mask]),
+                        np.concatenate([snapshot.lookup.incorrect_mask, table.incorrect_mask]),
+                        label.method_2_labels)
+    return label.VerifiedImages(np.concatenate([snapshot.embeddings, embeddings]), snapshot.index, lookup,
+                                snapshot.version + 1)
+
+
+def evaluate_run(method, run, seed):
+    """_summary_
+    Labels the shuffled batches with method, growing the verified set after each batch.
+
+    Returns:
+        dict: The batch order and the correct and incorrect prediction counts of each batch.
+    """
+    import label
+    import batch_label
+    order = random.Random(seed + run).sample(range(len(_batches)), len(_batches))
+    snapshot = empty_verified_images(label)
+    results = []
+    for position in order:
+        name, images, embeddings, truths = _batches[position]
+        if method in ("method_2", "method_3"):
+            predictions = batch_label.BATCH_METHODS[method](embeddings, snapshot=snapshot)
+        else:
+            predictions = batch_label.BATCH_METHODS[method](embeddings)
+
+        # As in the notebook, a prediction is correct if it is one of the image's ground truth labels.
+        correct = 0
+        records = []
+        for image, predicted, truth in zip(images, predictions, truths):
+            incorrect_labels = [value for value in predicted if value not in truth]
+            correct += len(predicted) - len(incorrect_labels)
+            records.append({"_id": image, "verified_labels": truth, "incorrect_labels": incorrect_labels})
+        total = len(images) * len(label.method_2_attributes)
+        results.append({
+            "batch": name,
+            "correct_predictions": correct,
+            "incorrect_predictions": total - correct,
+            "correct_percentage": correct / total * 100 if total else 0,
+            "incorrect_percentage": (total - correct) / total * 100 if total else 0,
+        })
+        snapshot = append_verified_images(label, snapshot, embeddings, records)
+    return {"method": method, "run": run + 1, "order": [_batches[position][0] for position in order],
+            "batches": results}
+
+
+def summarise_runs(runs):
+    """_summary_
+    Averages the runs of a method at each batch position, as in the "Average" sheet of the combined results.
+    """
+    average = []
+    for position in range(len(runs[0]["batches"])):
+        correct = [run["batches"][position]["correct_predictions"] for run in runs]
+        incorrect = [run["batches"][position]["incorrect_predictions"] for run in runs]
+        percentage = [run["batches"][position]["correct_percentage"] for run in runs]
+        average.append({
+            "batch": position + 1,
+            "correct_predictions": statistics.mean(correct),
+            "incorrect_predictions": statistics.mean(incorrect),
+            "correct_percentage": statistics.mean(percentage),
+            "correct_standard_deviation": statistics.stdev(correct) if len(runs) > 1 else 0.0,
+            "incorrect_standard_deviation": statistics.stdev(incorrect) if len(runs) > 1 else 0.0,
+            "runs": correct,
+        })
+    return average
+
+
+def write_excel(results, directory):
+    """_summary_
+    Writes one workbook per method with an "Average" sheet and a "Fold N Results" sheet per run, the layout of
+    the combined results in Results/. Requires openpyxl.
+    """
+    import openpyxl
+    os.makedirs(directory, exist_ok=True)
+    for method, result in results.items():
+        workbook = openpyxl.Workbook()
+        sheet = workbook.active
+        sheet.title = "Average"
+        sheet.append(["Batch", "Correct Predictions", "Incorrect Predictions", "Correct Percentage",
+                      "CR Standard Deviation", "Incr Standard Deviation"]
+                     + ["Fold " + str(run["run"]) for run in result["runs"]])
+        for row in result["average"]:
+            sheet.append([row["batch"], row["correct_predictions"], row["incorrect_predictions"],
+                          row["correct_percentage"], row["correct_standard_deviation"],
+                          row["incorrect_standard_deviation"]] + row["runs"])
+        for run in result["runs"]:
+            sheet = workbook.create_sheet("Fold " + str(run["run"]) + " Results")
+            sheet.append(["Batch", "Correct Predictions", "Incorrect Predictions", "Correct Percentage",
+                          "Incorrect Percentage"])
+            for row in run["batches"]:
+                sheet.append([row["batch"], row["correct_predictions"], row["incorrect_predictions"],
+                              row["correct_percentage"], row["incorrect_percentage"]])
+        workbook.save(os.path.join(directory, method + "_combined_results.xlsx"))
+
+
+def main():
+    global _batches
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory", help="Directory of batch directories, e.g. \"Test Data Files\".")
+    parser.add_argument("--labels", help="FairFace label CSV. Defaults to the labels metadata of packed batches.")
+    parser.add_argument("--methods", nargs="+", default=["method_1", "method_2", "method_3", "method_4"],
+                        choices=["method_1", "method_2", "method_3", "method_4", "method_5"])
+    parser.add_argument("--runs", type=int, default=5, help="Number of shuffled runs per method.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--output", default="fold_results.json")
+    parser.add_argument("--excel", help="Directory to also write the results to as spreadsheets.")
+    args = parser.parse_args()
+
+    # Load the model and batches before forking, so the workers share them.
+    import label  # noqa: F401
+    import batch_label  # noqa: F401
+    start = time.perf_counter()
+    _batches = load_batches(args.directory, load_fairface_labels(args.labels) if args.labels else None)
+    if not any(len(batch[1]) for batch in _batches):
+        sys.exit("No images with ground truth were found.")
+
+    tasks = [(method, run) for method in args.methods for run in range(args.runs)]
+    context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=context) as executor:
+        runs = list(executor.map(evaluate_run, *zip(*tasks), [args.seed] * len(tasks)))
+
+    results = {}
+    for method in args.methods:
+        method_runs = [run for run in runs if run["method"] == method]
+        results[method] = {"runs": method_runs, "average": summarise_runs(method_runs)}
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+    if args.excel:
+        write_excel(results, args.excel)
+
+    summary = {method: round(statistics.mean(batch["correct_percentage"] for run in result["runs"]
+                                             for batch in run["batches"]), 2)
+               for method, result in results.items()}
+    print(json.dumps({"correct_percentage": summary, "batches": len(_batches), "runs": args.runs,
+                      "seconds": time.perf_counter() - start}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
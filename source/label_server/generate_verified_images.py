@@ -0,0 +1,211 @@
+"""
+Generates synthetic verified images at scale, for measuring how build_verified_images() and methods 2 and 3 behave
+with far more verified images than the sample embeddings provide.
+
+Each synthetic image is a real sample embedding (a "centre") plus gaussian noise, so the synthetic images form
+clusters around the real ones. An image is given its centre's labels as its verified labels: the ground truth if the
+centre has any (from --labels or the store's "labels" metadata), otherwise the centre's method 1 labels. For each
+attribute, with probability --incorrect-rate, another label of that attribute is recorded as incorrect, as if a
+method had predicted it and a user had corrected it.
+
+The images are written in chunks, either to the local MongoDB in the same format as seed_verified_images.py, or to
+a packed embedding store (see common/embedding_store.py) with the labels in each row's metadata.
+load_verified_store() builds the verified image index from such a store without a database.
+
+At 768 float32 values per image, 10^6 images take about 3 GB, and 10^7 images about 30 GB, on disk and in the index.
+
+Usage:
+    python generate_verified_images.py --count 1000000 --store ../../Clip_Image_Embeddings/synthetic_1m.store
+    python generate_verified_images.py --count 100000 --mongo
+    python generate_verified_images.py --clear
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+import faiss
+import numpy as np
+from bulk_label import load_embedding_dir, label_embeddings, load_fairface_labels
+from index_store import LabelTable
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.embedding_store import EmbeddingStore, is_store  # noqa: E402
+
+EMBEDDINGS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                              "Clip_Image_Embeddings")
+SYNTHETIC_PREFIX = "synthetic/"
+
+
+def default_source():
+    """_summary_
+    The FairFace sample embeddings, packed if Clip_Image_Embeddings/FairFace.store has been built.
+    """
+    store_path = os.path.join(EMBEDDINGS_DIR, "FairFace.store")
+    return store_path if is_store(store_path) else os.path.join(EMBEDDINGS_DIR, "FairFace")
+
+
+def centre_label_indices(centre_labels, attributes):
+    """_summary_
+    Returns a (centres, attributes) array of the position of each centre's label in its attribute's label list, or -1
+    if the label is not in the list.
+    """
+    positions = [{value: i for i, value in enumerate(attribute)} for attribute in attributes]
+    return np.array([[positions[a].get(labels[a], -1) if a < len(labels) else -1 for a in range(len(attributes))]
+                     for labels in centre_labels], dtype=np.int64).reshape(-1, len(attributes))
+
+
+def generate_chunks(centres, centre_labels, attributes, count, chunk_size=100000, noise=0.05, incorrect_rate=0.3,
+                    seed=0):
+    """_summary_
+    Yields (embeddings, records) chunks of synthetic verified images until count images have been generated.
+
+    Args:
+        centres (NumpyArray): (n, 768) real embeddings the synthetic images are sampled around.
+        centre_labels (list): [age, gender, race] labels of each centre.
+        attributes (list): Label list of each attribute, e.g. label.method_2_attributes.
+        count (int): Number of images to generate.
+        chunk_size (int): Number of images per chunk.
+        noise (float): Norm of the noise added to a centre, relative to the centre's norm.
+        incorrect_rate (float): Probability of each attribute having an incorrect label.
+        seed (int): Random seed. The same arguments always generate the same images.
+
+    Yields:
+        NumpyArray: (chunk size, 768) float32 embeddings.
+        list: {"verified_labels", "incorrect_labels"} record of each embedding.
+    """
+    rng = np.random.default_rng(seed)
+    centres = np.ascontiguousarray(centres, dtype=np.float32).reshape(-1, 768)
+    scales = np.linalg.norm(centres, axis=1) * noise / np.sqrt(centres.shape[1])
+    label_indices = centre_label_indices(centre_labels, attributes)
+    for start in range(0, count, chunk_size):
+        size = min(chunk_size, count - start)
+        picks = rng.integers(0, len(centres), size)
+        embeddings = centres[picks] + rng.standard_normal((size, centres.shape[1]), dtype=np.float32) \
+            * scales[picks, None].astype(np.float32)
+
+        # Pick the incorrect label of each attribute as an offset from the verified label, so it is never the same.
+        incorrect = []
+        for a, attribute in enumerate(attributes):
+            has_incorrect = rng.random(size) < incorrect_rate
+            offsets = rng.integers(1, len(attribute), size) if len(attribute) > 1 else np.zeros(size, dtype=np.int64)
+            verified = label_indices[picks, a]
+            choices = np.where(verified >= 0, (verified + offsets) % len(attribute), offsets)
+            incorrect.append(np.where(has_incorrect & (len(attribute) > 1), choices, -1))
+
+        records = []
+        for i, centre in enumerate(picks):
+            records.append({
+                "verified_labels": list(centre_labels[centre]),
+                "incorrect_labels": [attribute[incorrect[a][i]] for a, attribute in enumerate(attributes)
+                                     if incorrect[a][i] >= 0],
+            })
+        yield embeddings, records
+
+
+def build_documents(embeddings, records, first_row_id):
+    """_summary_
+    Returns the verified image documents of a chunk, in the format of seed_verified_images.build_documents(). Each
+    image is named after its row_id.
+    """
+    return [{
+        "_id": uuid.uuid4().hex,
+        "image_data": SYNTHETIC_PREFIX + str(first_row_id + i),
+        "embedding": embedding.reshape(1, -1).tolist(),
+        "unverified_labels": "",
+        "verified_labels": record["verified_labels"],
+        "incorrect_labels": record["incorrect_labels"],
+        "requiresVerification": "False",
+        "row_id": first_row_id + i,
+    } for i, (embedding, record) in enumerate(zip(embeddings, records))]
+
+
+def load_verified_store(path, labels, limit=None):
+    """_summary_
+    Builds the verified image index from a store written by this script, as build_verified_images() builds it from
+    the database.
+
+    Args:
+        path (str): Store directory.
+        labels (list): Label list of the lookup table, e.g. label.method_2_labels.
+        limit (int): Only load the first limit images.
+
+    Returns:
+        NumpyArray: The embeddings.
+        Faiss index: Faiss IndexIDMap of the embeddings, with the row number of each image as its id.
+        LabelTable: Lookup table indexed by row number.
+    """
+    store = EmbeddingStore(path)
+    index = faiss.IndexIDMap(faiss.IndexFlatL2(store.dim))
+    embeddings = []
+    tables = []
+    for records, shard_embeddings in store.iter_shards():
+        remaining = len(records) if limit is None else min(len(records), limit - index.ntotal)
+        if remaining <= 0:
+            break
+        shard_embeddings = np.ascontiguousarray(shard_embeddings[:remaining])
+        index.add_with_ids(shard_embeddings, np.arange(index.ntotal, index.ntotal + remaining, dtype=np.int64))
+        tables.append(LabelTable.from_records(
+            list(range(remaining)), [dict(record, _id=record["id"]) for record in records[:remaining]], labels))
+        embeddings.append(shard_embeddings)
+    if not tables:
+        return np.empty((0, store.dim), dtype=np.float32), index, LabelTable.from_records([], [], labels)
+    lookup = LabelTable(np.concatenate([table.doc_ids for table in tables]),
+                        np.concatenate([table.verified_mask for table in tables]),
+                        np.concatenate([table.incorrect_mask for table in tables]), labels)
+    return np.concatenate(embeddings), index, lookup
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=10000, help="Number of synthetic images to generate.")
+    parser.add_argument("--source", default=default_source(),
+                        help="Embedding store or directory of the real embeddings used as centres.")
+    parser.add_argument("--labels", help="FairFace label CSV with the ground truth of the centres.")
+    parser.add_argument("--store", help="Write the images to this embedding store.")
+    parser.add_argument("--mongo", action="store_true", help="Insert the images into the local MongoDB.")
+    parser.add_argument("--clear", action="store_true", help="Delete the synthetic images from MongoDB first.")
+    parser.add_argument("--noise", type=float, default=0.05)
+    parser.add_argument("--incorrect-rate", type=float, default=0.3)
+    parser.add_argument("--chunk-size", type=int, default=100000)
+    parser.add_argument("--batch-size", type=int, default=1000, help="Number of documents per insert.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # Importing label loads the clip model, which labels the centres that have no ground truth.
+    import label
+    collection = label.db["image_data"]
+    if args.clear:
+        deleted = collection.delete_many({"image_data": {"$regex": "^" + SYNTHETIC_PREFIX}}).deleted_count
+        print(json.dumps({"deleted": deleted}))
+    if not (args.store or args.mongo):
+        return
+
+    start = time.perf_counter()
+    names, centres, ground_truth = load_embedding_dir(args.source)
+    if args.labels:
+        ground_truth = load_fairface_labels(args.labels)
+    predictions = label_embeddings("method_1", centres)
+    centre_labels = [list(ground_truth.get(name) or predicted) for name, predicted in zip(names, predictions)]
+
+    store = EmbeddingStore(args.store) if args.store else None
+    first_number = len(store) if store is not None else 0
+    generated = 0
+    for embeddings, records in generate_chunks(centres, centre_labels, label.method_2_attributes, args.count,
+                                               args.chunk_size, args.noise, args.incorrect_rate, args.seed):
+        if store is not None:
+            ids = [SYNTHETIC_PREFIX + str(first_number + generated + i) for i in range(len(records))]
+            store.append(embeddings, ids, records)
+        if args.mongo:
+            for i in range(0, len(records), args.batch_size):
+                batch_embeddings = embeddings[i:i + args.batch_size]
+                documents = build_documents(batch_embeddings, records[i:i + args.batch_size],
+                                            label.get_next_row_id(len(batch_embeddings)))
+                collection.insert_many(documents, ordered=False)
+        generated += len(records)
+        print(json.dumps({"generated": generated, "seconds": time.perf_counter() - start}))
+
+
+if __name__ == "__main__":
+    main()
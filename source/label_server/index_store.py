@@ -0,0 +1,203 @@
+import fcntl
+import json
+import os
+import shutil
+import faiss
+import numpy as np
+
+
+class LabelTable:
+    """_summary_
+    Lookup table from row_id to the labels of a verified image. The table is made of numpy arrays rather than Python
+    objects so that it can be memory mapped from an index snapshot and shared by every worker process.
+
+    table[row_id] returns {"_id": ..., "verified_labels": [...], "incorrect_labels": [...]}, or None if there is no
+    verified image with that row_id. Only labels in the table's label list are kept.
+    """
+
+    def __init__(self, doc_ids, verified_mask, incorrect_mask, labels):
+        """_summary_
+
+        Args:
+            doc_ids (NumpyArray): "_id" of the image with each row_id, or "" if there is none.
+            verified_mask (NumpyArray): Boolean mask over labels of each image's verified labels.
+            incorrect_mask (NumpyArray): Boolean mask over labels of each image's incorrect labels.
+            labels (list): The labels the masks refer to.
+        """
+        self.doc_ids = doc_ids
+        self.verified_mask = verified_mask
+        self.incorrect_mask = incorrect_mask
+        self.labels = labels
+
+    @classmethod
+    def from_records(cls, row_ids, records, labels):
+        """_summary_
+        Builds a table from a list of row_ids and a list of {"_id", "verified_labels", "incorrect_labels"} records.
+        """
+        size = int(max(row_ids)) + 1 if len(row_ids) else 0
+        positions = {label: i for i, label in enumerate(labels)}
+        width = max([len(str(record["_id"])) for record in records] + [1])
+        doc_ids = np.full(size, "", dtype="U" + str(width))
+        verified_mask = np.zeros((size, len(labels)), dtype=bool)
+        incorrect_mask = np.zeros((size, len(labels)), dtype=bool)
+        for row_id, record in zip(row_ids, records):
+            doc_ids[row_id] = str(record["_id"])
+            for label in record["verified_labels"]:
+                if label in positions:
+                    verified_mask[row_id, positions[label]] = True
+            for label in record["incorrect_labels"]:
+                if label in positions:
+                    incorrect_mask[row_id, positions[label]] = True
+        return cls(doc_ids, verified_mask, incorrect_mask, labels)
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def __getitem__(self, row_id):
+        if self.doc_ids[row_id] == "":
+            return None
+        return {
+            "_id": str(self.doc_ids[row_id]),
+            "verified_labels": [self.labels[i] for i in np.flatnonzero(self.verified_mask[row_id])],
+            "incorrect_labels": [self.labels[i] for i in np.flatnonzero(self.incorrect_mask[row_id])],
+        }
+
+
+def index_vectors(index):
+    """_summary_
+    Returns a read-only (ntotal, d) view of the vectors of a flat index, or of the flat index wrapped by an IndexIDMap,
+    in the order they were added. The view points into the index's memory, so the index must be kept alive with it.
+    """
+    flat = faiss.downcast_index(index.index if isinstance(index, faiss.IndexIDMap) else index)
+    if flat.ntotal == 0:
+        return np.empty((0, flat.d), dtype=np.float32)
+    vectors = faiss.rev_swig_ptr(flat.get_xb(), flat.ntotal * flat.d).reshape(flat.ntotal, flat.d)
+    vectors.flags.writeable = False
+    return vectors
+
+
+class IndexStore:
+    """_summary_
+    Directory of versioned snapshots of the verified image index, shared by every label server process on a host.
+
+    One process (the builder) builds the index from the database and publishes it as a new version. Every process
+    maps the current version read-only: the FAISS index and the numpy arrays are memory mapped, so their memory is
+    shared between processes through the page cache and paid once per host. The embeddings are not stored separately,
+    they are read from the vectors of the mapped index.
+
+    Layout:
+        CURRENT             the current version number, replaced atomically
+        v<version>/         index.faiss, doc_ids.npy, verified_mask.npy, incorrect_mask.npy, labels.json
+        builder.lock        held by the builder process
+        publish.lock        held while a version is being published
+    """
+
+    def __init__(self, directory, keep=3):
+        """_summary_
+
+        Args:
+            directory (str): Directory the snapshots are stored in.
+            keep (int): Number of versions to keep. Old versions are deleted once they are no longer current.
+                        Processes still mapping a deleted version keep working, as the files stay alive while mapped.
+        """
+        self.directory = directory
+        self.keep = keep
+        self._builder_lock = None
+        self._builder_pid = None
+        os.makedirs(directory, exist_ok=True)
+
+    def current_version(self):
+        """_summary_
+        Returns the current version number, or None if nothing has been published.
+        """
+        try:
+            with open(os.path.join(self.directory, "CURRENT")) as file:
+                return int(file.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def try_become_builder(self):
+        """_summary_
+        Returns True if this process is the builder. The first process to call this takes the builder lock and keeps
+        it until it exits or calls release_builder(), after which another process can take over.
+        """
+        if self._builder_lock is not None and self._builder_pid != os.getpid():
+            # The lock was inherited from the parent process through a fork and still belongs to the parent. Closing
+            # the inherited file does not release the parent's lock.
+            self._builder_lock.close()
+            self._builder_lock = None
+        if self._builder_lock is None:
+            lock = open(os.path.join(self.directory, "builder.lock"), "w")
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock.close()
+                return False
+            self._builder_lock = lock
+            self._builder_pid = os.getpid()
+        return True
+
+    def release_builder(self):
+        """_summary_
+        Gives up the builder lock, if this process holds it, so that another process can become the builder.
+        """
+        if self._builder_lock is not None:
+            if self._builder_pid == os.getpid():
+                fcntl.flock(self._builder_lock, fcntl.LOCK_UN)
+            self._builder_lock.close()
+            self._builder_lock = None
+
+    def publish(self, embeddings, index, label_table):
+        """_summary_
+        Writes a new version and makes it current. embeddings are not written, as they are the vectors of index.
+
+        Returns:
+            int: The new version number.
+        """
+        with open(os.path.join(self.directory, "publish.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            version = (self.current_version() or 0) + 1
+            path = self._path(version)
+            temp_path = path + ".tmp"
+            shutil.rmtree(temp_path, ignore_errors=True)
+            os.makedirs(temp_path)
+            faiss.write_index(index, os.path.join(temp_path, "index.faiss"))
+            np.save(os.path.join(temp_path, "doc_ids.npy"), label_table.doc_ids)
+            np.save(os.path.join(temp_path, "verified_mask.npy"), label_table.verified_mask)
+            np.save(os.path.join(temp_path, "incorrect_mask.npy"), label_table.incorrect_mask)
+            with open(os.path.join(temp_path, "labels.json"), "w") as file:
+                json.dump(label_table.labels, file)
+            os.rename(temp_path, path)
+
+            current = os.path.join(self.directory, "CURRENT.tmp")
+            with open(current, "w") as file:
+                file.write(str(version))
+            os.replace(current, os.path.join(self.directory, "CURRENT"))
+
+            for old_version in range(version - self.keep, 0, -1):
+                if not os.path.exists(self._path(old_version)):
+                    break
+                shutil.rmtree(self._path(old_version), ignore_errors=True)
+            return version
+
+    def load(self, version):
+        """_summary_
+        Maps a version read-only.
+
+        Returns:
+            tuple: (embeddings, FAISS index, LabelTable)
+        """
+        path = self._path(version)
+        # IO_FLAG_MMAP_IFC maps the vectors of the flat index in place. IO_FLAG_MMAP would copy them into each process.
+        index = faiss.read_index(os.path.join(path, "index.faiss"), faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+        embeddings = index_vectors(index)
+        with open(os.path.join(path, "labels.json")) as file:
+            labels = json.load(file)
+        label_table = LabelTable(np.load(os.path.join(path, "doc_ids.npy"), mmap_mode="r"),
+                                 np.load(os.path.join(path, "verified_mask.npy"), mmap_mode="r"),
+                                 np.load(os.path.join(path, "incorrect_mask.npy"), mmap_mode="r"),
+                                 labels)
+        return embeddings, index, label_table
+
+    def _path(self, version):
+        return os.path.join(self.directory, "v" + str(version))
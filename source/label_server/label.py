@@ -1,18 +1,37 @@
+import itertools
 import math
+import os
+import sys
+import threading
+from collections import namedtuple
 import faiss
 import numpy as np
 import pymongo
 import torch
 import clip
 import torch.nn.functional as F
+from index_store import LabelTable
+import prompt_ensembles
+from taxonomies import TaxonomyRegistry
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.threads import configure_threads  # noqa: E402
+from common.instrumentation import stage  # noqa: E402
+from common.row_ids import reserve_row_ids  # noqa: E402
 
 # Set up db connection
 client = pymongo.MongoClient('localhost', 27017)
 db = client.images
 
+# Each request only scores one embedding against a few hundred text features and searches the index for it, which
+# is too little work to split across threads. Requests are run in parallel by the server's workers and request
+# threads instead, so torch and FAISS use one thread per request by default.
+thread_settings = configure_threads(torch_threads=1, faiss_threads=1)
+
 # set up clip model
 device = "cuda" if torch.cuda.is_available() else "cpu"
-model, preprocess = clip.load("ViT-L/14", device=device, jit=True)
+CLIP_MODEL = "ViT-L/14"
+model, preprocess = clip.load(CLIP_MODEL, device=device, jit=True)
 
 # define labels.
 age_labels = ["0-2", "3-9", "10-19", "20-29", "30-39",
@@ -64,58 +83,196 @@ with torch.no_grad():
     race_label_features = model.encode_text(race_tokens)
     sentence_features = model.encode_text(sentence_tokens)
 
+# set up for label method 4.
+# Every sentence describes one (age, race, gender) combination. method_4_prompt_codes holds the position of each
+# sentence's labels in method_4_attributes, in the order sentence_builder() generates them, so the labels of a sentence
+# never have to be recovered by string matching. method_4_grid_order arranges the sentence scores into a grid with one
+# dimension per attribute, so the score of each label is a reduction over the other dimensions.
+method_4_attributes = [age_labels, race_labels, gender_labels]
+method_4_shape = tuple(len(labels) for labels in method_4_attributes)
+method_4_prompt_codes = np.array(list(itertools.product(*(range(size) for size in method_4_shape))))
+method_4_grid_order = torch.from_numpy(np.argsort(np.ravel_multi_index(method_4_prompt_codes.T, method_4_shape)))
+
+# set up for label method 2.
+# Method 2 scores every attribute in one pass. method_2_label_features holds the normalised text features of every
+# age, gender and race label, and method_2_label_matrix holds the position of each attribute's labels in that tensor,
+# padded with the position of an extra -inf column so that a single argmax picks the best label for every attribute.
+METHOD_2_NEIGHBOURS = 3
+# Largest number of neighbours a method 2 request can ask for.
+METHOD_2_MAX_NEIGHBOURS = int(os.environ.get("METHOD_2_MAX_NEIGHBOURS", "100"))
+method_2_attributes = [age_labels, gender_labels, race_labels]
+method_2_labels = age_labels + gender_labels + race_labels
+method_2_label_features = F.normalize(
+    torch.cat([age_label_features, gender_label_features, race_label_features]).float(), p=2, dim=1)
+_max_attribute_size = max(len(labels) for labels in method_2_attributes)
+method_2_label_matrix = torch.full((len(method_2_attributes), _max_attribute_size), len(method_2_labels), dtype=torch.long)
+_offset = 0
+for _i, _labels in enumerate(method_2_attributes):
+    method_2_label_matrix[_i, :len(_labels)] = torch.arange(_offset, _offset + len(_labels))
+    _offset += len(_labels)
+
+# set up for label method 5.
+# Method 5 scores the labels with prompt ensembles (see prompt_ensembles.py). The ensemble features are in the same
+# order as method_2_labels, so they are scored in one pass with method_2_label_matrix. They are loaded from the
+# prompt cache, and built and cached here if they have not been built yet.
+method_5_templates = [prompt_ensembles.AGE_TEMPLATES, prompt_ensembles.GENDER_TEMPLATES,
+                      prompt_ensembles.RACE_TEMPLATES]
+method_5_version = prompt_ensembles.ensemble_version(CLIP_MODEL, method_2_attributes, method_5_templates)
+method_5_label_features = prompt_ensembles.load_ensemble_features(method_5_version)
+# True if the features were built when this module was imported, rather than loaded from the cache.
+method_5_built = method_5_label_features is None
+if method_5_built:
+    method_5_label_features = prompt_ensembles.build_ensemble_features(
+        model, clip.tokenize, device, method_2_attributes, method_5_templates)
+    try:
+        prompt_ensembles.save_ensemble_features(method_5_version, method_5_label_features, CLIP_MODEL,
+                                                method_2_attributes, method_5_templates)
+    except OSError as e:
+        print(e)
+method_5_label_features = method_5_label_features.to(device)
+
+# set up for taxonomy labelling.
+# The taxonomies are read from taxonomies.json (see taxonomies.py). Their text features are persisted under data/, so
+# only new or changed taxonomies are encoded here. The registry can be reloaded while the server is running.
+taxonomy_registry = TaxonomyRegistry(model, clip.tokenize, device, CLIP_MODEL)
+try:
+    taxonomy_registry.reload()
+except Exception as e:
+    print(e)
+    print("There was an error loading the taxonomies.")
+
 # vi stands for verified images. These are used to perform nearest neighbour search
 # on images already in the db.
-vi_embeddings = np.empty((0, 768), dtype=np.float32)
-vi_index = faiss.IndexFlatL2(768)
+# Every verified image document carries a compact integer "row_id" which is used as its id in the FAISS index.
+# The lookup is a LabelTable indexed by row_id, so a FAISS result can be resolved to its labels without querying the
+# db. lookup.incorrect_mask[row_id] is a boolean mask over method_2_labels of the labels marked incorrect.
+# The embeddings, index, lookup and version are held together in one immutable snapshot. A refresh builds a new
+# snapshot off to the side and replaces verified_images with a single assignment, so a request always sees an index,
+# embeddings and lookup from the same build. Requests read verified_images once and finish against that snapshot
+# even if a refresh completes while they are running.
+VerifiedImages = namedtuple("VerifiedImages", ["embeddings", "index", "lookup", "version"])
+verified_images = VerifiedImages(np.empty((0, 768), dtype=np.float32),
+                                 faiss.IndexIDMap(faiss.IndexFlatL2(768)),
+                                 LabelTable.from_records([], [], method_2_labels),
+                                 0)
+# Only one snapshot is built at a time, so a scheduled refresh and a manual refresh do not race.
+build_lock = threading.Lock()
+
+
+def get_next_row_id(count=1):
+    """_summary_
+    Reserves a block of "count" row ids from the counters collection and returns the first id in the block.
+    """
+    return reserve_row_ids(db, count)
+
+
+def assign_row_ids(collection):
+    """_summary_
+    Gives a row_id to every verified image in the collection that does not have one yet. Images verified through
+    the UI are given a row_id when they are verified, this catches images that were inserted directly into the db.
+    """
+    missing = [item["_id"] for item in collection.find(
+        {"requiresVerification": "False", "row_id": {"$exists": False}}, {"_id": 1})]
+    if not missing:
+        return
+    first_row_id = get_next_row_id(len(missing))
+    collection.bulk_write([pymongo.UpdateOne({"_id": _id, "row_id": {"$exists": False}}, {"$set": {"row_id": first_row_id + i}})
+                           for i, _id in enumerate(missing)])
 
 
 # Builds Faiss index of images in the database.
 def build_verified_images():
     """_summary_
-    This function connects to the image database and returns a numpy array of all image embeddings in the database, and a FAISS
-    index of the array. 
+    This function connects to the image database and returns a numpy array of all image embeddings in the database, a FAISS
+    index of the array and a lookup table of the labels of each image.
 
     Returns:
         NumpyArray : Array of all image embeddings in the database
-        Faiss index: Faiss index of the NumpyArray 
+        Faiss index: Faiss IndexIDMap of the NumpyArray. The ids are the row_id of each image.
+        LabelTable: Lookup table indexed by row_id. Each entry is a dictionary containing the "_id", "verified_labels"
+              and "incorrect_labels" of the image, or None if there is no verified image with that row_id.
     """
     collection = db['image_data']
-    index = faiss.IndexFlatL2(768)
+    index = faiss.IndexIDMap(faiss.IndexFlatL2(768))
     try:
-        embeddings = np.empty((0, 768), dtype=np.float32)
-        # print("Process has started")
-        # count = 0
-        # Get every image that has been verified in the db
-        for item in collection.find({"requiresVerification": "False"}):
-            emb = np.array(item['embedding'])
-            embeddings = np.append(embeddings, emb, axis=0)
+        embeddings = []
+        row_ids = []
+        records = []
+        with stage("mongo_lookup"):
+            assign_row_ids(collection)
+            # Get every image that has been verified in the db
+            for item in collection.find({"requiresVerification": "False"},
+                                        {"embedding": 1, "row_id": 1, "verified_labels": 1, "incorrect_labels": 1}):
+                embeddings.append(np.array(item['embedding'], dtype=np.float32).reshape(1, 768))
+                row_ids.append(item['row_id'])
+                records.append({"_id": item["_id"],
+                                "verified_labels": item.get("verified_labels") or [],
+                                "incorrect_labels": item.get("incorrect_labels") or []})
         # If no verified images have been found. return the default index and embeddings objects.
         # else update the index.
-        if embeddings.size == 0:
-            return embeddings, index
-        index.add(embeddings)
-        return embeddings, index
+        if not embeddings:
+            return np.empty((0, 768), dtype=np.float32), index, LabelTable.from_records([], [], method_2_labels)
+
+        embeddings = np.concatenate(embeddings, axis=0)
+        row_ids = np.array(row_ids, dtype=np.int64)
+        with stage("index_build"):
+            index.add_with_ids(embeddings, row_ids)
+
+        return embeddings, index, LabelTable.from_records(row_ids, records, method_2_labels)
     except Exception as e:
         print(e)
-        return ("There was an error building the embeddings list.")
+        print("There was an error building the embeddings list.")
+        return None
 
 # Updates the index of embeddings
 
 
 def update_data():
     """
-    This function updates the vi_embeddings and vi_index variabls by calling build_verified_images()
+    This function builds a new verified_images snapshot by calling build_verified_images() and swaps it in.
     """
     print("Data is updating")
-    global vi_embeddings
-    global vi_index
-    vi_embeddings, vi_index = build_verified_images()
-    print("Ntotal: "+str(vi_index.ntotal))
+    global verified_images
+    with build_lock:
+        data = build_verified_images()
+        # Keep serving the previous snapshot if the build failed.
+        if data is None:
+            return
+        verified_images = VerifiedImages(*data, version=verified_images.version + 1)
+    print("Ntotal: "+str(verified_images.index.ntotal))
     # print(len(vi_embeddings))
     # print(vi_index.ntotal)
 
 
+def publish_data(index_store):
+    """
+    Builds the index of verified images and publishes it to index_store as a new version, for every label server
+    process on the host to load with load_published_data().
+    """
+    print("Data is being published")
+    with build_lock:
+        data = build_verified_images()
+    if data is not None:
+        print("Published version: " + str(index_store.publish(*data)))
+
+
+def load_published_data(index_store):
+    """
+    Maps the current version of index_store read-only and swaps it in as the verified_images snapshot if it differs
+    from the loaded version.
+
+    Returns:
+        bool: True if a new version was loaded.
+    """
+    global verified_images
+    version = index_store.current_version()
+    if version is None or version == verified_images.version:
+        return False
+    verified_images = VerifiedImages(*index_store.load(version), version=version)
+    print("Loaded version " + str(version) + ", Ntotal: " + str(verified_images.index.ntotal))
+    return True
+
+
 # Clip only method
 def label_method_1(embedding):
     """_summary_
@@ -157,68 +314,51 @@ def label_method_1(embedding):
 # Original method (dont be wrong). Tries to remove labels it thinks might be wrong.
 
 
-def label_method_2(image_embedding):
+def label_method_2(image_embedding, neighbours=METHOD_2_NEIGHBOURS, snapshot=None):
     """_summary_
     Label method 2:
-        This method tries to remove labels that it thinks might be wrong. It retrieves the 2 closest images
-        from the database, and builds a list of the labels tagged as incorrect for these images. If the predicted label
+        This method tries to remove labels that it thinks might be wrong. It retrieves the closest images
+        from the database, and builds a mask of the labels tagged as incorrect for these images. If the predicted label
         has been tagged at incorrect for a close neighbour, the predicted label is discarded and the next closest label 
         is attached. 
+
+        The incorrect label masks of the neighbours are read from the snapshot lookup and applied to the similarity scores
+        of all attributes at once, so the label for each attribute is a single masked argmax.
+
+    Args:
+        image_embedding (list): Clip image embedding.
+        neighbours (int): The number of nearest neighbours whose incorrect labels are excluded. Defaults to 3.
+        snapshot (VerifiedImages): The verified images to search. Defaults to the current verified_images.
     """
+    if snapshot is None:
+        snapshot = verified_images
     try:
         # convert embedding to numpy array
         emb = np.array(image_embedding).astype('float32')
-        # print(vi_index.ntotal)
-        if vi_index.ntotal > 0:
-            nearest_neighbour_labels = []
-            nearest_neighbour_incorrect_labels = []
-
-            # Get the closest matching image from the database.
-            _, I = vi_index.search(emb, 3)
-            closest_image_embedding_1 = vi_embeddings[[I[0][0]]].tolist()
-            closest_image_embedding_2 = vi_embeddings[[I[0][1]]].tolist()
-            closest_image_embedding_3 = vi_embeddings[[I[0][2]]].tolist()
-
-            nearest_neighbour_1 = db.image_data.find(
-                {"embedding": closest_image_embedding_1, "requiresVerification": "False"})
-
-            for neighbour in nearest_neighbour_1:
-                nearest_neighbour_incorrect_labels += neighbour['incorrect_labels']
-                nearest_neighbour_labels += neighbour['verified_labels']
-
-            nearest_neighbour_2 = db.image_data.find(
-                {"embedding": closest_image_embedding_2, "requiresVerification": "False"})
-
-            for neighbour in nearest_neighbour_2:
-                nearest_neighbour_labels += neighbour['verified_labels']
-                nearest_neighbour_incorrect_labels += neighbour['incorrect_labels']
-
-            nearest_neighbour_3 = db.image_data.find(
-                {"embedding": closest_image_embedding_3, "requiresVerification": "False"})
-
-            for neighbour in nearest_neighbour_3:
-                nearest_neighbour_labels += neighbour['verified_labels']
-                nearest_neighbour_incorrect_labels += neighbour['incorrect_labels']
-
-            nearest_neighbour_labels = list(set(nearest_neighbour_labels))
-            # print("Correct labels: " + str(nearest_neighbour_labels))
-
-            nearest_neighbour_incorrect_labels = list(set(
-                nearest_neighbour_incorrect_labels))
-            # print("Incorrect labels: "+str(nearest_neighbour_incorrect_labels))
-
-        else:
-            nearest_neighbour_labels = []
-            nearest_neighbour_incorrect_labels = []
-
-        age = method_2_get_age_label(emb, nearest_neighbour_incorrect_labels)
-
-        gender = method_2_get_gender_label(
-            emb, nearest_neighbour_incorrect_labels)
-
-        race = method_2_get_race_label(emb, nearest_neighbour_incorrect_labels)
-
-        labels = [age, gender, race]
+        excluded = np.zeros(len(method_2_labels), dtype=bool)
+        if snapshot.index.ntotal > 0:
+            # Get the closest matching images from the database. FAISS pads the result with -1 if there are
+            # fewer images than neighbours.
+            with stage("faiss_search"):
+                _, I = snapshot.index.search(emb, int(neighbours))
+            row_ids = I[0][I[0] >= 0]
+            excluded = snapshot.lookup.incorrect_mask[row_ids].any(axis=0)
+
+        image_features = F.normalize(torch.from_numpy(emb), p=2, dim=1).to(device)
+        # Softmax does not change the order of the labels, so the argmax of the raw similarity is the top label.
+        similarity = (image_features @ method_2_label_features.T)[0].cpu()
+        similarity[torch.from_numpy(excluded)] = -math.inf
+        similarity = torch.cat([similarity, torch.tensor([-math.inf])])
+
+        scores = similarity[method_2_label_matrix]
+        values, indices = scores.max(dim=1)
+
+        labels = []
+        for attribute, value, index in zip(method_2_attributes, values, indices):
+            if math.isinf(float(value)):
+                labels.append("No Label Identified")
+            else:
+                labels.append(attribute[int(index)])
         status = "success"
         return status, labels
 
@@ -230,13 +370,16 @@ def label_method_2(image_embedding):
 
 
 # k nearest neighbours method
-def label_method_3(image_embedding):
+def label_method_3(image_embedding, snapshot=None):
     """_summary_
     This method uses Nearest Neighbour search to label images. 
     If there are images in the database and the index has been built (n.total>0), we call the method_3 functions to perform nearest neighbour search. 
     Else, if the database is empty, vi_index.ntotal = 0, and we use label_method_1 to populate to database with some initial image data. 
     When the scheduler updates vi_index, vi_index.ntotal will be >0 and therefore method_3 functions will then be used. 
+    The search runs against snapshot, which defaults to the current verified_images.
     """
+    if snapshot is None:
+        snapshot = verified_images
     try:
         # convert embedding to numpy array
         emb = np.array(image_embedding).astype('float32')
@@ -244,22 +387,73 @@ def label_method_3(image_embedding):
         # If there are images in the database and the index has been built, we calulate the n total and call the method_3 functions.
         # Else, if the database is empty, vi_index.ntotal = 0, and we use label_method_1 to populate to database with some initial
         # image data. when the scheduler updates vi_index, vi_index.ntotal will be >0 and therefore method_3 functions will then be used.
-        if vi_index.ntotal > 0:
-            N = math.sqrt(vi_index.ntotal)
+        if snapshot.index.ntotal > 0:
+            N = math.sqrt(snapshot.index.ntotal)
             N = round(N)
 
-            age = method_3_get_age_label(emb, N)
-            gender = method_3_get_gender_label(emb, N)
-            race = method_3_get_race_label(emb, N)
+            age = method_3_get_age_label(emb, N, snapshot)
+            gender = method_3_get_gender_label(emb, N, snapshot)
+            race = method_3_get_race_label(emb, N, snapshot)
 
             labels = [age, gender, race]
             status = "success"
             return status, labels
 
         else:
-            labels = label_method_1(image_embedding)
-            status = "success"
-            return status, labels
+            return label_method_1(image_embedding)
+
+    except Exception as e:
+        print(e)
+        status = "Fail"
+        message = "There was an error processing your request"
+        return status, message
+
+
+def label_taxonomies(embedding, names=None):
+    """_summary_
+    Labels an image embedding with any subset of the taxonomies in the taxonomy registry, in one pass.
+
+    Args:
+        embedding (list): Clip image embedding.
+        names (list): Names of the taxonomies to label with. Defaults to every taxonomy.
+
+    Returns:
+        status, {taxonomy name: label} or an error message.
+    """
+    try:
+        return "success", taxonomy_registry.score(embedding, names)
+
+    except KeyError as e:
+        return "Fail", "Unknown taxonomy: " + str(e)
+
+    except Exception as e:
+        print(e)
+        status = "Fail"
+        message = "There was an error processing your request"
+        return status, message
+
+
+# Similar to label_method_1 but with prompt ensembles
+def label_method_5(embedding):
+    """_summary_
+    Label method 5 - Clip only method using prompt ensembles.
+
+    This method is similar to label method 1, but each label is scored against the average text features of several
+    prompts describing it rather than the bare FairFace label. The ensemble features are precomputed, so this costs
+    the same as label method 1.
+    """
+    try:
+        # convert embedding to numpy array
+        emb = np.array(embedding).astype('float32')
+        image_features = F.normalize(torch.from_numpy(emb), p=2, dim=1).to(device)
+
+        similarity = (image_features @ method_5_label_features.T)[0].cpu()
+        similarity = torch.cat([similarity, torch.tensor([-math.inf])])
+        _, indices = similarity[method_2_label_matrix].max(dim=1)
+
+        labels = [attribute[int(index)] for attribute, index in zip(method_2_attributes, indices)]
+        status = "success"
+        return status, labels
 
     except Exception as e:
         print(e)
@@ -274,6 +468,9 @@ def label_method_4(embedding):
     This method was developed during the experimentation phase. It is similar to label method 1, however it passes the prompts 
     generated by the sentence_builder() rather than the FairFace labels. 
 
+    The sentence scores are arranged into an (age, race, gender) grid, and each attribute's label is the one with the
+    highest marginal score, the logsumexp of the grid over the other attributes. Adding an attribute adds a dimension
+    to the grid rather than another scan of the sentences.
     """
     try:
         # convert embedding to numpy array
@@ -281,23 +478,14 @@ def label_method_4(embedding):
         image_features = F.normalize(
             torch.from_numpy(emb), p=2, dim=1).to(device)
 
-        sentence_similarity = (100.0 * image_features @
-                               sentence_features.T).softmax(dim=-1)
-
-        values, indices = sentence_similarity[0].topk(1)
-        closest_sentence = sentences[int(indices[0])]
-        # print(closest_sentence)
+        logits = (100.0 * image_features @ sentence_features.T)[0].float().cpu()
+        grid = logits[method_4_grid_order].reshape(method_4_shape)
 
-        # Check if label was in the closest sentence and return label.
-        for i in age_labels:
-            if i in closest_sentence:
-                age = i
-        for i in race_labels:
-            if i in closest_sentence:
-                race = i
-        for i in gender_labels:
-            if i in closest_sentence:
-                gender = i
+        codes = []
+        for axis in range(grid.dim()):
+            other_axes = [i for i in range(grid.dim()) if i != axis]
+            codes.append(int(torch.logsumexp(grid, dim=other_axes).argmax()))
+        age, race, gender = [labels[code] for labels, code in zip(method_4_attributes, codes)]
 
         labels = [age, gender, race]
         status = "success"
@@ -308,6 +496,8 @@ def label_method_4(embedding):
         return "No Label Identified"
 
 
+# The method_2_get_*_label functions are the original per-attribute implementation of method 2. label_method_2 no
+# longer uses them, they are kept as the reference implementation for benchmarks/bench_label_method_2.py.
 def method_2_get_age_label(embedding, nearest_neighbour_incorrect_labels):
     """_summary_
     Receives an Image embedding and returns the closest matching label. 
@@ -400,23 +590,18 @@ def method_2_get_gender_label(embedding, nearest_neighbour_incorrect_labels):
         return "No Label Identified"
 
 
-def method_3_get_age_label(embedding, n):
+def method_3_get_age_label(embedding, n, snapshot):
     """_summary_
     Receives an Image embedding and returns a label for the image embedding. Predicts labels by KNN search on the 
     image database. 
     """
     try:
-        _, I = vi_index.search(embedding, vi_index.ntotal)
+        with stage("faiss_search"):
+            _, I = snapshot.index.search(embedding, snapshot.index.ntotal)
         labels_dict = {key: 0 for key in age_labels}
 
         for index in I[0]:
-            nearest_neighbour_embedding = vi_embeddings[index].tolist()
-            nearest_neighbour = db.image_data.find(
-                {"embedding": nearest_neighbour_embedding, "requiresVerification": "False"})
-
-            closest_labels = []
-            for neighbour in nearest_neighbour:
-                closest_labels += neighbour['verified_labels']
+            closest_labels = snapshot.lookup[index]['verified_labels']
 
             for key in labels_dict:
                 if key in closest_labels:
@@ -432,26 +617,18 @@ def method_3_get_age_label(embedding, n):
         return "No Label Identified"
 
 
-def method_3_get_race_label(embedding, n):
+def method_3_get_race_label(embedding, n, snapshot):
     """_summary_
     Receives an Image embedding and returns a label for the image embedding. Predicts labels by KNN search on the 
     image database. 
     """
     try:
-        _, I = vi_index.search(embedding, vi_index.ntotal)
+        with stage("faiss_search"):
+            _, I = snapshot.index.search(embedding, snapshot.index.ntotal)
         labels_dict = {key: 0 for key in race_labels}
 
         for index in I[0]:
-            nearest_neighbour_embedding = vi_embeddings[index].tolist()
-            # nearest_neighbour_embedding = vi_embeddings[index].tolist()
-
-            nearest_neighbour = db.image_data.find(
-                {"embedding": nearest_neighbour_embedding, "requiresVerification": "False"})
-
-            closest_labels = []
-
-            for neighbour in nearest_neighbour:
-                closest_labels += neighbour['verified_labels']
+            closest_labels = snapshot.lookup[index]['verified_labels']
 
             for key in labels_dict:
                 if key in closest_labels:
@@ -467,22 +644,17 @@ def method_3_get_race_label(embedding, n):
         return "No Label Identified"
 
 
-def method_3_get_gender_label(embedding, n):
+def method_3_get_gender_label(embedding, n, snapshot):
     """_summary_
     Receives an Image embedding and returns a label for the image embedding. Predicts labels by KNN search on the 
     image database. 
     """
     try:
-        _, I = vi_index.search(embedding, vi_index.ntotal)
+        with stage("faiss_search"):
+            _, I = snapshot.index.search(embedding, snapshot.index.ntotal)
         labels_dict = {key: 0 for key in gender_labels}
         for index in I[0]:
-            nearest_neighbour_embedding = vi_embeddings[index].tolist()
-            nearest_neighbour = db.image_data.find(
-                {"embedding": nearest_neighbour_embedding, "requiresVerification": "False"})
-            closest_labels = []
-
-            for neighbour in nearest_neighbour:
-                closest_labels += neighbour['verified_labels']
+            closest_labels = snapshot.lookup[index]['verified_labels']
 
             for key in labels_dict:
                 if key in closest_labels:
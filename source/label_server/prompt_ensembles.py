@@ -0,0 +1,114 @@
+"""
+Prompt ensembles for labelling with clip.
+
+Each label is described by several prompt templates ("a photo of a {} person.", "a portrait of a {}." ...). The text
+features of a label are the average of the normalised text features of its prompts, which is more accurate than
+scoring a single prompt. The features only depend on the clip model, the templates and the labels, so they are
+computed once and cached on disk, and labelling with an ensemble costs the same as labelling with bare labels.
+
+Each cache file is named after a version hash of the model name, templates and labels, so changing any of them
+builds a new cache file instead of loading a stale one.
+
+The cache is built by the label server at start up if it is missing, or ahead of time with build_prompt_cache.py.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import torch
+import torch.nn.functional as F
+
+PROMPT_CACHE_DIR = os.environ.get(
+    "PROMPT_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "prompt_ensembles"))
+
+# Prompt templates of each attribute. "{}" is replaced by the label.
+AGE_TEMPLATES = [
+    "a photo of a {} year old person.",
+    "a photo of the face of a person aged {}.",
+    "a close-up photo of a {} year old.",
+    "a cropped photo of the face of someone who is {} years old.",
+]
+GENDER_TEMPLATES = [
+    "a photo of a {} person.",
+    "a photo of the face of a {}.",
+    "a close-up photo of a {} face.",
+    "a portrait of a {}.",
+]
+RACE_TEMPLATES = [
+    "a photo of a {} person.",
+    "a photo of the face of a {} person.",
+    "a close-up photo of a {} face.",
+    "a portrait of a {} man or woman.",
+]
+
+
+def ensemble_version(model_name, attributes, templates):
+    """_summary_
+    Returns a short hash identifying the ensemble built from a model, attributes and templates.
+
+    Args:
+        model_name (str): Name of the clip model, e.g. "ViT-L/14".
+        attributes (list): List of the label lists of each attribute.
+        templates (list): List of the template lists of each attribute.
+    """
+    description = json.dumps({"model": model_name, "attributes": attributes, "templates": templates})
+    return hashlib.sha1(description.encode("utf-8")).hexdigest()[:12]
+
+
+def cache_path(version, cache_dir=PROMPT_CACHE_DIR):
+    return os.path.join(cache_dir, "ensemble_" + version + ".pt")
+
+
+def build_ensemble_features(model, tokenize, device, attributes, templates):
+    """_summary_
+    Encodes every prompt of every label and averages the normalised features of the prompts of each label.
+
+    Args:
+        model: Clip model.
+        tokenize (function): clip.tokenize.
+        device (str): Device the model is on.
+        attributes (list): List of the label lists of each attribute.
+        templates (list): List of the template lists of each attribute.
+
+    Returns:
+        Tensor: Normalised (number of labels, embedding size) float tensor, with the labels of each attribute in order.
+    """
+    features = []
+    with torch.no_grad():
+        for labels, attribute_templates in zip(attributes, templates):
+            prompts = [template.format(label) for label in labels for template in attribute_templates]
+            prompt_features = F.normalize(model.encode_text(tokenize(prompts).to(device)).float(), p=2, dim=1)
+            prompt_features = prompt_features.reshape(len(labels), len(attribute_templates), -1).mean(dim=1)
+            features.append(F.normalize(prompt_features, p=2, dim=1))
+    return torch.cat(features).cpu()
+
+
+def load_ensemble_features(version, cache_dir=PROMPT_CACHE_DIR):
+    """_summary_
+    Returns the cached features of an ensemble version, or None if they have not been built.
+    """
+    path = cache_path(version, cache_dir)
+    if not os.path.exists(path):
+        return None
+    return torch.load(path)["features"]
+
+
+def save_ensemble_features(version, features, model_name, attributes, templates, cache_dir=PROMPT_CACHE_DIR):
+    """_summary_
+    Writes the features of an ensemble version to the cache, with the model name, labels and templates they were
+    built from. The file is written to a temporary file of its own in the cache directory and renamed, so a reader
+    never sees a partial file and processes building the same version at the same time do not write over each
+    other's temporary file.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    path = cache_path(version, cache_dir)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            torch.save({"version": version, "model": model_name, "attributes": attributes, "templates": templates,
+                        "features": features}, tmp_file)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return path
@@ -0,0 +1,144 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+import numpy as np
+
+# group is (method, index version, method parameters), embedding is the normalised embedding.
+CacheKey = namedtuple("CacheKey", ["group", "embedding"])
+
+
+class ResultCache:
+    """_summary_
+    LRU cache with a time to live for labelling results.
+
+    Webcam clients send the same face frame after frame, so the clip embeddings of consecutive requests are almost
+    identical, but rarely exactly identical. Instead of an exact key, the cache finds the cached embedding most similar
+    to the request's among the results of the same labelling method, method parameters and verified image index
+    version, and returns its result if the cosine similarity of the two normalised embeddings is at least
+    min_similarity. Results from an old index are never returned.
+
+    The nearest embedding is found by brute force, which for the default 1024 entries is one small matrix-vector
+    product per lookup.
+    """
+
+    def __init__(self, max_entries=1024, ttl=10.0, min_similarity=0.97):
+        """_summary_
+
+        Args:
+            max_entries (int): Maximum number of cached results. The least recently used result is evicted first.
+            ttl (float): Number of seconds a result stays valid.
+            min_similarity (float): Minimum cosine similarity of two embeddings for them to share a result. Lower
+                                    values let more near duplicate embeddings share a result.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.min_similarity = min_similarity
+        # entry id: (group, embedding, result, time stored, compute seconds)
+        self._entries = OrderedDict()
+        # group: [entry ids, matrix of their embeddings or None if it needs rebuilding]
+        self._groups = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.saved_seconds = 0.0
+
+    def make_key(self, method, embedding, version, *params):
+        """_summary_
+        Returns the cache key of an embedding for the given method, index version and method parameters.
+        """
+        emb = np.asarray(embedding, dtype=np.float32).ravel()
+        norm = np.linalg.norm(emb)
+        if norm > 0:
+            emb = emb / norm
+        # Lists from the request JSON are not hashable.
+        params = tuple(tuple(param) if isinstance(param, list) else param for param in params)
+        return CacheKey((method, version, params), emb)
+
+    def _nearest(self, key):
+        """_summary_
+        Returns (entry id, similarity) of the cached embedding most similar to key's in key's group, or (None, None).
+        """
+        group = self._groups.get(key.group)
+        if not group or not group[0]:
+            return None, None
+        if group[1] is None:
+            group[1] = np.stack([self._entries[entry_id][1] for entry_id in group[0]])
+        if group[1].shape[1] != key.embedding.shape[0]:
+            return None, None
+        similarities = group[1] @ key.embedding
+        best = int(np.argmax(similarities))
+        return group[0][best], float(similarities[best])
+
+    def _remove(self, entry_id):
+        group_key = self._entries.pop(entry_id)[0]
+        group = self._groups[group_key]
+        group[0].remove(entry_id)
+        group[1] = None
+        if not group[0]:
+            del self._groups[group_key]
+
+    def get(self, key):
+        """_summary_
+        Returns the cached result of the most similar embedding to key's, or None if there is no valid result within
+        min_similarity.
+        """
+        with self._lock:
+            entry_id, similarity = self._nearest(key)
+            if entry_id is not None and time.monotonic() - self._entries[entry_id][3] > self.ttl:
+                self._remove(entry_id)
+                entry_id = None
+            if entry_id is None or similarity < self.min_similarity:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(entry_id)
+            entry = self._entries[entry_id]
+            self.hits += 1
+            if similarity < 1.0 - 1e-6:
+                self.near_hits += 1
+            self.saved_seconds += entry[4]
+            return entry[2]
+
+    def put(self, key, result, compute_seconds):
+        """_summary_
+        Stores a result. compute_seconds is how long the result took to compute, and is counted as time saved
+        every time the result is returned from the cache.
+        """
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (key.group, key.embedding, result, time.monotonic(), compute_seconds)
+            group = self._groups.setdefault(key.group, [[], None])
+            group[0].append(entry_id)
+            group[1] = None
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def clear(self):
+        """_summary_
+        Removes every cached result. Called when the verified image index is rebuilt.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._groups.clear()
+
+    def stats(self):
+        """_summary_
+        Returns the cache metrics as a dictionary. near_hits counts the hits on an embedding that was similar to, but
+        not the same as, the cached one.
+        """
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "near_hits": self.near_hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests else 0.0,
+                "evictions": self.evictions,
+                "saved_seconds": self.saved_seconds,
+                "min_similarity": self.min_similarity,
+            }
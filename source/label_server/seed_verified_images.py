@@ -0,0 +1,69 @@
+"""
+Seeds the image database with verified images from a packed embedding store (see common/embedding_store.py) or a
+directory of per-image .npy embeddings, as the label_images() function of Scripts/Experimentation_Script.ipynb does
+one image at a time.
+
+Each image is labelled with --method. Its ground truth labels become its verified labels, and the predicted labels
+that are not in the ground truth become its incorrect labels. The ground truth is read from the store's "labels"
+metadata, or from --labels. The documents are inserted in batches with row ids already assigned.
+
+Usage:
+    python seed_verified_images.py ../../Clip_Image_Embeddings/FairFace.store --method method_1
+    python seed_verified_images.py "../../Test Data Files/test_1" --labels fairface_label_train.csv
+"""
+import argparse
+import json
+import time
+import uuid
+from bulk_label import load_embedding_dir, label_embeddings, load_fairface_labels
+
+
+def build_documents(names, embeddings, predictions, ground_truth, first_row_id):
+    """_summary_
+    Returns the verified image documents of the images that have ground truth.
+    """
+    documents = []
+    for name, embedding, predicted in zip(names, embeddings, predictions):
+        truth = ground_truth.get(name)
+        if not truth:
+            continue
+        documents.append({
+            "_id": uuid.uuid4().hex,
+            "image_data": "train/" + name,
+            "embedding": embedding.reshape(1, -1).tolist(),
+            "unverified_labels": "",
+            "verified_labels": list(truth),
+            "incorrect_labels": [label for label in predicted if label not in truth],
+            "requiresVerification": "False",
+            "row_id": first_row_id + len(documents),
+        })
+    return documents
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("source", help="Packed embedding store, or directory of <image name>.npy files.")
+    parser.add_argument("--labels", help="FairFace label CSV. Defaults to the store's labels metadata.")
+    parser.add_argument("--method", default="method_1",
+                        choices=["method_1", "method_2", "method_3", "method_4", "method_5"])
+    parser.add_argument("--batch-size", type=int, default=1000, help="Number of documents per insert.")
+    args = parser.parse_args()
+
+    import label
+    start = time.perf_counter()
+    names, embeddings, ground_truth = load_embedding_dir(args.source)
+    if args.labels:
+        ground_truth = load_fairface_labels(args.labels)
+    predictions = label_embeddings(args.method, embeddings)
+
+    # Reserve a block of row ids for the images that have ground truth.
+    count = sum(1 for name in names if ground_truth.get(name))
+    documents = build_documents(names, embeddings, predictions, ground_truth, label.get_next_row_id(count))
+    collection = label.db["image_data"]
+    for i in range(0, len(documents), args.batch_size):
+        collection.insert_many(documents[i:i + args.batch_size])
+    print(json.dumps({"inserted": len(documents), "seconds": time.perf_counter() - start}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+"""
+Registry of label taxonomies, loaded from a JSON config file.
+
+Each taxonomy is a named list of labels, for example ages, nationalities or dog breeds, with optional prompt templates.
+The text features of a taxonomy are built once and persisted as data/<name>/<name>.index (a FAISS index of the
+normalised features, in label order) and data/<name>/<name>_dictionary (a pickled {position: label} dictionary), the
+same layout as the indexes built by Scripts/index_builder.ipynb. A <name>.json file next to them records the version
+hash of the model, labels and templates they were built from, so a taxonomy is only rebuilt when its definition
+changes.
+
+Config format:
+    {
+        "age": {"labels": ["0-2", "3-9", ...]},
+        "dogs": {"labels_file": "dogs.csv", "templates": ["a photo of a {}."]},
+        "gender": {"labels": ["Male", "Female"], "file_name": "genders"}
+    }
+
+    labels          list of labels, or
+    labels_file     CSV file with one label per row, relative to the config file
+    templates       prompt templates, "{}" is replaced by the label. Defaults to the bare label.
+    file_name       name of the persisted index files. Defaults to the taxonomy name.
+
+reload() can be called while the server is running. New and changed taxonomies are built, the others are reused, and
+the scoring state is swapped in with a single assignment.
+"""
+import csv
+import json
+import math
+import os
+import pickle
+import threading
+from collections import namedtuple
+import faiss
+import torch
+import torch.nn.functional as F
+import prompt_ensembles
+
+TAXONOMY_CONFIG = os.environ.get(
+    "TAXONOMY_CONFIG", os.path.join(os.path.dirname(os.path.abspath(__file__)), "taxonomies.json"))
+TAXONOMY_DATA_DIR = os.environ.get(
+    "TAXONOMY_DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"))
+
+# Model used by Scripts/index_builder.ipynb to build the indexes that have no version file.
+NOTEBOOK_MODEL = "ViT-L/14"
+
+Taxonomy = namedtuple("Taxonomy", ["name", "labels", "templates", "version", "features"])
+
+# The scoring state of every loaded taxonomy. features holds the features of every label of every taxonomy,
+# label_matrix holds the position of each taxonomy's labels in features, padded with the position of an extra -inf
+# column, and positions maps each taxonomy name to its row in label_matrix.
+TaxonomyState = namedtuple("TaxonomyState", ["taxonomies", "positions", "features", "label_matrix", "version"])
+
+
+def read_labels(taxonomy_config, config_dir):
+    """_summary_
+    Returns the labels of a taxonomy from its "labels" list or "labels_file" CSV.
+    """
+    if "labels" in taxonomy_config:
+        return [str(label) for label in taxonomy_config["labels"]]
+    labels = []
+    with open(os.path.join(config_dir, taxonomy_config["labels_file"]), newline="", encoding="utf-8-sig") as file:
+        for row in csv.reader(file):
+            label = ",".join(row).strip()
+            if label:
+                labels.append(label)
+    return labels
+
+
+class TaxonomyRegistry:
+    """_summary_
+    Loads, builds and scores the taxonomies in a config file. Scoring uses the current state, which is replaced as a
+    whole by reload(), so a reload never affects a request that is already scoring.
+    """
+
+    def __init__(self, model, tokenize, device, model_name, config_path=TAXONOMY_CONFIG, data_dir=TAXONOMY_DATA_DIR):
+        """_summary_
+
+        Args:
+            model: Clip model used to encode the labels.
+            tokenize (function): clip.tokenize.
+            device (str): Device the model is on.
+            model_name (str): Name of the clip model, part of each taxonomy's version.
+            config_path (str): Path of the JSON config file.
+            data_dir (str): Directory the taxonomy indexes are persisted in.
+        """
+        self.model = model
+        self.tokenize = tokenize
+        self.device = device
+        self.model_name = model_name
+        self.config_path = config_path
+        self.data_dir = data_dir
+        self.state = TaxonomyState({}, {}, torch.empty((0, 0)), torch.empty((0, 0), dtype=torch.long), 0)
+        self._config_mtime = None
+        self._reload_lock = threading.Lock()
+
+    def reload(self):
+        """_summary_
+        Reads the config file, builds any new or changed taxonomy and swaps in the new scoring state.
+
+        Returns:
+            list: Names of the taxonomies that were built rather than reused or loaded from disk.
+        """
+        with self._reload_lock:
+            self._config_mtime = os.path.getmtime(self.config_path)
+            with open(self.config_path) as file:
+                config = json.load(file)
+            config_dir = os.path.dirname(os.path.abspath(self.config_path))
+
+            taxonomies = {}
+            built = []
+            for name, taxonomy_config in config.items():
+                labels = read_labels(taxonomy_config, config_dir)
+                templates = taxonomy_config.get("templates") or ["{}"]
+                version = prompt_ensembles.ensemble_version(self.model_name, [labels], [templates])
+                current = self.state.taxonomies.get(name)
+                if current is not None and current.version == version:
+                    taxonomies[name] = current
+                    continue
+                file_name = taxonomy_config.get("file_name", name)
+                features = self._load(name, file_name, labels, templates, version)
+                if features is None:
+                    features = prompt_ensembles.build_ensemble_features(
+                        self.model, self.tokenize, self.device, [labels], [templates])
+                    self._save(name, file_name, labels, version, features)
+                    built.append(name)
+                taxonomies[name] = Taxonomy(name, labels, templates, version, features)
+
+            self.state = self._build_state(taxonomies, self.state.version + 1)
+            return built
+
+    def reload_if_changed(self):
+        """_summary_
+        Reloads the config file if it has been modified since it was last read.
+
+        Returns:
+            bool: True if the config was reloaded.
+        """
+        try:
+            if os.path.getmtime(self.config_path) == self._config_mtime:
+                return False
+            self.reload()
+            return True
+        except Exception as e:
+            print(e)
+            return False
+
+    def score(self, embedding, names=None):
+        """_summary_
+        Labels an image embedding with every taxonomy in names (default: all taxonomies) in one pass.
+
+        Returns:
+            dict: {taxonomy name: label}
+
+        Raises:
+            KeyError: If a name is not a loaded taxonomy.
+        """
+        state = self.state
+        if names is None:
+            names = list(state.taxonomies)
+        rows = torch.tensor([state.positions[name] for name in names], dtype=torch.long)
+        image_features = F.normalize(torch.as_tensor(embedding, dtype=torch.float32).reshape(1, -1), p=2, dim=1)
+        similarity = (image_features @ state.features.T)[0]
+        similarity = torch.cat([similarity, torch.tensor([-math.inf])])
+        _, indices = similarity[state.label_matrix[rows]].max(dim=1)
+        return {name: state.taxonomies[name].labels[int(index)] for name, index in zip(names, indices)}
+
+    def _build_state(self, taxonomies, version):
+        names = list(taxonomies)
+        sizes = [len(taxonomies[name].labels) for name in names]
+        total = sum(sizes)
+        features = torch.cat([taxonomies[name].features for name in names]) if names else torch.empty((0, 0))
+        label_matrix = torch.full((len(names), max(sizes, default=0)), total, dtype=torch.long)
+        offset = 0
+        for i, size in enumerate(sizes):
+            label_matrix[i, :size] = torch.arange(offset, offset + size)
+            offset += size
+        return TaxonomyState(taxonomies, {name: i for i, name in enumerate(names)}, features, label_matrix, version)
+
+    def _paths(self, name, file_name):
+        folder = os.path.join(self.data_dir, name)
+        return (os.path.join(folder, file_name + ".index"), os.path.join(folder, file_name + "_dictionary"),
+                os.path.join(folder, file_name + ".json"))
+
+    def _load(self, name, file_name, labels, templates, version):
+        """_summary_
+        Returns the persisted features of a taxonomy, or None if they are missing or were built from a different
+        model, labels or templates. Indexes without a version file were built by Scripts/index_builder.ipynb from
+        the bare labels, and are reused if the taxonomy has no templates and the same labels.
+        """
+        index_path, dictionary_path, version_path = self._paths(name, file_name)
+        if not (os.path.exists(index_path) and os.path.exists(dictionary_path)):
+            return None
+        try:
+            if os.path.exists(version_path):
+                with open(version_path) as file:
+                    if json.load(file).get("version") != version:
+                        return None
+            elif templates != ["{}"] or self.model_name != NOTEBOOK_MODEL:
+                return None
+            with open(dictionary_path, "rb") as file:
+                dictionary = pickle.load(file)
+            if [dictionary.get(i) for i in range(len(labels))] != labels or len(dictionary) != len(labels):
+                return None
+            index = faiss.read_index(index_path)
+            features = torch.from_numpy(index.reconstruct_n(0, index.ntotal))
+            return F.normalize(features.float(), p=2, dim=1)
+        except Exception as e:
+            print(e)
+            return None
+
+    def _save(self, name, file_name, labels, version, features):
+        index_path, dictionary_path, version_path = self._paths(name, file_name)
+        try:
+            os.makedirs(os.path.dirname(index_path), exist_ok=True)
+            index = faiss.IndexFlatL2(features.shape[1])
+            index.add(features.numpy().astype("float32"))
+            faiss.write_index(index, index_path)
+            with open(dictionary_path, "wb") as file:
+                pickle.dump({i: label for i, label in enumerate(labels)}, file)
+            with open(version_path, "w") as file:
+                json.dump({"version": version, "model": self.model_name}, file)
+        except Exception as e:
+            print(e)
@@ -0,0 +1,33 @@
+"""
+Packs directories of per-image .npy clip embeddings (Clip_Image_Embeddings/<dataset>, "Test Data Files/test_N") into
+packed embedding stores (see common/embedding_store.py).
+
+Usage:
+    python pack_embeddings.py ../Clip_Image_Embeddings/FairFace ../Clip_Image_Embeddings/FairFace.store
+    python pack_embeddings.py "../Test Data Files/test_1" test_1.store --labels fairface_label_train.csv
+    python pack_embeddings.py new_images existing.store --shard-size 5000     (appends new shards)
+"""
+import argparse
+import json
+import time
+from common.embedding_store import EmbeddingStore, load_fairface_labels, pack_directory
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory", help="Directory of <image name>.npy files.")
+    parser.add_argument("store", help="Store directory. Created if it does not exist, else appended to.")
+    parser.add_argument("--shard-size", type=int, default=10000, help="Maximum number of embeddings per shard.")
+    parser.add_argument("--labels", help="FairFace label CSV. The labels of each image are stored as metadata.")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    store = EmbeddingStore(args.store)
+    labels = load_fairface_labels(args.labels) if args.labels else None
+    packed = pack_directory(args.directory, store, args.shard_size, labels)
+    print(json.dumps({"packed": packed, "rows": len(store), "shards": len(store.manifest["shards"]),
+                      "seconds": time.perf_counter() - start}))
+
+
+if __name__ == "__main__":
+    main()
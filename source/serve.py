@@ -0,0 +1,73 @@
+"""
+Starts one of the services with gunicorn instead of the Flask development server.
+
+Usage:
+    python serve.py label --workers 2 --threads 4
+    python serve.py embedding --workers 1 --threads 8 --port 5002
+    python serve.py label_async --workers 1
+
+By default the app is preloaded: the models (and the label server's index) are loaded once in the gunicorn master
+process and shared with the workers copy-on-write. Use --no-preload when the models are on a GPU, as CUDA cannot be
+used in a forked process, so each worker has to load its own model.
+"""
+import argparse
+import os
+import sys
+
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# service name: (folder, module, app, default port)
+SERVICES = {
+    "face_detection": ("face_detection_server", "app", "app", 5010),
+    "embedding": ("image_embedding_server", "app", "app", 5002),
+    "label": ("label_server", "app", "app", 5003),
+    "label_async": ("label_server", "async_app", "app", 5004),
+    "ui": ("UI_Tool", "run", "app", 5000),
+}
+
+# ASGI services are run by uvicorn workers instead of gunicorn's threaded workers. --threads does not apply to them.
+WORKER_CLASSES = {
+    "label_async": "uvicorn.workers.UvicornWorker",
+}
+
+
+def gunicorn_command(service, workers, threads, host, port, preload):
+    """_summary_
+    Returns the gunicorn command line and environment variables used to serve a service.
+    """
+    folder, module, app, default_port = SERVICES[service]
+    command = [sys.executable, "-m", "gunicorn",
+               "--config", os.path.join(SOURCE_DIR, "gunicorn.conf.py"),
+               "--chdir", os.path.join(SOURCE_DIR, folder),
+               "--workers", str(workers),
+               "--threads", str(threads),
+               "--bind", f"{host}:{port or default_port}"]
+    if service in WORKER_CLASSES:
+        command += ["--worker-class", WORKER_CLASSES[service]]
+    # SERVICE_WORKERS is used by common/threads.py to divide the cores between the workers.
+    env = dict(os.environ, SERVICE_MODULE=module, SERVICE_WORKERS=str(workers))
+    if preload:
+        command.append("--preload")
+        # The background jobs are started by the post_fork hook in gunicorn.conf.py instead of at import.
+        env["DEFER_BACKGROUND_JOBS"] = "1"
+    command.append(f"{module}:{app}")
+    return command, env
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("service", choices=SERVICES.keys())
+    parser.add_argument("--workers", type=int, default=2, help="Number of worker processes.")
+    parser.add_argument("--threads", type=int, default=4, help="Number of request threads per worker.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, help="Defaults to the port used by the development server.")
+    parser.add_argument("--no-preload", dest="preload", action="store_false",
+                        help="Load the app separately in each worker.")
+    args = parser.parse_args()
+
+    command, env = gunicorn_command(args.service, args.workers, args.threads, args.host, args.port, args.preload)
+    os.execvpe(command[0], command, env)
+
+
+if __name__ == "__main__":
+    main()